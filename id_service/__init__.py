@@ -0,0 +1 @@
+default_app_config = 'id_service.apps.IdServiceConfig'
@@ -3,3 +3,14 @@ from django.apps import AppConfig
 
 class IdServiceConfig(AppConfig):
     name = 'id_service'
+
+    def ready(self):
+        # connect model signal receivers
+        from . import signals
+
+        # in-process models are loaded once per worker, before the first request
+        from django.conf import settings
+        from django.utils.module_loading import import_string
+        from .inference import get_backend
+        if import_string(settings.INFERENCE_BACKEND).load_on_start:
+            get_backend()
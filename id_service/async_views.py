@@ -0,0 +1,132 @@
+"""
+Async counterparts of the API views, for running under ASGI (see proj/asgi.py)
+inference calls are awaited instead of blocking the worker, ORM access is offloaded to a thread with sync_to_async
+so a single worker can keep many inference bound uploads in flight.
+urls.py picks these over the sync views when ASYNC_VIEWS is set
+"""
+import asyncio
+from functools import update_wrapper
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from .inference import acall_encoder, acall_differenciator
+from .preprocessing import preprocess
+from .views import UnifiedBase, ImageView, check_token
+from . import upload_cache
+
+
+class AsyncUnifiedBase(UnifiedBase):
+    """
+    UnifiedBase with an async dispatch, the call flow is the same
+    handlers can be sync or async, sync ones are run in a thread
+    """
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # let django validate initkwargs, then build our own coroutine view around the class
+        super(AsyncUnifiedBase, cls).as_view(**initkwargs)
+
+        async def view(request, *args, **kwargs):
+            self = cls(**initkwargs)
+            # setup looks up the token
+            await sync_to_async(self.setup)(request, *args, **kwargs)
+            return await self.dispatch(request, *args, **kwargs)
+
+        view.view_class = cls
+        view.view_initkwargs = initkwargs
+        update_wrapper(view, cls, updated=())
+        update_wrapper(view, cls.dispatch, assigned=())
+        return view
+
+    async def dispatch(self, request, *args, **kwargs):
+        # setting up data first before dispatching to HTTP methods
+        await sync_to_async(self.get_or_create_object)()
+
+        if request.method.lower() in self.http_method_names:
+            handler = getattr(self, request.method.lower(), self.http_method_not_allowed)
+        else:
+            handler = self.http_method_not_allowed
+
+        if asyncio.iscoroutinefunction(handler):
+            ok = await handler(request, *args, **kwargs)
+        else:
+            ok = await sync_to_async(handler)(request, *args, **kwargs)
+
+        return await sync_to_async(self.finish_response)(ok)
+
+
+class AsyncImageView(AsyncUnifiedBase, ImageView):
+    """ImageView with uploads handled without blocking on the model servers"""
+
+    @check_token()
+    async def post(self,request,*args,**kwargs):
+        # HTTP POST needs to do its own data modification, (basically just a form_valid)
+        populated_form = self.get_form(request=request)
+
+        # only save form when data is valid, validating may look up related models
+        if await sync_to_async(populated_form.is_valid)():
+            self.object = populated_form.save(commit=False)
+
+            image_file = populated_form.files.get("image_file")
+            if image_file is None:
+                # No image is uploaded, no ML inference
+                return True
+
+            # the same bytes may have been uploaded before, see upload_cache.py
+            upload_digest = upload_cache.digest(image_file)
+            cached = await sync_to_async(upload_cache.lookup)(self.object.data_set_id, upload_digest)
+            if cached is not None:
+                # reuse stored file and embedding, nothing to decode or encode
+                self.object.image_file, self.object.embedding, cached_identity = cached
+                embedding_vector = self.object.vector
+                if self.object.identity_id is None:
+                    self.object.identity_id = cached_identity
+            elif settings.ASYNC_UPLOADS:
+                # answer now, decoding and inference run in the background, see jobs.py
+                return await sync_to_async(self.queue_upload)(image_file, upload_digest)
+            else:
+                cleaned_image, embedding_vector = await self.process_image(image_file)
+                # update object with computed image related data
+                await sync_to_async(self.object.image_file.save)(str(self.object.id),cleaned_image,save=False)
+                self.object.vector = embedding_vector
+
+            # if an identity isn't provided, make new or find matching one
+            if self.object.identity_id is None:
+                self.object.identity = await self.get_identity(embedding_vector)
+            await sync_to_async(upload_cache.store)(self.object.data_set_id, upload_digest, self.object)
+
+        # new records have empty forms, but still it's not a bad request
+        elif self.kwargs['pk'] != "new":
+            return False
+
+        return True
+
+    @check_token(expensive_action=True)
+    async def process_image(self,image_file):
+        """
+        returns a cleaned, standard sized django ImageFile, and embedding vector of image
+        """
+        # resizing is cpu bound, keep it off the event loop
+        new_file, pixels = (await sync_to_async(preprocess, thread_sensitive=False)([image_file]))[0]
+
+        # run pixels through encoder
+        vector = await acall_encoder(pixels)
+
+        return new_file, vector
+
+    @check_token(expensive_action=True)
+    async def get_identity(self,vector):
+        # animals made by other uploads from here on are checked again before a new one is saved
+        self.matching_started = timezone.now()
+        identities, candidates = await sync_to_async(self.get_candidates)(vector)
+
+        #  verify each possible candidate, query vector is broadcast against all of them
+        if len(candidates):
+            sameness = await acall_differenciator(candidates, np.asarray(vector, dtype=np.float32))
+        else:
+            sameness = []
+
+        return await sync_to_async(self.resolve_identity)(identities, sameness)
@@ -0,0 +1,148 @@
+"""
+Dynamic micro-batching for model server calls
+concurrent views submit their instances to a MicroBatcher, a background thread merges whatever is pending
+into one predict call (up to max_batch_size instances, waiting at most max_wait_ms for more to arrive)
+and hands each caller back its own slice of predictions.
+AsyncMicroBatcher does the same for coroutines, with a task on the caller's event loop instead of a thread
+"""
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class MicroBatcher:
+
+    def __init__(self, predict, max_batch_size, max_wait_ms):
+        """predict takes a stacked np array of instances and returns a list with one prediction per instance"""
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+
+        self._queue = queue.Queue()
+        self._worker = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, instances) -> list:
+        """blocks until predictions for instances are back, exceptions from predict are re-raised here"""
+        instances = np.asarray(instances)
+        future = Future()
+        self._ensure_worker()
+        self._queue.put((instances, future))
+        return future.result()
+
+    def _ensure_worker(self):
+        with self._start_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        carry = None
+        while True:
+            # block for the first request of a batch
+            pending = [carry or self._queue.get()]
+            carry = None
+            size = len(pending[0][0])
+            deadline = time.monotonic() + self.max_wait
+
+            # collect more until batch is full or we've waited long enough
+            while size < self.max_batch_size:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if size + len(item[0]) > self.max_batch_size:
+                    # doesn't fit, goes first in next batch
+                    carry = item
+                    break
+                pending.append(item)
+                size += len(item[0])
+
+            self._dispatch(pending)
+
+    def _dispatch(self, pending):
+        try:
+            predictions = self.predict(np.concatenate([instances for instances, future in pending]))
+        except Exception as e:
+            for instances, future in pending:
+                future.set_exception(e)
+            return
+
+        # route each slice back to its caller
+        start = 0
+        for instances, future in pending:
+            future.set_result(predictions[start:start + len(instances)])
+            start += len(instances)
+
+
+class AsyncMicroBatcher:
+    """
+    MicroBatcher for async views, merges calls made on one event loop, nothing blocks the loop
+    predict is a coroutine function, queue and worker task belong to the loop the first call was made on
+    """
+
+    def __init__(self, predict, max_batch_size, max_wait_ms):
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+
+        self._queue = asyncio.Queue()
+        self._worker = None
+
+    async def submit(self, instances) -> list:
+        """returns predictions for instances once their batch is back, exceptions from predict are re-raised here"""
+        instances = np.asarray(instances)
+        future = asyncio.get_running_loop().create_future()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.ensure_future(self._run())
+        self._queue.put_nowait((instances, future))
+        return await future
+
+    def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        carry = None
+        while True:
+            # wait for the first request of a batch
+            pending = [carry or await self._queue.get()]
+            carry = None
+            size = len(pending[0][0])
+            deadline = loop.time() + self.max_wait
+
+            # collect more until batch is full or we've waited long enough
+            while size < self.max_batch_size:
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    break
+                if size + len(item[0]) > self.max_batch_size:
+                    # doesn't fit, goes first in next batch
+                    carry = item
+                    break
+                pending.append(item)
+                size += len(item[0])
+
+            await self._dispatch(pending)
+
+    async def _dispatch(self, pending):
+        try:
+            predictions = await self.predict(np.concatenate([instances for instances, future in pending]))
+        except Exception as e:
+            for instances, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        # route each slice back to its caller, unless it has given up waiting
+        start = 0
+        for instances, future in pending:
+            if not future.done():
+                future.set_result(predictions[start:start + len(instances)])
+            start += len(instances)
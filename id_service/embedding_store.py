@@ -0,0 +1,198 @@
+"""
+On-disk embedding store, one per DataSet (public images are kept under "public")
+each store is a pair of flat files under EMBEDDING_STORE_ROOT:
+-vectors.f32, contiguous float32 matrix of EMBEDDING_DIM columns
+-ids.bin, fixed width ascii ImageRecord ids, row i belongs to vector row i
+
+files are memory-mapped read only, so every worker process shares the same pages
+and can serve lookups without loading the image table first.
+writers take an exclusive flock, rows are updated in place, deleted rows are overwritten with NaN
+ImageRecord save / delete signals keep the store in line with ImageRecord.vector, see signals.py
+
+rows appended by other processes are picked up on every read: refresh() compares row count and inode
+on disk with what's mapped, readers holding copies (vector_index.py) compare version before each query
+"""
+import fcntl
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+from django.conf import settings
+
+from .models import ImageRecord
+
+ID_WIDTH = 36  # <= uuid4 as str
+
+
+class EmbeddingStore:
+
+    def __init__(self, data_set_id, root=None, dim=None):
+        self.dim = dim or settings.EMBEDDING_DIM
+        self.path = os.path.join(str(root or settings.EMBEDDING_STORE_ROOT), data_set_id or "public")
+        self.vector_path = os.path.join(self.path, "vectors.f32")
+        self.id_path = os.path.join(self.path, "ids.bin")
+        self.lock_path = os.path.join(self.path, "lock")
+
+        self._lock = threading.Lock()
+        self._rows = 0
+        self._inode = None
+        self._vectors = np.zeros((0, self.dim), dtype=np.float32)
+        self._ids = np.zeros((0,), dtype=f"S{ID_WIDTH}")
+        self._positions = {}
+
+    def exists(self):
+        return os.path.exists(self.id_path)
+
+    @contextmanager
+    def _write_lock(self):
+        os.makedirs(self.path, exist_ok=True)
+        with self._lock, open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @property
+    def version(self):
+        """(inode, rows) as last mapped, rows only grow until the store is rebuilt with a new inode"""
+        return self._inode, self._rows
+
+    def refresh(self) -> bool:
+        """re-map files if another process has appended rows or rebuilt the store since we last looked, True if so"""
+        if not self.exists():
+            return False
+        id_stat = os.stat(self.id_path)
+        rows = min(id_stat.st_size // ID_WIDTH, os.path.getsize(self.vector_path) // (4 * self.dim))
+        if id_stat.st_ino != self._inode:
+            # store was rebuilt, possibly by another process
+            self._inode = id_stat.st_ino
+            self._positions = {}
+            self._rows = -1
+        if rows == self._rows:
+            return False
+
+        if rows == 0:
+            self._vectors = np.zeros((0, self.dim), dtype=np.float32)
+            self._ids = np.zeros((0,), dtype=f"S{ID_WIDTH}")
+        else:
+            self._vectors = np.memmap(self.vector_path, dtype=np.float32, mode="r", shape=(rows, self.dim))
+            self._ids = np.memmap(self.id_path, dtype=f"S{ID_WIDTH}", mode="r", shape=(rows,))
+
+        for i in range(max(self._rows, 0), rows):
+            self._positions[self._ids[i].decode()] = i
+        self._rows = rows
+        return True
+
+    def arrays(self, start=0):
+        """
+        returns ids as str list and the memory-mapped vector matrix, from row start on
+        rows of deleted records are NaN, any comparison against them is False
+        """
+        self.refresh()
+        return [each.decode() for each in self._ids[start:]], self._vectors[start:]
+
+    def get(self, record_id):
+        self.refresh()
+        try:
+            vector = self._vectors[self._positions[str(record_id)]]
+        except KeyError:
+            return None
+        return None if np.isnan(vector).any() else vector
+
+    def put(self, record_id, vector):
+        vector = np.asarray(vector, dtype=np.float32).reshape(self.dim)
+        with self._write_lock():
+            self.refresh()
+            position = self._positions.get(str(record_id))
+            if position is not None:
+                with open(self.vector_path, "r+b") as f:
+                    f.seek(position * 4 * self.dim)
+                    f.write(vector.tobytes())
+            else:
+                # new record, append to both files, vectors first so readers never see an id without a row
+                with open(self.vector_path, "ab") as f:
+                    f.write(vector.tobytes())
+                with open(self.id_path, "ab") as f:
+                    f.write(str(record_id).encode().ljust(ID_WIDTH, b"\0"))
+
+    def delete(self, record_id):
+        if not self.exists():
+            return
+        with self._write_lock():
+            self.refresh()
+            try:
+                position = self._positions[str(record_id)]
+            except KeyError:
+                return
+            with open(self.vector_path, "r+b") as f:
+                f.seek(position * 4 * self.dim)
+                f.write(np.full(self.dim, np.nan, dtype=np.float32).tobytes())
+
+    def rebuild(self, rows):
+        """rewrite the store from (id, vector) pairs, drops deleted rows"""
+        with self._write_lock():
+            with open(self.vector_path + ".new", "wb") as vector_file, open(self.id_path + ".new", "wb") as id_file:
+                for record_id, vector in rows:
+                    vector_file.write(np.asarray(vector, dtype=np.float32).reshape(self.dim).tobytes())
+                    id_file.write(str(record_id).encode().ljust(ID_WIDTH, b"\0"))
+            # swap in ids last, refresh() takes the smaller of the two row counts
+            os.replace(self.vector_path + ".new", self.vector_path)
+            os.replace(self.id_path + ".new", self.id_path)
+            self.refresh()
+
+
+###
+## Per DataSet registry
+#
+_stores = {}
+_registry_lock = threading.Lock()
+
+
+def get_store(data_set_id, build=True):
+    """
+    returns store for data set, building it from db if it isn't on disk yet
+    with build=False, None is returned instead of building
+    """
+    data_set_id = None if data_set_id is None else str(data_set_id)
+    with _registry_lock:
+        try:
+            return _stores[data_set_id]
+        except KeyError:
+            pass
+        store = EmbeddingStore(data_set_id)
+        if not store.exists():
+            if not build:
+                return None
+            records = ImageRecord.objects.filter(data_set_id=data_set_id, embedding__isnull=False).iterator()
+            store.rebuild((each.id, each.vector) for each in records)
+        _stores[data_set_id] = store
+        return store
+
+
+def record_saved(record):
+    data_set_id = None if record.data_set_id is None else str(record.data_set_id)
+    if record.vector is not None:
+        get_store(data_set_id).put(record.id, record.vector)
+    else:
+        store = get_store(data_set_id, build=False)
+        if store is not None:
+            store.delete(record.id)
+
+    # the record may have moved between data sets
+    for key, store in list(_stores.items()):
+        if key != data_set_id:
+            store.delete(record.id)
+
+
+def record_deleted(record):
+    store = get_store(record.data_set_id, build=False)
+    if store is not None:
+        store.delete(record.id)
+
+
+def reset():
+    """forget opened stores, files on disk are left alone"""
+    with _registry_lock:
+        _stores.clear()
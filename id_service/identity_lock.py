@@ -0,0 +1,37 @@
+"""
+Per data set lock around making new animals
+two uploads of a new animal arriving together would each find no match and make an animal of their own.
+matching (candidate lookup and the differentiator) runs without any lock, and so does checking animals made by
+other uploads since matching started, see ImageView.save_object. only when that comes up empty too is the
+data set's lock taken: the few animals made while the check ran are checked, then the new animal is made and the
+image saved in the same transaction, so whoever goes next sees them.
+
+the lock is the data set's IdentityLock row, taken by updating it. that holds a row lock to the end of the
+transaction on postgres / mysql, and the database write lock on sqlite
+"""
+from contextlib import contextmanager
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import IdentityLock
+
+
+def _key(data_set_id):
+    return "public" if data_set_id is None else str(data_set_id)
+
+
+@contextmanager
+def hold(data_set_id):
+    """runs the block in a transaction holding data set's identity lock"""
+    key = _key(data_set_id)
+    with transaction.atomic():
+        if not IdentityLock.objects.filter(key=key).update(taken=timezone.now()):
+            # first new animal in this data set, make the row
+            try:
+                with transaction.atomic():
+                    IdentityLock.objects.create(key=key, taken=timezone.now())
+            except IntegrityError:
+                # made by someone else meanwhile, waits for their transaction
+                IdentityLock.objects.filter(key=key).update(taken=timezone.now())
+        yield
@@ -2,55 +2,369 @@
 Inference is now done by Django calling REST API on tf-serving containers
 each model have their own container, reachable by other containerized services through default network  
 see docker-compose.yml for the tf-serving container configs
+
+for small deployments, models can also be run in-process with LocalBackend, see INFERENCE_BACKEND in settings
 """
+import asyncio
+import base64
+import json
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from PIL import Image
 from io import BytesIO
+from asgiref.sync import sync_to_async
+
+try:
+    import httpx
+except ImportError:
+    # async views fall back to running the blocking client in a thread
+    httpx = None
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.core.files.images import ImageFile
+from django.utils.module_loading import import_string
+
+from .batching import MicroBatcher, AsyncMicroBatcher
+from . import timing
 
 
 # Note: the tf-serving API calls assume each model is served by its own tfs container
 # see docker-compose for the tf-serving container configs
 def call_encoder(pixels:np.ndarray) -> list:
     """returns vector embedding of a single image as python list"""
-    url = "http://" + "/".join([
-        f"{settings.ENCODER_NAME}:{settings.TF_SERVER_PORT}",
-        "v1/models",
-        settings.ENCODER_NAME
-    ]) + ":predict"
-    data = {
-        "instances": pixels.tolist()
-    }
-    response = requests.post(url,json=data)
-    # return the first prediction since images are always given in batch of 1
-    return response.json()['predictions'][0]
+    # return the first prediction since images are given in batch of 1 here
+    return call_encoder_batch(pixels)[0]
 
 
+@timing.timed("encoder")
+def call_encoder_batch(pixels:np.ndarray) -> list:
+    """
+    returns vector embeddings for a batch of images as list of python lists
+    pixels should be stacked on the first axis, see standardize_image
+    """
+    return _predict(settings.ENCODER_NAME, pixels)
+
+
+@timing.timed("differentiator")
 def call_differenciator(batch_left, batch_right) -> list:
     """
     returns sameness for the entire batch  
-    note: each batch should be a list of vectors
+    note: each batch should be a list of vectors, batch_right can also be a single vector to compare everything against
     """
+    predictions = _predict(settings.DIFFERENTIATOR_NAME, _differenciator_batch(batch_left, batch_right))
+    return _to_sameness(predictions)
+
+
+def _differenciator_batch(batch_left, batch_right) -> np.ndarray:
     # combine two halfs into a single batch
-    batch = np.concatenate([batch_left,batch_right], axis=1)
-
-    # call tf serving API
-    url = "http://" + "/".join([
-        f"{settings.DIFFERENTIATOR_NAME}:{settings.TF_SERVER_PORT}",
-        "v1/models",
-        settings.DIFFERENTIATOR_NAME
-    ]) + ":predict"
-    data = {
-        "instances" : batch.tolist()
-    }
-    response = requests.post(url, json=data)
+    batch_left = np.asarray(batch_left)
+    batch_right = np.broadcast_to(batch_right, batch_left.shape)
+    return np.concatenate([batch_left,batch_right], axis=1)
+
 
+def _to_sameness(predictions) -> list:
     # convert network raw output to bool using sameness threshold
-    return [each[0] >= settings.SAMENESS_THRESHOLD for each in response.json()['predictions']]
+    return [each[0] >= settings.SAMENESS_THRESHOLD for each in predictions]
+
+
+# async counterparts, for the views in async_views.py
+async def acall_encoder(pixels:np.ndarray) -> list:
+    return (await acall_encoder_batch(pixels))[0]
+
+
+@timing.timed("encoder")
+async def acall_encoder_batch(pixels:np.ndarray) -> list:
+    return await _apredict(settings.ENCODER_NAME, pixels)
+
+
+@timing.timed("differentiator")
+async def acall_differenciator(batch_left, batch_right) -> list:
+    predictions = await _apredict(settings.DIFFERENTIATOR_NAME, _differenciator_batch(batch_left, batch_right))
+    return _to_sameness(predictions)
+
+
+def call_tf_serving(model_name, instances:np.ndarray) -> list:
+    """calls tf serving predict API of model, returns one prediction per instance"""
+    return get_client().predict(model_name, instances)
+
+
+class JSONTransport:
+    """tensors as nested json lists, works with any tf-serving model but is large and slow to (de)serialize"""
+    content_type = "application/json"
+
+    def encode(self, instances:np.ndarray) -> bytes:
+        return json.dumps({"instances": instances.tolist()}).encode()
+
+    def decode(self, content:bytes) -> list:
+        return json.loads(content)['predictions']
+
+
+class Base64Transport(JSONTransport):
+    """
+    each instance is sent as raw little-endian bytes in tf-serving's {"b64": ...} form,
+    about a third the size of json text and close to free to encode.
+    the served model needs a string input that decodes the bytes, e.g. tf.io.decode_raw with matching dtype
+    """
+    dtype = np.dtype("<f4")
+
+    def encode(self, instances:np.ndarray) -> bytes:
+        instances = np.ascontiguousarray(instances, dtype=self.dtype)
+        return json.dumps({
+            "instances": [{"b64": base64.b64encode(each.tobytes()).decode()} for each in instances]
+        }).encode()
+
+
+class Base64PixelTransport(Base64Transport):
+    """b64 transport for uint8 pixels, a byte per channel"""
+    dtype = np.dtype("u1")
+
+
+class LoopLocal:
+    """
+    one value per running event loop, made with make() on first use there and handed to the coroutine
+    function close() when that loop shuts down.
+    closing hangs off an async generator started on the loop, loops close those in shutdown_asyncgens,
+    which asyncio.run and asgiref's async_to_sync call before the loop is closed
+    """
+
+    def __init__(self, make, close):
+        self.make = make
+        self.close = close
+        self._values = {}  # <= loop => (value, closing generator), only touched from the loop's own thread
+
+    async def get(self):
+        loop = asyncio.get_running_loop()
+        try:
+            return self._values[loop][0]
+        except KeyError:
+            value = self.make()
+            closer = self._close_on_shutdown(loop, value)
+            self._values[loop] = value, closer
+            # runs up to the yield, the loop now tracks it
+            await closer.__anext__()
+            return value
+
+    async def _close_on_shutdown(self, loop, value):
+        try:
+            yield
+        finally:
+            self._values.pop(loop, None)
+            await self.close(value)
+
+    def __len__(self):
+        return len(self._values)
+
+
+class InferenceClient:
+    """
+    keep-alive http client for the tf-serving containers
+    one pooled session is shared by all models, failed connections and 502-504 responses are retried with backoff
+    predict urls are built once per model, tensors are serialized by the model's transport (json by default)
+    """
+
+    def __init__(self, host=None, port=settings.TF_SERVER_PORT, pool_size=10, timeouts=None, retries=3, backoff=0.2,
+                 transports=None):
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.retries = retries
+        self.timeouts = timeouts or {}
+        self.transports = transports or {}
+        self._urls = {}
+        # httpx clients are tied to an event loop, one per loop, closed along with it
+        self._async_clients = LoopLocal(self._make_async_client, lambda client: client.aclose())
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["POST"]),  # <= predict calls are safe to repeat
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def url_for(self, model_name):
+        try:
+            return self._urls[model_name]
+        except KeyError:
+            # each model is served by its own container, reachable by model name unless a host is given
+            self._urls[model_name] = "http://" + "/".join([
+                f"{self.host or model_name}:{self.port}",
+                "v1/models",
+                model_name
+            ]) + ":predict"
+            return self._urls[model_name]
+
+    def predict(self, model_name, instances:np.ndarray) -> list:
+        transport = self.transports.get(model_name) or JSONTransport()
+        response = self.session.post(
+            self.url_for(model_name),
+            data=transport.encode(np.asarray(instances)),
+            headers={"Content-Type": transport.content_type},
+            timeout=self.timeouts.get(model_name),
+        )
+        response.raise_for_status()
+        return transport.decode(response.content)
+
+    async def apredict(self, model_name, instances:np.ndarray) -> list:
+        """same as predict, on httpx so the event loop isn't blocked"""
+        transport = self.transports.get(model_name) or JSONTransport()
+        client = await self._async_clients.get()
+        response = await client.post(
+            self.url_for(model_name),
+            content=transport.encode(np.asarray(instances)),
+            headers={"Content-Type": transport.content_type},
+            timeout=self.timeouts.get(model_name),
+        )
+        response.raise_for_status()
+        return transport.decode(response.content)
+
+    def _make_async_client(self):
+        # httpx only retries failed connects, not error responses
+        return httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+            transport=httpx.AsyncHTTPTransport(retries=self.retries),
+        )
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> InferenceClient:
+    """returns the process wide inference client, made from settings on first use"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = InferenceClient(
+                host=settings.TF_SERVER_HOST,
+                port=settings.TF_SERVER_PORT,
+                pool_size=settings.INFERENCE_POOL_SIZE,
+                timeouts=settings.INFERENCE_TIMEOUTS,
+                retries=settings.INFERENCE_RETRIES,
+                backoff=settings.INFERENCE_RETRY_BACKOFF,
+                transports={name: import_string(path)() for name, path in settings.INFERENCE_TRANSPORTS.items()},
+            )
+        return _client
+
+
+class RemoteBackend:
+    """
+    models served by tf-serving containers, called through the shared InferenceClient
+    concurrent calls are merged per model by a micro batcher when INFERENCE_BATCHING_ENABLED, see batching.py
+    async calls are merged by an AsyncMicroBatcher per event loop, and sent with httpx
+    """
+    load_on_start = False
+
+    def __init__(self):
+        self._batchers = {}
+        self._batchers_lock = threading.Lock()
+        self._async_batchers = LoopLocal(dict, self._close_async_batchers)
+
+    def predict(self, model_name, instances:np.ndarray) -> list:
+        if not settings.INFERENCE_BATCHING_ENABLED:
+            return call_tf_serving(model_name, instances)
+
+        with self._batchers_lock:
+            try:
+                batcher = self._batchers[model_name]
+            except KeyError:
+                batcher = self._batchers[model_name] = MicroBatcher(
+                    lambda batch: call_tf_serving(model_name, batch),
+                    max_batch_size=settings.INFERENCE_MAX_BATCH_SIZE,
+                    max_wait_ms=settings.INFERENCE_MAX_WAIT_MS,
+                )
+        return batcher.submit(instances)
+
+    async def apredict(self, model_name, instances:np.ndarray) -> list:
+        if httpx is None:
+            # requests blocks, run it off the event loop
+            return await sync_to_async(self.predict, thread_sensitive=False)(model_name, instances)
+        if not settings.INFERENCE_BATCHING_ENABLED:
+            return await get_client().apredict(model_name, instances)
+
+        batchers = await self._async_batchers.get()
+        try:
+            batcher = batchers[model_name]
+        except KeyError:
+            batcher = batchers[model_name] = AsyncMicroBatcher(
+                lambda batch: get_client().apredict(model_name, batch),
+                max_batch_size=settings.INFERENCE_MAX_BATCH_SIZE,
+                max_wait_ms=settings.INFERENCE_MAX_WAIT_MS,
+            )
+        return await batcher.submit(instances)
+
+    @staticmethod
+    async def _close_async_batchers(batchers):
+        for each in batchers.values():
+            each.close()
+
+
+class LocalBackend:
+    """
+    models exported to onnx (<model name>.onnx in INFERENCE_MODEL_DIR) and run in-process on CPU
+    sessions are loaded once per worker, calls run on a small thread pool since onnxruntime releases the GIL
+    """
+    load_on_start = True
+
+    def __init__(self, model_dir=None, model_names=None, threads=None):
+        model_dir = model_dir or settings.INFERENCE_MODEL_DIR
+        model_names = model_names or [settings.ENCODER_NAME, settings.DIFFERENTIATOR_NAME]
+        self.sessions = {name: self.load_session(os.path.join(str(model_dir), f"{name}.onnx")) for name in model_names}
+        self.pool = ThreadPoolExecutor(threads or settings.INFERENCE_LOCAL_THREADS, thread_name_prefix="local-inference")
+
+    def load_session(self, path):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImproperlyConfigured("LocalBackend needs onnxruntime installed")
+
+        options = onnxruntime.SessionOptions()
+        # parallelism comes from our pool, one thread per call keeps concurrent calls from fighting
+        options.intra_op_num_threads = 1
+        return onnxruntime.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+
+    def predict(self, model_name, instances:np.ndarray) -> list:
+        return self.pool.submit(self._run, self.sessions[model_name], instances).result()
+
+    async def apredict(self, model_name, instances:np.ndarray) -> list:
+        return await asyncio.wrap_future(self.pool.submit(self._run, self.sessions[model_name], instances))
+
+    @staticmethod
+    def _run(session, instances):
+        input_name = session.get_inputs()[0].name
+        return session.run(None, {input_name: np.asarray(instances, dtype=np.float32)})[0].tolist()
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """returns the process wide inference backend named by INFERENCE_BACKEND"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = import_string(settings.INFERENCE_BACKEND)()
+        return _backend
+
+
+def _predict(model_name, instances:np.ndarray) -> list:
+    return get_backend().predict(model_name, instances)
+
+
+async def _apredict(model_name, instances:np.ndarray) -> list:
+    return await get_backend().apredict(model_name, instances)
 
 
 def get_square_box(width, height):
@@ -76,17 +390,25 @@ def standardize_image(input_image: ImageFile, new_size=settings.IMAGE_SIZE) -> (
     returns a new ImageFile of specified size, free of metadata
     and pixels stored in np array
     """
-    # first open the image in PIL
-    old_image = Image.open(input_image)
+    with timing.stage("decode"):
+        # first open the image in PIL, nothing is decoded yet
+        old_image = Image.open(input_image)
+
+        # jpeg can be decoded at 1/2, 1/4 or 1/8 scale for free, pick the smallest that still covers new_size
+        scale = max(new_size) / min(old_image.size)
+        old_image.draft("RGB", (math.ceil(old_image.size[0] * scale), math.ceil(old_image.size[1] * scale)))
 
-    # resize to 1:1 then get pixels
-    pixels = np.array(
-        old_image.resize(new_size,box=get_square_box(*old_image.size))
-    )
+        if old_image.mode != "RGB":
+            old_image = old_image.convert("RGB")
 
-    # make a new pil image file then django file
-    new_image = Image.fromarray(pixels,mode="RGB")
+        # resize to 1:1 then get pixels, reducing_gap lets PIL shrink by whole factors before the final resample
+        new_image = old_image.resize(
+            new_size, box=get_square_box(*old_image.size), reducing_gap=settings.IMAGE_REDUCING_GAP
+        )
+        pixels = np.asarray(new_image)
+
+    # save resized image straight to a django file
     temp_file = BytesIO()
-    new_image.save(fp=temp_file,format="PNG")
+    with timing.stage("image_encode"):
+        new_image.save(fp=temp_file, format=settings.STORED_IMAGE_FORMAT, **settings.STORED_IMAGE_OPTIONS)
     return ImageFile(temp_file), pixels.reshape((-1,*new_size,3))
-
@@ -0,0 +1,155 @@
+"""
+Background ingestion of uploads, used when ASYNC_UPLOADS is set
+ImageView stores the raw upload as an UploadJob and answers 202 straight away, decoding, the encoder and
+identity matching run here, so web workers aren't held up by slow model servers.
+clients poll jobs/<pk>, or long-poll it with ?wait=<seconds>, until the job is done or failed.
+
+the queue is the UploadJob table, jobs are claimed with a conditional update so each runs once.
+each web process runs its own jobs on UPLOAD_JOB_WORKERS threads, with 0 they're left to
+manage.py process_uploads, which also picks up jobs left behind by a restart
+"""
+import threading
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .models import APIToken, UploadJob
+from . import upload_cache
+
+
+_pool = None
+_pool_lock = threading.Lock()
+# notified whenever a job in this process finishes, wakes up long-polls early
+_finished = threading.Condition()
+
+
+def get_pool():
+    """returns the process wide job pool, None when UPLOAD_JOB_WORKERS is 0"""
+    global _pool
+    if settings.UPLOAD_JOB_WORKERS == 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=settings.UPLOAD_JOB_WORKERS, thread_name_prefix="upload-job")
+        return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
+
+
+def enqueue(record, token, upload, upload_digest=""):
+    """stores upload as received and queues record for inference, returns the job"""
+    job = UploadJob(data_set_id=record.data_set_id, token=token, image=record, digest=upload_digest)
+    job.raw_file.save(str(record.id), upload, save=False)
+    job.save()
+
+    pool = get_pool()
+    if pool is not None:
+        # after commit, so the worker's connection can see the job
+        transaction.on_commit(lambda: pool.submit(_run_in_worker, job.id))
+    return job
+
+
+def claim(job_id) -> bool:
+    """marks a queued job running, False if another worker got to it first"""
+    return UploadJob.objects.filter(id=job_id, status=UploadJob.QUEUED).update(
+        status=UploadJob.RUNNING, updated=timezone.now()) == 1
+
+
+def run(job_id) -> bool:
+    """runs a queued job to done or failed, returns False if it was already taken"""
+    if not claim(job_id):
+        return False
+
+    job = UploadJob.objects.select_related("image").get(id=job_id)
+    try:
+        process(job)
+    except Exception as e:
+        # raw file is kept, the job can be queued again with requeue
+        job.status, job.error = UploadJob.FAILED, f"{type(e).__name__}: {e}"
+        job.save(update_fields=["status", "error", "updated"])
+    else:
+        job.raw_file.delete(save=False)
+        job.status, job.error = UploadJob.DONE, ""
+        job.save(update_fields=["status", "error", "raw_file", "updated"])
+
+    with _finished:
+        _finished.notify_all()
+    return True
+
+
+def process(job):
+    """the inline upload path of ImageView.post, from the stored raw file"""
+    # views import this module
+    from .views import ImageView
+
+    record = job.image
+    view = ImageView()
+    # the job's token may have been deleted since, new animals go into the job's data set
+    view.token, view.object = APIToken(write_set_id=job.data_set_id), record
+
+    # inference was charged when the job was queued, call past check_token
+    with job.raw_file.open("rb") as raw_file:
+        cleaned_image, embedding_vector = ImageView.process_image.__wrapped__(view, raw_file)
+    record.image_file.save(str(record.id), cleaned_image, save=False)
+    try:
+        record.vector = embedding_vector
+
+        # if an identity isn't provided, make new or find matching one
+        if record.identity_id is None:
+            record.identity = ImageView.get_identity.__wrapped__(view, embedding_vector)
+        view.save_object()
+    except Exception:
+        # the record doesn't point at the stored file yet, a retry stores it again
+        record.image_file.delete(save=False)
+        raise
+
+    if job.digest:
+        upload_cache.store(record.data_set_id, job.digest, record)
+
+
+def _run_in_worker(job_id):
+    try:
+        run(job_id)
+    finally:
+        # pool threads are long lived, don't let their connections go stale
+        close_old_connections()
+
+
+def run_pending(limit=None) -> int:
+    """runs queued jobs on this thread, oldest first, returns how many were run"""
+    pending = UploadJob.objects.filter(status=UploadJob.QUEUED).order_by("created").values_list("id", flat=True)
+    done = 0
+    for job_id in pending[:limit] if limit else pending:
+        done += run(job_id)
+    return done
+
+
+def requeue(older_than=None, failed=False) -> int:
+    """
+    queues jobs again, running ones not updated for older_than seconds (their worker is presumably gone)
+    and failed ones if failed is set. returns how many were queued
+    """
+    requeued = 0
+    if older_than is not None:
+        stale = timezone.now() - timedelta(seconds=older_than)
+        requeued += UploadJob.objects.filter(status=UploadJob.RUNNING, updated__lt=stale).update(
+            status=UploadJob.QUEUED, updated=timezone.now())
+    if failed:
+        requeued += UploadJob.objects.filter(status=UploadJob.FAILED, raw_file__isnull=False).exclude(raw_file="").update(
+            status=UploadJob.QUEUED, error="", updated=timezone.now())
+    return requeued
+
+
+def wait(timeout):
+    """blocks until a job in this process finishes, or timeout seconds"""
+    with _finished:
+        _finished.wait(timeout)
@@ -0,0 +1,89 @@
+import shutil
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from ...models import DataSet, AnimalRecord, ImageRecord, APIToken, pack_vector
+from ...views import ImageView
+from ... import embedding_store, pg_cube, prototypes, vector_index
+
+
+class Command(BaseCommand):
+    help = (
+        "time identity lookup (index query, db confirmation and ranking, differentiator excluded) "
+        "over synthetic data sets of growing size. everything is written in a transaction that is rolled back"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", nargs="+", type=int, default=[10000, 100000, 1000000])
+        parser.add_argument("--images-per-animal", type=int, default=5)
+        parser.add_argument("--queries", type=int, default=200)
+        parser.add_argument("--batch-size", type=int, default=5000, help="rows per insert")
+
+    def handle(self, *args, **options):
+        backend = "cube GiST index" if pg_cube.enabled() else settings.VECTOR_INDEX_BACKEND
+        self.stdout.write(f"{connection.vendor} database, {backend}")
+        for size in options["sizes"]:
+            with transaction.atomic():
+                try:
+                    self.run(size, options)
+                finally:
+                    transaction.set_rollback(True)
+
+    def run(self, size, options):
+        rng = np.random.default_rng(size)
+        d_set = DataSet.objects.create(name="bench_identity")
+
+        # animals spread over the space, their images close around them
+        animal_count = max(size // options["images_per_animal"], 1)
+        centers = rng.uniform(-100, 100, (animal_count, settings.EMBEDDING_DIM)).astype(np.float32)
+        animals = [AnimalRecord(data_set=d_set) for i in range(animal_count)]
+
+        start = time.perf_counter()
+        AnimalRecord.objects.bulk_create(animals, batch_size=options["batch_size"])
+        for offset in range(0, size, options["batch_size"]):
+            count = min(options["batch_size"], size - offset)
+            owners = rng.integers(0, animal_count, count)
+            vectors = centers[owners] + rng.normal(scale=1., size=(count, settings.EMBEDDING_DIM))
+            ImageRecord.objects.bulk_create([
+                ImageRecord(data_set=d_set, identity=animals[owner], embedding=pack_vector(vector))
+                for owner, vector in zip(owners, vectors)
+            ], batch_size=options["batch_size"])
+        self.stdout.write(f"{size} images: inserted in {time.perf_counter() - start:.1f} s")
+
+        try:
+            view = ImageView()
+            view.token, view.object = APIToken(write_set=d_set), ImageRecord(data_set=d_set)
+
+            if not pg_cube.enabled():
+                start = time.perf_counter()
+                vector_index.get_index(d_set.id)
+                self.stdout.write(f"{size} images: index loaded in {time.perf_counter() - start:.2f} s")
+
+            queries = centers[rng.integers(0, animal_count, options["queries"])]
+            queries = queries + rng.normal(scale=1., size=queries.shape)
+            timings = []
+            for vector in queries.astype(np.float32):
+                start = time.perf_counter()
+                view.get_candidates(vector)
+                timings.append(time.perf_counter() - start)
+            timings = np.array(timings) * 1000
+            self.stdout.write(
+                f"{size} images: lookup p50 {np.percentile(timings, 50):.2f} ms, "
+                f"p95 {np.percentile(timings, 95):.2f} ms, max {timings.max():.2f} ms"
+            )
+
+            # a page of sets/<pk>/images, deep into the set
+            after = ImageRecord.objects.filter(data_set=d_set).order_by("id").values_list("id", flat=True)[size // 2]
+            start = time.perf_counter()
+            list(ImageRecord.objects.filter(data_set=d_set, id__gt=after).order_by("id").values_list("id", flat=True)[:settings.RELATED_PAGE_SIZE])
+            self.stdout.write(f"{size} images: related page in {(time.perf_counter() - start) * 1000:.2f} ms")
+        finally:
+            # rows are rolled back, derived state has to go too
+            shutil.rmtree(embedding_store.EmbeddingStore(str(d_set.id)).path, ignore_errors=True)
+            embedding_store.reset()
+            vector_index.reset()
+            prototypes.reset()
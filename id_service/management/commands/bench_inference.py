@@ -0,0 +1,50 @@
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+
+
+class Command(BaseCommand):
+    help = "time encoder and differentiator calls on each inference backend"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--backends", nargs="+",
+            default=["id_service.inference.RemoteBackend", "id_service.inference.LocalBackend"],
+        )
+        parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 8, 32])
+        parser.add_argument("--iterations", type=int, default=20)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(0)
+
+        for path in options["backends"]:
+            try:
+                backend = import_string(path)()
+            except Exception as e:
+                self.stderr.write(f"{path}: can't load, {e}")
+                continue
+
+            for batch_size in options["batch_sizes"]:
+                cases = [
+                    (settings.ENCODER_NAME, rng.integers(0, 255, (batch_size, *settings.IMAGE_SIZE, 3), dtype=np.uint8)),
+                    (settings.DIFFERENTIATOR_NAME, rng.normal(size=(batch_size, 2 * settings.EMBEDDING_DIM))),
+                ]
+                for model_name, instances in cases:
+                    try:
+                        # warm up connections / sessions first
+                        backend.predict(model_name, instances)
+                        start = time.perf_counter()
+                        for i in range(options["iterations"]):
+                            backend.predict(model_name, instances)
+                        elapsed = (time.perf_counter() - start) / options["iterations"]
+                    except Exception as e:
+                        self.stderr.write(f"{path} {model_name} batch {batch_size}: failed, {e}")
+                        continue
+
+                    self.stdout.write(
+                        f"{path} {model_name} batch {batch_size}: "
+                        f"{elapsed * 1000:.2f} ms/call, {batch_size / elapsed:.1f} instances/s"
+                    )
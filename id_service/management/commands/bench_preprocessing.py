@@ -0,0 +1,56 @@
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+from django.conf import settings
+from django.core.files.images import ImageFile
+from django.core.management.base import BaseCommand
+
+from ...inference import standardize_image, get_square_box
+
+
+def legacy_standardize_image(input_image, new_size=settings.IMAGE_SIZE):
+    """standardize_image as it was before draft decoding, kept here as the baseline"""
+    old_image = Image.open(input_image)
+    pixels = np.array(
+        old_image.resize(new_size,box=get_square_box(*old_image.size))
+    )
+    new_image = Image.fromarray(pixels,mode="RGB")
+    temp_file = BytesIO()
+    new_image.save(fp=temp_file,format="PNG")
+    return ImageFile(temp_file), pixels.reshape((-1,*new_size,3))
+
+
+class Command(BaseCommand):
+    help = "time standardize_image against the previous implementation on synthetic photos"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", nargs="+", default=["4032x3024", "1920x1080", "640x480"])
+        parser.add_argument("--formats", nargs="+", default=["JPEG", "PNG"])
+        parser.add_argument("--iterations", type=int, default=10)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(0)
+
+        for size in options["sizes"]:
+            width, height = (int(each) for each in size.split("x"))
+            # smooth gradient plus noise, compresses roughly like a photo
+            gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+            noise = rng.normal(scale=20., size=(height, width, 3))
+            source = Image.fromarray(np.clip(gradient + noise, 0, 255).astype(np.uint8), mode="RGB")
+
+            for image_format in options["formats"]:
+                encoded = BytesIO()
+                source.save(encoded, format=image_format)
+                data = encoded.getvalue()
+
+                for name, function in [("legacy", legacy_standardize_image), ("current", standardize_image)]:
+                    start = time.perf_counter()
+                    for i in range(options["iterations"]):
+                        new_file, pixels = function(BytesIO(data))
+                    elapsed = (time.perf_counter() - start) / options["iterations"]
+                    self.stdout.write(
+                        f"{size} {image_format} {name}: {elapsed * 1000:.1f} ms/image, "
+                        f"stored {len(new_file.file.getvalue()) // 1024} KB"
+                    )
@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ... import jobs
+
+
+class Command(BaseCommand):
+    help = (
+        "run uploads queued with ASYNC_UPLOADS, for when web processes have UPLOAD_JOB_WORKERS = 0 "
+        "or to pick up jobs left behind by a restart. several can run side by side"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="run what's queued and exit")
+        parser.add_argument("--interval", type=float, default=1., help="seconds between polls of an empty queue")
+        parser.add_argument(
+            "--requeue-after", type=float, default=None,
+            help="queue running jobs again when they haven't been updated for this many seconds",
+        )
+        parser.add_argument("--retry-failed", action="store_true", help="queue failed jobs again first")
+
+    def handle(self, *args, **options):
+        if options["retry_failed"]:
+            self.stdout.write(f"requeued {jobs.requeue(failed=True)} failed jobs")
+
+        while True:
+            if options["requeue_after"] is not None:
+                requeued = jobs.requeue(older_than=options["requeue_after"])
+                if requeued:
+                    self.stdout.write(f"requeued {requeued} stale jobs")
+
+            done = jobs.run_pending()
+            if done:
+                self.stdout.write(f"ran {done} jobs")
+            if options["once"]:
+                break
+            if not done:
+                time.sleep(options["interval"])
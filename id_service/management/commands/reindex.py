@@ -0,0 +1,93 @@
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from ...models import DataSet
+from ...preprocessing import _init_worker
+from ... import reindex
+
+
+class Command(BaseCommand):
+    help = (
+        "re-encode stored images with the current encoder, and optionally re-run identity clustering. "
+        "progress is checkpointed, run again with the same arguments to resume"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--data-set", nargs="+", dest="data_sets",
+            help="data set ids to reindex, 'public' for images without one, default is everything",
+        )
+        parser.add_argument("--workers", type=int, default=1, help="processes to encode / identify with")
+        parser.add_argument("--chunk-size", type=int, default=settings.REINDEX_CHUNK_SIZE)
+        parser.add_argument("--checkpoint-dir", default=str(settings.REINDEX_CHECKPOINT_DIR))
+        parser.add_argument("--restart", action="store_true", help="throw away checkpoints and start over")
+        parser.add_argument("--skip-encode", action="store_true", help="keep stored vectors")
+        parser.add_argument(
+            "--reidentify", action="store_true",
+            help="reassign identities from the new vectors, animals left without images are deleted",
+        )
+
+    def handle(self, *args, **options):
+        checkpoint_dir = options["checkpoint_dir"]
+        if options["restart"]:
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+        if options["data_sets"]:
+            data_set_ids = [None if each == "public" else each for each in options["data_sets"]]
+        else:
+            data_set_ids = [None] + list(DataSet.objects.values_list("id", flat=True))
+
+        # shards are fixed when a job starts, so a resumed job lines up with its checkpoints
+        job = reindex.Checkpoint(os.path.join(checkpoint_dir, "job.json"))
+        state = job.load()
+        if not state:
+            shards = reindex.shard_bounds(reindex.images_in(data_set_ids), max(options["workers"], 1))
+            state = {"data_sets": data_set_ids, "shards": shards}
+            job.save(state)
+        elif sorted(map(str, state["data_sets"])) != sorted(map(str, data_set_ids)):
+            raise CommandError(f"{checkpoint_dir} holds a job for other data sets, use --restart to replace it")
+
+        if not options["skip_encode"]:
+            tasks = [
+                (reindex.run_encode_shard, data_set_ids, start, stop, os.path.join(checkpoint_dir, f"encode-{i}.json"), options["chunk_size"])
+                for i, (start, stop) in enumerate(state["shards"])
+            ]
+            for result in self.run_tasks(tasks, options["workers"]):
+                self.stdout.write(f"encoded {result['encoded']} images, skipped {result['skipped']} unreadable")
+            reindex.refresh_stores(data_set_ids)
+
+        if options["reidentify"]:
+            tasks = [
+                (reindex.run_reidentify, data_set_id, os.path.join(checkpoint_dir, f"identify-{data_set_id or 'public'}.json"), options["chunk_size"])
+                for data_set_id in data_set_ids
+            ]
+            for result in self.run_tasks(tasks, options["workers"]):
+                self.stdout.write(f"identified {result['identified']} images")
+
+        # centroids follow both new vectors and new identities
+        reindex.refresh_prototypes(data_set_ids)
+
+        # vector indexes load rebuilt stores again on their next lookup, centroid indexes only load once
+        if settings.IDENTITY_MATCHING == "prototype":
+            self.stdout.write(self.style.SUCCESS("done, restart app servers so their centroid indexes are reloaded"))
+        else:
+            self.stdout.write(self.style.SUCCESS("done"))
+
+    def run_tasks(self, tasks, workers):
+        """yields results of (function, *args) tasks, in worker processes when there's more than one worker"""
+        if workers <= 1:
+            for function, *args in tasks:
+                yield function(*args)
+            return
+
+        # forked workers mustn't share our db connections
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+            futures = [pool.submit(function, *args) for function, *args in tasks]
+            for each in as_completed(futures):
+                yield each.result()
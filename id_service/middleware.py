@@ -0,0 +1,85 @@
+import asyncio
+import math
+
+from django.conf import settings
+from django.http import JsonResponse
+
+from .rate_limit import RateLimited
+from . import timing
+
+try:
+    from asgiref.sync import markcoroutinefunction
+except ImportError:
+    # asgiref < 3.6, mark it the way django's MiddlewareMixin does
+    def markcoroutinefunction(func):
+        func._is_coroutine = asyncio.coroutines._is_coroutine
+        return func
+
+
+class TimingMiddleware:
+    """times each request, stages timed along the way go out in a Server-Timing header, see timing.py"""
+    # the recorder is a context variable, so it follows the request across awaits
+    sync_capable = async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not settings.TIMING_ENABLED:
+            return self.get_response(request)
+
+        recorder, token = timing.start_request()
+        try:
+            with timing.stage("total"):
+                response = self.get_response(request)
+        finally:
+            timing.end_request(token)
+        response["Server-Timing"] = recorder.header()
+        return response
+
+    async def __acall__(self, request):
+        if not settings.TIMING_ENABLED:
+            return await self.get_response(request)
+
+        recorder, token = timing.start_request()
+        try:
+            with timing.stage("total"):
+                response = await self.get_response(request)
+        finally:
+            timing.end_request(token)
+        response["Server-Timing"] = recorder.header()
+        return response
+
+
+class RateLimitMiddleware:
+    """turns RateLimited raised in views into a 429 with Retry-After"""
+    # sync only middleware would put the whole chain, async views included, on one thread under ASGI
+    sync_capable = async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        return await self.get_response(request)
+
+    def process_exception(self, request, exception):
+        if not isinstance(exception, RateLimited):
+            return None
+
+        retry_after = max(math.ceil(exception.retry_after), 1)
+        response = JsonResponse({"detail": "rate limited", "retry_after": retry_after}, status=429)
+        response["Retry-After"] = str(retry_after)
+        return response
@@ -0,0 +1,62 @@
+from django.db import migrations, models
+
+import numpy as np
+
+
+def pack_vectors(apps, schema_editor):
+    ImageRecord = apps.get_model("id_service", "ImageRecord")
+    batch = []
+    for record in ImageRecord.objects.filter(v0__isnull=False).iterator(chunk_size=2000):
+        record.embedding = np.array([record.v0, record.v1, record.v2, record.v3], dtype="<f4").tobytes()
+        batch.append(record)
+        if len(batch) == 2000:
+            ImageRecord.objects.bulk_update(batch, ["embedding"])
+            batch = []
+    ImageRecord.objects.bulk_update(batch, ["embedding"])
+
+
+def unpack_vectors(apps, schema_editor):
+    ImageRecord = apps.get_model("id_service", "ImageRecord")
+    batch = []
+    for record in ImageRecord.objects.filter(embedding__isnull=False).iterator(chunk_size=2000):
+        vector = np.frombuffer(record.embedding, dtype="<f4")
+        if len(vector) != 4:
+            raise ValueError("only 4 dimensional embeddings fit in v0..v3")
+        record.v0, record.v1, record.v2, record.v3 = vector.tolist()
+        batch.append(record)
+        if len(batch) == 2000:
+            ImageRecord.objects.bulk_update(batch, ["v0", "v1", "v2", "v3"])
+            batch = []
+    ImageRecord.objects.bulk_update(batch, ["v0", "v1", "v2", "v3"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('id_service', '0003_auto_20201209_0112'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imagerecord',
+            name='embedding',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.RunPython(pack_vectors, unpack_vectors),
+        migrations.RemoveField(
+            model_name='imagerecord',
+            name='v0',
+        ),
+        migrations.RemoveField(
+            model_name='imagerecord',
+            name='v1',
+        ),
+        migrations.RemoveField(
+            model_name='imagerecord',
+            name='v2',
+        ),
+        migrations.RemoveField(
+            model_name='imagerecord',
+            name='v3',
+        ),
+    ]
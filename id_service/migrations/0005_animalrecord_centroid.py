@@ -0,0 +1,44 @@
+from django.db import migrations, models
+
+import numpy as np
+
+
+def compute_centroids(apps, schema_editor):
+    AnimalRecord = apps.get_model("id_service", "AnimalRecord")
+    ImageRecord = apps.get_model("id_service", "ImageRecord")
+    batch = []
+    for animal in AnimalRecord.objects.iterator(chunk_size=2000):
+        vectors = [
+            np.frombuffer(each, dtype="<f4")
+            for each in ImageRecord.objects.filter(identity_id=animal.id, embedding__isnull=False).values_list("embedding", flat=True)
+        ]
+        if len(vectors) == 0:
+            continue
+        animal.centroid = np.mean(vectors, axis=0).astype("<f4").tobytes()
+        animal.image_count = len(vectors)
+        batch.append(animal)
+        if len(batch) == 2000:
+            AnimalRecord.objects.bulk_update(batch, ["centroid", "image_count"])
+            batch = []
+    AnimalRecord.objects.bulk_update(batch, ["centroid", "image_count"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('id_service', '0004_imagerecord_embedding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='animalrecord',
+            name='centroid',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='animalrecord',
+            name='image_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(compute_centroids, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('id_service', '0006_uploadjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdentityLock',
+            fields=[
+                ('key', models.CharField(max_length=36, primary_key=True, serialize=False)),
+                ('taken', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='animalrecord',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True, db_index=True, null=True),
+        ),
+    ]
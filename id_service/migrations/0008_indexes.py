@@ -0,0 +1,32 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('id_service', '0007_identity_lock'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='uploadjob',
+            name='status',
+            field=models.CharField(choices=[('queued', 'queued'), ('running', 'running'), ('done', 'done'), ('failed', 'failed')], default='queued', max_length=8),
+        ),
+        migrations.AddIndex(
+            model_name='animalrecord',
+            index=models.Index(fields=['data_set', 'id'], name='animal_set_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='imagerecord',
+            index=models.Index(fields=['data_set', 'id'], name='image_set_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='imagerecord',
+            index=models.Index(fields=['identity', 'id'], name='image_identity_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='uploadjob',
+            index=models.Index(fields=['status', 'created'], name='upload_job_queue_idx'),
+        ),
+    ]
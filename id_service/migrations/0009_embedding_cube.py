@@ -0,0 +1,68 @@
+from django.db import migrations
+
+
+# float32s in ImageRecord.embedding are little endian, postgres has no cast from bytes to float, so bits are decoded by hand
+# immutable, so it can be indexed. infinities and nan don't come out of the encoder and aren't handled
+CREATE_FUNCTION = """
+CREATE OR REPLACE FUNCTION id_service_embedding_cube(embedding bytea) RETURNS cube
+LANGUAGE plpgsql IMMUTABLE STRICT PARALLEL SAFE AS $$
+DECLARE
+    coords float8[] := '{}';
+    bits bigint;
+    exponent int;
+    mantissa bigint;
+    value float8;
+BEGIN
+    FOR i IN 0 .. length(embedding) / 4 - 1 LOOP
+        bits := get_byte(embedding, 4 * i)::bigint
+            | (get_byte(embedding, 4 * i + 1)::bigint << 8)
+            | (get_byte(embedding, 4 * i + 2)::bigint << 16)
+            | (get_byte(embedding, 4 * i + 3)::bigint << 24);
+        exponent := ((bits >> 23) & 255)::int;
+        mantissa := bits & 8388607;
+        IF exponent = 0 THEN
+            -- zero and subnormals
+            value := mantissa * power(2::float8, -149);
+        ELSE
+            value := (8388608 + mantissa) * power(2::float8, exponent - 150);
+        END IF;
+        IF (bits >> 31) = 1 THEN
+            value := -value;
+        END IF;
+        coords := coords || value;
+    END LOOP;
+    RETURN cube(coords);
+END
+$$
+"""
+
+
+def create_cube_index(apps, schema_editor):
+    # other databases use the in-process indexes, see pg_cube.py
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    # cube is a trusted extension from postgres 13, older servers need a superuser to run this
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS cube")
+    schema_editor.execute(CREATE_FUNCTION)
+    schema_editor.execute(
+        "CREATE INDEX image_embedding_cube_idx ON id_service_imagerecord USING gist (id_service_embedding_cube(embedding))"
+    )
+
+
+def drop_cube_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    # extension is left in place, other apps may use it
+    schema_editor.execute("DROP INDEX IF EXISTS image_embedding_cube_idx")
+    schema_editor.execute("DROP FUNCTION IF EXISTS id_service_embedding_cube(bytea)")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('id_service', '0008_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_cube_index, drop_cube_index),
+    ]
@@ -0,0 +1,59 @@
+from django.db import migrations
+
+
+# 0009's function, but NULL for embeddings over the 100 dimensions cube holds. the GiST index computes it on
+# every insert, so otherwise no image with a larger EMBEDDING_DIM could be saved on postgres
+CREATE_FUNCTION = """
+CREATE OR REPLACE FUNCTION id_service_embedding_cube(embedding bytea) RETURNS cube
+LANGUAGE plpgsql IMMUTABLE STRICT PARALLEL SAFE AS $$
+DECLARE
+    coords float8[] := '{}';
+    bits bigint;
+    exponent int;
+    mantissa bigint;
+    value float8;
+BEGIN
+    IF length(embedding) / 4 > 100 THEN
+        -- over what cube holds, such rows aren't in the index, see pg_cube.py
+        RETURN NULL;
+    END IF;
+    FOR i IN 0 .. length(embedding) / 4 - 1 LOOP
+        bits := get_byte(embedding, 4 * i)::bigint
+            | (get_byte(embedding, 4 * i + 1)::bigint << 8)
+            | (get_byte(embedding, 4 * i + 2)::bigint << 16)
+            | (get_byte(embedding, 4 * i + 3)::bigint << 24);
+        exponent := ((bits >> 23) & 255)::int;
+        mantissa := bits & 8388607;
+        IF exponent = 0 THEN
+            -- zero and subnormals
+            value := mantissa * power(2::float8, -149);
+        ELSE
+            value := (8388608 + mantissa) * power(2::float8, exponent - 150);
+        END IF;
+        IF (bits >> 31) = 1 THEN
+            value := -value;
+        END IF;
+        coords := coords || value;
+    END LOOP;
+    RETURN cube(coords);
+END
+$$
+"""
+
+
+def replace_function(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute(CREATE_FUNCTION)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('id_service', '0009_embedding_cube'),
+    ]
+
+    operations = [
+        # 0009's version can't be put back while larger embeddings are stored
+        migrations.RunPython(replace_function, migrations.RunPython.noop),
+    ]
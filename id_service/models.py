@@ -1,8 +1,11 @@
 from django.db import models
+from django.db.models import Case, When
 from django.conf import settings
 
 from datetime import datetime, timedelta
 from uuid import uuid4
+
+import numpy as np
 # Create your models here.
 
 # the fields are minimal on record related models, we only track id
@@ -12,6 +15,26 @@ from uuid import uuid4
 # many APIToken to one User, related_name = token
 
 
+VECTOR_DTYPE = np.dtype("<f4")
+
+
+def pack_vector(vector):
+    """vector as the bytes stored in ImageRecord.embedding"""
+    if vector is None:
+        return None
+    packed = np.asarray(vector, dtype=VECTOR_DTYPE)
+    if packed.shape != (settings.EMBEDDING_DIM,):
+        raise ValueError(f"expected a vector of {settings.EMBEDDING_DIM}, got shape {packed.shape}")
+    return packed.tobytes()
+
+
+def unpack_vector(packed):
+    """ImageRecord.embedding as np array, no copy is made"""
+    if packed is None:
+        return None
+    return np.frombuffer(packed, dtype=VECTOR_DTYPE)
+
+
 class DataSet(models.Model):
     id = models.CharField(primary_key=True,max_length=36,null=False,default=uuid4)
     name = models.CharField(max_length=64,blank=True)
@@ -29,6 +52,22 @@ class AnimalRecord(models.Model):
     id = models.CharField(primary_key=True,max_length=36,null=False,default=uuid4)
     data_set = models.ForeignKey(DataSet,null=True,blank=True,on_delete=models.CASCADE,related_name="animals")
 
+    # mean of this animal's image vectors, kept up to date as images are assigned, see prototypes.py
+    centroid = models.BinaryField(null=True)
+    image_count = models.IntegerField(default=0)  # <= images with a vector in centroid
+
+    created = models.DateTimeField(auto_now_add=True,null=True,db_index=True)  # <= null for animals made before it was tracked
+
+    class Meta:
+        indexes = [
+            # sets/<pk>/animals pages, by id within a data set
+            models.Index(fields=["data_set", "id"], name="animal_set_id_idx"),
+        ]
+
+    @property
+    def centroid_vector(self):
+        return unpack_vector(self.centroid)
+
 
 class ImageRecord(models.Model):
     id = models.CharField(primary_key=True,max_length=36,null=False,default=uuid4)
@@ -37,35 +76,60 @@ class ImageRecord(models.Model):
     # data related
     image_file = models.ImageField(upload_to="images", null=True, blank=True)  # <= TODO : upgrade to cloud storage backends when appropriate
 
-    # vectorized image field
-    # TODO : integrate postgres cube extension later
-    v0 = models.FloatField(null=True)
-    v1 = models.FloatField(null=True)
-    v2 = models.FloatField(null=True)
-    v3 = models.FloatField(null=True)
+    # vectorized image field, EMBEDDING_DIM float32s packed into one blob, see pack_vector
+    embedding = models.BinaryField(null=True)
 
     identity = models.ForeignKey(AnimalRecord,null=True,blank=True,on_delete=models.CASCADE,related_name="images")
 
+    # (identity_id, embedding) as last loaded / saved, so centroids can be moved on reassignment
+    # None when either was deferred on load, then they're read back before save / delete, see prototypes.load_assigned
+    _assigned = (None, None)
+
+    class Meta:
+        indexes = [
+            # related list pages, export and reindex all walk a data set or an animal's images by id
+            models.Index(fields=["data_set", "id"], name="image_set_id_idx"),
+            models.Index(fields=["identity", "id"], name="image_identity_id_idx"),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(ImageRecord, cls).from_db(db, field_names, values)
+        if {"identity_id", "embedding"} & instance.get_deferred_fields():
+            instance._assigned = None
+        else:
+            instance._assigned = (instance.identity_id, instance.embedding)
+        return instance
+
     @property
     def vector(self):
-        return self.v0, self.v1, self.v2, self.v3
+        """read only np array straight over the stored bytes, None if not encoded yet"""
+        return unpack_vector(self.embedding)
 
     @vector.setter
-    def vector(self,vector_as_tuple):
+    def vector(self,vector):
         """NOTE: this setter does not call model.save()"""
-        vector_as_tuple = [round(each,8)for each in vector_as_tuple]
-        self.v0, self.v1, self.v2, self.v3 = vector_as_tuple
+        self.embedding = pack_vector(vector)
 
     @classmethod
-    def vector_queryset(cls,vector,half_range=settings.SPACIAL_QUERY_DIST):
-        """get a queryset filtered by proximity of model.vector to vector"""
-        q0, q1, q2, q3 = vector
-        return cls.objects.filter(
-            v0__range=(q0 - half_range, q0 + half_range),
-            v1__range=(q1 - half_range, q1 + half_range),
-            v2__range=(q2 - half_range, q2 + half_range),
-            v3__range=(q3 - half_range, q3 + half_range),
-        )
+    def vector_queryset(cls,vector,half_range=settings.SPACIAL_QUERY_DIST,data_set_id=None,k=None):
+        """
+        get a queryset filtered by proximity of model.vector to vector, within a box of half_range
+        with k, only the k closest are kept, closest first
+        """
+        from . import pg_cube
+        if pg_cube.enabled():
+            # KNN on the GiST index, in the database
+            return pg_cube.within(cls.objects.filter(data_set_id=data_set_id), vector, half_range, k)
+
+        # the packed column can't be range filtered in sql, go through the in-process index
+        from .vector_index import get_index
+        ids = get_index(data_set_id).query(vector, half_range, k)
+        queryset = cls.objects.filter(id__in=ids)
+        if k:
+            # keep the index's order
+            queryset = queryset.order_by(Case(*[When(id=each, then=i) for i, each in enumerate(ids)], default=len(ids)))
+        return queryset
 
 
 class APIToken(models.Model):
@@ -88,18 +152,44 @@ class APIToken(models.Model):
     actions = models.IntegerField(default=0)
     expensive_actions = models.IntegerField(default=0)
 
-    def is_valid(self, expensive=False):
-        # resolve which field to check
-        to_check = (self.expensive_actions, settings.MAX_EXPENSIVE_ACTIONS_PER_SEC) if expensive else (self.actions, settings.MAX_ACTIONS_PER_SEC)
-
+    def is_valid(self):
+        # rate limits are checked separately, see rate_limit.py
         if self.first_use is None:
             return True
         elif self.first_use + timedelta(days=settings.TOKEN_VALID_DAYS) < datetime.now():
             # expired after too many days
             return False
+        return True
 
-        # users are allowed certain actions per second since the first use
-        if to_check[0] < int((datetime.now() - self.first_use).total_seconds() * to_check[1]):
-            return True
-        else:
-            return False
+
+class UploadJob(models.Model):
+    """an upload waiting for, or done with, background inference, see jobs.py"""
+    QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+    STATUS_CHOICES = [(each, each) for each in (QUEUED, RUNNING, DONE, FAILED)]
+
+    id = models.CharField(primary_key=True,max_length=36,null=False,default=uuid4)
+    # same data set as image, so jobs are readable by the same tokens
+    data_set = models.ForeignKey(DataSet,null=True,blank=True,on_delete=models.CASCADE,related_name="+")
+    token = models.ForeignKey(APIToken,null=True,on_delete=models.SET_NULL,related_name="+")
+    image = models.ForeignKey(ImageRecord,on_delete=models.CASCADE,related_name="+")
+
+    raw_file = models.FileField(upload_to="uploads", null=True, blank=True)  # <= upload as received, removed once done
+    digest = models.CharField(max_length=40,blank=True)  # <= content hash for upload_cache
+
+    status = models.CharField(max_length=8,choices=STATUS_CHOICES,default=QUEUED)
+    error = models.TextField(blank=True)
+
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # run_pending takes queued jobs oldest first
+            models.Index(fields=["status", "created"], name="upload_job_queue_idx"),
+        ]
+
+
+class IdentityLock(models.Model):
+    """one row per data set, held while a new animal is made in it, see identity_lock.py"""
+    key = models.CharField(primary_key=True,max_length=36)  # <= data set id, "public" for images without one
+    taken = models.DateTimeField(null=True)
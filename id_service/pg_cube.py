@@ -0,0 +1,58 @@
+"""
+Proximity queries inside postgres, with the cube extension
+migration 0009 adds id_service_embedding_cube(bytea), which unpacks ImageRecord.embedding into a cube,
+and a GiST index over it. queries filter on a box around the query vector and order by distance to it,
+both answered from the index (KNN), so no process has to keep an index of its own and every worker sees
+every committed image straight away.
+
+used when VECTOR_CUBE_ENABLED and the database is postgres, the in-process indexes in vector_index.py stay
+as the fallback for everything else. cube is limited to 100 dimensions in a stock build, with a larger
+EMBEDDING_DIM the fallback is used too, and check_dimensions warns about it
+"""
+from django.conf import settings
+from django.core import checks
+from django.db import connection
+from django.db.models import FloatField
+from django.db.models.expressions import RawSQL
+
+
+UNPACK_FUNCTION = "id_service_embedding_cube"
+MAX_DIM = 100  # <= CUBE_MAX_DIM of a stock cube build
+
+
+def enabled():
+    return settings.VECTOR_CUBE_ENABLED and connection.vendor == "postgresql" and settings.EMBEDDING_DIM <= MAX_DIM
+
+
+@checks.register(checks.Tags.database)
+def check_dimensions(app_configs, **kwargs):
+    if settings.VECTOR_CUBE_ENABLED and connection.vendor == "postgresql" and settings.EMBEDDING_DIM > MAX_DIM:
+        return [checks.Warning(
+            f"EMBEDDING_DIM {settings.EMBEDDING_DIM} is over the {MAX_DIM} dimensions cube supports, "
+            "proximity queries use the in-process indexes instead",
+            hint="set VECTOR_CUBE_ENABLED = False",
+            id="id_service.W001",
+        )]
+    return []
+
+
+def _column(model):
+    return f'{UNPACK_FUNCTION}("{model._meta.db_table}"."embedding")'
+
+
+def within(queryset, vector, half_range, k=None):
+    """
+    rows of queryset with embedding within a box of half_range around vector, closest first
+    distance is chebyshev like vector_index, so the box and the ordering agree. with k, only the first k
+    """
+    column = _column(queryset.model)
+    point = [float(each) for each in vector]
+    # extra, so the containment stays a bare operator the GiST index can answer
+    queryset = queryset.extra(
+        where=[f"{column} <@ cube_enlarge(cube(%s::float8[]), %s, %s)"],
+        params=[point, float(half_range), len(point)],
+    )
+    queryset = queryset.annotate(
+        distance=RawSQL(f"{column} <=> cube(%s::float8[])", (point,), output_field=FloatField())
+    ).order_by("distance")
+    return queryset[:k] if k else queryset
@@ -0,0 +1,124 @@
+"""
+Process pool for image preprocessing
+decode / resize / encode in standardize_image holds the GIL for much of its work,
+with PREPROCESSING_WORKERS > 0 it runs in worker processes instead so other requests in this process keep going.
+workers are started by a forkserver (PREPROCESSING_START_METHOD), forking this process directly would copy
+locks held by its other threads (micro batcher, job pool, db connections) and can deadlock the child.
+pixels come back through shared memory rather than being pickled, the stored image file comes back as bytes
+"""
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import numpy as np
+from django.conf import settings
+from django.core.files.images import ImageFile
+
+from .inference import standardize_image
+from . import timing
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    # python < 3.8, pixels get pickled instead
+    shared_memory = resource_tracker = None
+
+
+def _init_worker():
+    # forkserver and spawned workers start fresh, django has to be set up before settings can be read
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        django.setup()
+
+
+def _standardize_in_worker(data: bytes):
+    """runs in worker process, returns stored image bytes and a handle to the pixels"""
+    new_file, pixels = standardize_image(BytesIO(data))
+    stored = new_file.file.getvalue()
+
+    if shared_memory is None:
+        return stored, pixels
+
+    block = shared_memory.SharedMemory(create=True, size=pixels.nbytes)
+    np.ndarray(pixels.shape, dtype=pixels.dtype, buffer=block.buf)[:] = pixels
+    handle = (block.name, pixels.shape, pixels.dtype.str)
+    # parent unlinks once it has read the pixels
+    block.close()
+    return stored, handle
+
+
+def _read_pixels(handle):
+    if isinstance(handle, np.ndarray):
+        return handle
+
+    name, shape, dtype = handle
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        return np.ndarray(shape, dtype=dtype, buffer=block.buf).copy()
+    finally:
+        block.close()
+        block.unlink()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """returns the process wide preprocessing pool, None when PREPROCESSING_WORKERS is 0"""
+    global _pool
+    if settings.PREPROCESSING_WORKERS == 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            if resource_tracker is not None:
+                # workers must share our resource tracker, else theirs would try to clean up blocks we've unlinked
+                resource_tracker.ensure_running()
+            _pool = ProcessPoolExecutor(
+                max_workers=settings.PREPROCESSING_WORKERS,
+                mp_context=multiprocessing.get_context(settings.PREPROCESSING_START_METHOD),
+                initializer=_init_worker,
+            )
+        return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
+
+
+def preprocess(image_files) -> list:
+    """
+    standardize_image for a list of uploaded files, returns list of (ImageFile, pixels) in the same order
+    files are handled in parallel when a pool is configured, inline otherwise
+    """
+    pool = get_pool()
+    if pool is None:
+        return [standardize_image(each) for each in image_files]
+
+    # stages inside the workers aren't seen from here, time the whole thing
+    with timing.stage("preprocess"):
+        return _preprocess_in_pool(pool, image_files)
+
+
+def _preprocess_in_pool(pool, image_files) -> list:
+    futures = [pool.submit(_standardize_in_worker, each.read()) for each in image_files]
+    results, error = [], None
+    for each in futures:
+        try:
+            stored, handle = each.result()
+        except Exception as e:
+            error = error or e
+            continue
+        # always read, so shared memory of the other files is released when one of them fails
+        pixels = _read_pixels(handle)
+        results.append((ImageFile(BytesIO(stored)), pixels))
+
+    if error is not None:
+        raise error
+    return results
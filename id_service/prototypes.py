@@ -0,0 +1,125 @@
+"""
+Per animal prototypes, the centroid of each AnimalRecord's image vectors
+with IDENTITY_MATCHING = "prototype" an upload is verified against the closest few animals
+instead of the closest few images, so well photographed animals don't crowd out the others
+and the differentiator batch stays small.
+
+centroids are moved incrementally when an image is assigned, reassigned, re-encoded or deleted (see signals.py),
+under a row lock on the animal. bulk updates skip signals, use recompute() after those.
+like vector_index, each process keeps its own index of centroids per data set, candidates are confirmed against db
+"""
+import threading
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from .models import AnimalRecord, ImageRecord, pack_vector, unpack_vector
+
+
+def _shift(animal_id, vector, sign):
+    """adds (sign=1) or removes (sign=-1) vector from animal's centroid"""
+    with transaction.atomic():
+        animal = AnimalRecord.objects.select_for_update().filter(id=animal_id).only("id", "data_set_id", "centroid", "image_count").first()
+        if animal is None:
+            # deleted along with its images
+            return
+        if animal.centroid is None or animal.image_count <= 0:
+            # nothing to move from, start over
+            count, centroid = (1, vector) if sign > 0 else (0, None)
+        else:
+            count = animal.image_count + sign
+            # in float64, float32 error would build up over many updates
+            centroid = (animal.centroid_vector.astype(np.float64) * animal.image_count + sign * vector) / count if count else None
+        AnimalRecord.objects.filter(id=animal_id).update(centroid=pack_vector(centroid), image_count=count)
+    _update_index(animal.data_set_id, animal_id, centroid)
+
+
+def load_assigned(record):
+    """
+    reads record's stored (identity_id, embedding) when they were deferred on load, see ImageRecord._assigned
+    called before save / delete (see signals.py), so the old centroid can be moved too
+    """
+    if record._assigned is None:
+        record._assigned = ImageRecord.objects.filter(pk=record.pk).values_list("identity_id", "embedding").first() or (None, None)
+
+
+def record_saved(record):
+    """moves record's vector between centroids if its identity or vector changed"""
+    assigned = (record.identity_id, record.embedding)
+    if record._assigned == assigned:
+        return
+
+    if record._assigned is None:
+        # saved without load_assigned, e.g. signals disconnected, count the new identity from scratch
+        if record.identity_id is not None:
+            recompute([record.identity_id])
+    else:
+        old_identity, old_embedding = record._assigned
+        if old_identity is not None and old_embedding is not None:
+            _shift(old_identity, unpack_vector(old_embedding), -1)
+        if record.identity_id is not None and record.embedding is not None:
+            _shift(record.identity_id, record.vector, 1)
+    record._assigned = assigned
+
+
+def record_deleted(record):
+    if record._assigned is not None and None not in record._assigned:
+        _shift(record._assigned[0], unpack_vector(record._assigned[1]), -1)
+
+
+def recompute(animal_ids):
+    """recomputes centroids of animals from their images"""
+    for animal_id in animal_ids:
+        vectors = [unpack_vector(each) for each in ImageRecord.objects.filter(
+            identity_id=animal_id, embedding__isnull=False).values_list("embedding", flat=True)]
+        centroid = np.mean(vectors, axis=0) if len(vectors) else None
+        AnimalRecord.objects.filter(id=animal_id).update(centroid=pack_vector(centroid), image_count=len(vectors))
+        data_set_id = AnimalRecord.objects.filter(id=animal_id).values_list("data_set_id", flat=True).first()
+        _update_index(data_set_id, animal_id, centroid)
+
+
+###
+## Per DataSet index of centroids
+#
+_indexes = {}
+_registry_lock = threading.Lock()
+
+
+def _key(value):
+    return None if value is None else str(value)
+
+
+def get_index(data_set_id):
+    data_set_id = _key(data_set_id)
+    with _registry_lock:
+        try:
+            return _indexes[data_set_id]
+        except KeyError:
+            rows = AnimalRecord.objects.filter(data_set_id=data_set_id, centroid__isnull=False).values_list("id", "centroid")
+            _indexes[data_set_id] = import_string(settings.VECTOR_INDEX_BACKEND)(
+                [each[0] for each in rows], [unpack_vector(each[1]) for each in rows]
+            )
+            return _indexes[data_set_id]
+
+
+def _update_index(data_set_id, animal_id, centroid):
+    index = _indexes.get(_key(data_set_id))
+    if index is None:
+        return
+    if centroid is None:
+        index.remove(str(animal_id))
+    else:
+        index.add(str(animal_id), centroid)
+
+
+def nearest(vector, data_set_id=None, radius=settings.SPACIAL_QUERY_DIST, k=settings.VECTOR_INDEX_TOP_K):
+    """returns ids of up to k animals in data set with centroids within radius of vector, closest first"""
+    return get_index(data_set_id).query(vector, radius, k)
+
+
+def reset():
+    """drop all loaded indexes, they are rebuilt from db on next query"""
+    with _registry_lock:
+        _indexes.clear()
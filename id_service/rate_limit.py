@@ -0,0 +1,110 @@
+"""
+Token bucket rate limiting per API token and action class
+each token gets a bucket per action class ("cheap" / "expensive", see check_token in views.py, and "batch",
+images uploaded to image/batch, so bulk uploads don't have to fit in the expensive burst), buckets refill at RATE_LIMITS[class]["rate"] per second up to RATE_LIMITS[class]["burst"],
+so an idle token can't save up more than burst actions.
+
+bucket state is a (level, timestamp) pair in django's cache (RATE_LIMIT_CACHE_ALIAS), read and written back
+under a lock taken with cache.add, which is atomic on every django backend, so concurrent checks never both take
+the last action in a bucket.
+buckets are only shared between processes if the cache is: the "rate_limit" cache is local memory unless
+RATE_LIMIT_CACHE_BACKEND / RATE_LIMIT_CACHE_LOCATION point it at memcached, redis or the db (see settings),
+with local memory each worker process has its own buckets and a token gets rate and burst once per process
+"""
+import math
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import PermissionDenied
+
+
+class RateLimited(PermissionDenied):
+    """raised when a token's bucket is empty, RateLimitMiddleware turns it into a 429"""
+
+    def __init__(self, retry_after):
+        super(RateLimited, self).__init__(f"rate limited, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after  # <= seconds until the bucket holds enough for the action
+
+
+class TokenBucket:
+    """refills rate per second, holds at most burst"""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+
+    def take(self, state, now, cost=1.):
+        """
+        takes cost out of bucket in state, a (level, timestamp) pair or None for a full bucket
+        returns new state and seconds to wait, wait is 0 when the action is allowed
+        """
+        level, stamp = state if state is not None else (self.burst, now)
+        level = min(self.burst, level + max(now - stamp, 0.) * self.rate)
+        if level >= cost:
+            return (level - cost, now), 0.
+        return (level, now), (cost - level) / self.rate
+
+    @property
+    def refill_time(self):
+        # an untouched bucket is full again after this many seconds, no need to keep its state longer
+        return math.ceil(self.burst / self.rate)
+
+
+def action_class(expensive=False):
+    return "expensive" if expensive else "cheap"
+
+
+def get_bucket(expensive=False, action=None) -> TokenBucket:
+    return TokenBucket(**settings.RATE_LIMITS[action or action_class(expensive)])
+
+
+def _key(token_id, action):
+    return f"id_service:rate_limit:{action}:{token_id}"
+
+
+LOCK_TIMEOUT = 1  # <= seconds a crashed holder can keep a bucket locked, whole seconds for memcached
+LOCK_WAIT = 0.1  # <= seconds to wait for the lock before going ahead anyway
+
+
+@contextmanager
+def _locked(cache, key):
+    """holds a lock on key for the block, shared by every process using the cache"""
+    lock_key = f"{key}:lock"
+    deadline = time.monotonic() + LOCK_WAIT
+    acquired = cache.add(lock_key, 1, LOCK_TIMEOUT)
+    while not acquired and time.monotonic() <= deadline:
+        time.sleep(0.001)
+        acquired = cache.add(lock_key, 1, LOCK_TIMEOUT)
+    # when it's still not acquired, better to let a request through on a racy read than to stall it
+    try:
+        yield
+    finally:
+        # the lock isn't ours to release when we went ahead without it
+        if acquired:
+            cache.delete(lock_key)
+
+
+def check(token_id, expensive=False, cost=1., action=None):
+    """
+    takes one action (or cost actions) for token, raises RateLimited if there isn't enough left
+    action names the class directly, otherwise it's cheap or expensive
+    """
+    action = action or action_class(expensive)
+    bucket = get_bucket(action=action)
+    cache = caches[settings.RATE_LIMIT_CACHE_ALIAS]
+    key = _key(token_id, action)
+
+    with _locked(cache, key):
+        state, wait = bucket.take(cache.get(key), time.time(), cost)
+        cache.set(key, state, bucket.refill_time + 1)
+
+    if wait > 0:
+        raise RateLimited(wait)
+
+
+def reset(token_id):
+    """refill all buckets of token"""
+    cache = caches[settings.RATE_LIMIT_CACHE_ALIAS]
+    cache.delete_many([_key(token_id, action) for action in settings.RATE_LIMITS])
@@ -0,0 +1,244 @@
+"""
+Re-encoding and re-identification of stored ImageRecords, for when the encoder model changes
+run through `manage.py reindex`, see management/commands/reindex.py
+
+encoding goes over images in id order, REINDEX_CHUNK_SIZE at a time:
+stored image files are read back from storage, preprocessed, encoded in ENCODER_BATCH_SIZE batches
+and vectors are written with bulk_update. the id range can be split into shards for parallel workers,
+each shard keeps a json checkpoint of the last id it finished, so an interrupted job picks up where it left off.
+
+re-identification clusters each data set from scratch, in id order, the same way uploads are matched in ImageView:
+nearest neighbours among images already seen, closest few verified with the differentiator, majority vote
+(ties go to the closest), with the same rank_candidates / best_match.
+a new cluster keeps its first image's old identity id when no other cluster has taken it yet,
+so identities mostly stay put when the new model agrees with the old one
+"""
+import json
+import os
+from io import BytesIO
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Q
+from django.utils.module_loading import import_string
+
+from .inference import call_encoder_batch, call_differenciator
+from .models import ImageRecord, AnimalRecord, unpack_vector
+from .preprocessing import preprocess
+from .vector_index import rank_candidates, best_match
+from . import embedding_store, vector_index, prototypes
+
+
+def images_in(data_set_ids):
+    """ImageRecords in any of data_set_ids, None stands for public images"""
+    query = Q(data_set_id__in=[each for each in data_set_ids if each is not None])
+    if None in data_set_ids:
+        query |= Q(data_set__isnull=True)
+    return ImageRecord.objects.filter(query)
+
+
+class Checkpoint:
+    """json state file, written atomically"""
+
+    def __init__(self, path):
+        self.path = str(path)
+
+    def load(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def save(self, state):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".new", "w") as f:
+            json.dump(state, f)
+        os.replace(self.path + ".new", self.path)
+
+
+def shard_bounds(queryset, shards):
+    """splits queryset into shards by id, returns list of (start, stop) ids, start inclusive, stop exclusive, None is open"""
+    count = queryset.count()
+    ordered = queryset.order_by("id").values_list("id", flat=True)
+    starts = [None] + [ordered[count * i // shards] for i in range(1, shards) if count * i // shards < count]
+    # tiny data sets can end up with repeated bounds
+    starts = [each for i, each in enumerate(starts) if i == 0 or each != starts[i - 1]]
+    return list(zip(starts, starts[1:] + [None]))
+
+
+def iter_chunks(queryset, chunk_size, after=None):
+    """yields lists of records in id order, keyset paged so each chunk is one cheap query"""
+    queryset = queryset.order_by("id")
+    while True:
+        page = queryset if after is None else queryset.filter(id__gt=after)
+        chunk = list(page[:chunk_size])
+        if len(chunk) == 0:
+            return
+        yield chunk
+        after = chunk[-1].id
+
+
+def _read_file(record):
+    with record.image_file.open("rb") as f:
+        return BytesIO(f.read())
+
+
+def encode_records(records):
+    """sets vector on each record from its stored image, returns the records that could be read"""
+    readable, files = [], []
+    for record in records:
+        try:
+            files.append(_read_file(record))
+        except (OSError, ValueError):
+            # missing from storage, leave it for someone to look at
+            continue
+        readable.append(record)
+
+    try:
+        cleaned = preprocess(files)
+    except OSError:
+        # one bad file fails the whole batch, redo one at a time to find it
+        cleaned, kept = [], []
+        for record, each_file in zip(readable, files):
+            each_file.seek(0)
+            try:
+                cleaned += preprocess([each_file])
+            except OSError:
+                continue
+            kept.append(record)
+        readable = kept
+
+    if len(readable) == 0:
+        return readable
+
+    pixels = np.concatenate([each for new_file, each in cleaned])
+    vectors = []
+    for start in range(0, len(pixels), settings.ENCODER_BATCH_SIZE):
+        vectors += call_encoder_batch(pixels[start:start + settings.ENCODER_BATCH_SIZE])
+
+    for record, vector in zip(readable, vectors):
+        record.vector = vector
+    return readable
+
+
+def reencode(queryset, checkpoint, start=None, stop=None, chunk_size=None, progress=None):
+    """
+    re-encodes images in queryset with ids in [start, stop), resuming from checkpoint
+    returns the final checkpoint state
+    """
+    state = {"after": None, "encoded": 0, "skipped": 0, "finished": False, **checkpoint.load()}
+    if state["finished"]:
+        return state
+
+    queryset = queryset.exclude(image_file="").exclude(image_file__isnull=True)
+    if start is not None:
+        queryset = queryset.filter(id__gte=start)
+    if stop is not None:
+        queryset = queryset.filter(id__lt=stop)
+
+    for chunk in iter_chunks(queryset, chunk_size or settings.REINDEX_CHUNK_SIZE, after=state["after"]):
+        encoded = encode_records(chunk)
+        # bulk_update skips save signals, embedding stores are rebuilt once the job is done
+        ImageRecord.objects.bulk_update(encoded, ["embedding"])
+
+        state["after"] = str(chunk[-1].id)
+        state["encoded"] += len(encoded)
+        state["skipped"] += len(chunk) - len(encoded)
+        checkpoint.save(state)
+        if progress is not None:
+            progress(state)
+
+    state["finished"] = True
+    checkpoint.save(state)
+    return state
+
+
+def reidentify(data_set_id, checkpoint, chunk_size=None, progress=None):
+    """
+    reassigns identities of every encoded image in data set, resuming from checkpoint
+    animals left without images are deleted at the end
+    """
+    state = {"after": None, "identified": 0, "finished": False, **checkpoint.load()}
+    if state["finished"]:
+        return state
+
+    images = ImageRecord.objects.filter(data_set_id=data_set_id, embedding__isnull=False)
+
+    # images done before an interruption are already in their final clusters
+    seen = images.filter(id__lte=state["after"]) if state["after"] is not None else images.none()
+    seen = list(seen.values_list("id", "identity_id", "embedding"))
+    vectors = {str(each[0]): unpack_vector(each[2]) for each in seen}
+    index = import_string(settings.VECTOR_INDEX_BACKEND)(list(vectors), list(vectors.values()))
+    identities = {str(each[0]): each[1] for each in seen}
+    taken = set(identities.values())
+
+    for chunk in iter_chunks(images, chunk_size or settings.REINDEX_CHUNK_SIZE, after=state["after"]):
+        for record in chunk:
+            vector = record.vector
+            identity = _match(index, vectors, identities, vector)
+            if identity is None:
+                # new cluster, keep the old identity if it's still free
+                if record.identity_id is not None and record.identity_id not in taken:
+                    identity = record.identity_id
+                else:
+                    identity = str(AnimalRecord.objects.create(data_set_id=data_set_id).id)
+            taken.add(identity)
+
+            record.identity_id = identity
+            index.add(str(record.id), vector)
+            vectors[str(record.id)] = vector
+            identities[str(record.id)] = identity
+
+        ImageRecord.objects.bulk_update(chunk, ["identity"])
+        state["after"] = str(chunk[-1].id)
+        state["identified"] += len(chunk)
+        checkpoint.save(state)
+        if progress is not None:
+            progress(state)
+
+    AnimalRecord.objects.filter(data_set_id=data_set_id, images__isnull=True).delete()
+    state["finished"] = True
+    checkpoint.save(state)
+    return state
+
+
+def _match(index, vectors, identities, vector):
+    """returns identity with most same candidates among seen images, None if there are none, as ImageView does"""
+    candidate_ids = index.query(vector, settings.SPACIAL_QUERY_DIST, settings.VECTOR_INDEX_TOP_K)
+    if len(candidate_ids) == 0:
+        return None
+
+    found, candidates = rank_candidates(
+        np.array([str(identities[each]) for each in candidate_ids], dtype=object),
+        np.stack([vectors[each] for each in candidate_ids]),
+        vector,
+    )
+    return best_match(found, call_differenciator(candidates, vector))
+
+
+def refresh_prototypes(data_set_ids):
+    """recompute animal centroids after bulk updates"""
+    prototypes.recompute(AnimalRecord.objects.filter(data_set_id__in=[each for each in data_set_ids if each is not None]).values_list("id", flat=True).iterator())
+    if None in data_set_ids:
+        prototypes.recompute(AnimalRecord.objects.filter(data_set__isnull=True).values_list("id", flat=True).iterator())
+
+
+def refresh_stores(data_set_ids):
+    """rewrite embedding stores from db after bulk updates, and drop this process's indexes, other processes see the new inode"""
+    if settings.EMBEDDING_STORE_ENABLED:
+        for data_set_id in data_set_ids:
+            records = ImageRecord.objects.filter(data_set_id=data_set_id, embedding__isnull=False).iterator()
+            embedding_store.get_store(data_set_id).rebuild((each.id, each.vector) for each in records)
+    vector_index.reset()
+
+
+###
+## Worker entry points, module level so they can be sent to worker processes
+#
+def run_encode_shard(data_set_ids, start, stop, checkpoint_path, chunk_size=None):
+    return reencode(images_in(data_set_ids), Checkpoint(checkpoint_path), start=start, stop=stop, chunk_size=chunk_size)
+
+
+def run_reidentify(data_set_id, checkpoint_path, chunk_size=None):
+    return reidentify(data_set_id, Checkpoint(checkpoint_path), chunk_size=chunk_size)
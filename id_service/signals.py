@@ -0,0 +1,64 @@
+"""
+keeps derived, in-process state in line with ImageRecord rows, and sets up new db connections
+receivers are connected in IdServiceConfig.ready
+"""
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db.backends.signals import connection_created
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from .models import ImageRecord, APIToken
+
+from . import vector_index, embedding_store, prototypes, token_cache
+
+
+@receiver(pre_save, sender=ImageRecord)
+@receiver(pre_delete, sender=ImageRecord)
+def load_assigned(sender, instance, **kwargs):
+    # identity and vector as stored, if they were deferred, so their old centroid is moved too
+    prototypes.load_assigned(instance)
+
+
+@receiver(post_save, sender=ImageRecord)
+def update_vector_index(sender, instance, **kwargs):
+    # store goes first, so an index built from it won't miss this record
+    if settings.EMBEDDING_STORE_ENABLED:
+        embedding_store.record_saved(instance)
+    vector_index.record_saved(instance)
+    prototypes.record_saved(instance)
+
+
+@receiver(post_delete, sender=ImageRecord)
+def remove_from_vector_index(sender, instance, **kwargs):
+    if settings.EMBEDDING_STORE_ENABLED:
+        embedding_store.record_deleted(instance)
+    vector_index.record_deleted(instance)
+    prototypes.record_deleted(instance)
+
+
+@receiver(post_save, sender=APIToken)
+@receiver(post_delete, sender=APIToken)
+def invalidate_cached_token(sender, instance, **kwargs):
+    token_cache.invalidate(instance.id)
+
+
+@receiver(m2m_changed, sender=APIToken.read_set.through)
+def invalidate_cached_token_read_set(sender, instance, **kwargs):
+    if isinstance(instance, APIToken):
+        token_cache.invalidate(instance.id)
+
+
+@receiver(request_finished)
+def flush_action_counters(sender, **kwargs):
+    # once the response is out, if TOKEN_FLUSH_INTERVAL has passed
+    token_cache.counters.maybe_flush()
+
+
+@receiver(connection_created)
+def set_sqlite_pragmas(sender, connection, **kwargs):
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for name, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
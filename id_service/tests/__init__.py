@@ -1,10 +1,21 @@
 from django.core.files.base import ContentFile
+from django.test import Client, override_settings
 
 from PIL import Image
 from io import BytesIO
+from unittest import mock
 
+import base64
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
 import numpy as np
 import random
+import tempfile
+import threading
+
+
+# whatever runs the tests, counters mustn't be flushed on exit, the test database is gone by then
+override_settings(TOKEN_FLUSH_ON_EXIT=False).enable()
 
 
 def get_fake_image_file():
@@ -26,4 +37,123 @@ def get_test_embeddings():
         [4.638023,  7.8766  , -23.59152 , -7.3079066],
         [7.703525,  4.752338, -21.905794, -9.553763 ],
         [4.171407, 14.440775, -20.054556, -6.2461677],
-    ]
\ No newline at end of file
+    ]
+
+
+def use_temp_media(test_case):
+    # uploaded files go to a throw away dir instead of the dev server's media
+    temp_dir = tempfile.TemporaryDirectory()
+    test_case.addCleanup(temp_dir.cleanup)
+    override = override_settings(MEDIA_ROOT=temp_dir.name)
+    override.enable()
+    test_case.addCleanup(override.disable)
+
+
+def use_temp_embedding_store(test_case):
+    # point embedding store at a throw away dir, and forget anything loaded by earlier tests
+    from .. import embedding_store, vector_index, prototypes
+
+    temp_dir = tempfile.TemporaryDirectory()
+    test_case.addCleanup(temp_dir.cleanup)
+    override = override_settings(EMBEDDING_STORE_ROOT=temp_dir.name)
+    override.enable()
+    test_case.addCleanup(override.disable)
+
+    embedding_store.reset()
+    vector_index.reset()
+    prototypes.reset()
+    test_case.addCleanup(embedding_store.reset)
+    test_case.addCleanup(vector_index.reset)
+    test_case.addCleanup(prototypes.reset)
+
+
+class UploadTestMixin:
+    """
+    temp media and embedding store, an empty upload cache, a data set with a token that reads and writes it,
+    and a client for that token. model servers are mocked below the call_* functions in inference.py:
+    self.encoder gets the pixels and returns embeddings, self.differ gets the left and right halves and
+    returns sameness, change their side_effect to change the answers
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        from django.core.cache import caches
+        from ..models import DataSet, APIToken, settings
+
+        use_temp_embedding_store(self)
+        use_temp_media(self)
+        caches[settings.UPLOAD_CACHE_ALIAS].clear()
+        self.addCleanup(caches[settings.UPLOAD_CACHE_ALIAS].clear)
+
+        self.d_set = DataSet.objects.create()
+        self.token = APIToken.objects.create(write_set=self.d_set)
+        self.token.read_set.add(self.d_set)
+        self.client = Client(HTTP_X_API_KEY=self.token.id)
+
+        # every image looks like embedding 1, and every pair is the same animal
+        embeddings = get_test_embeddings()
+        self.encoder = mock.Mock(side_effect=lambda pixels: [embeddings[1] for each in pixels])
+        self.differ = mock.Mock(side_effect=lambda left, right: [True for each in left])
+
+        def fake_predict(model_name, instances):
+            if model_name == settings.ENCODER_NAME:
+                return self.encoder(instances)
+            left, right = np.split(np.asarray(instances), 2, axis=1)
+            return [[1.] if same else [0.] for same in self.differ(left, right)]
+
+        mock.patch("id_service.inference._predict", side_effect=fake_predict).start()
+        # an AsyncMock, fake_predict's answer comes back awaitable
+        mock.patch("id_service.inference._apredict", side_effect=fake_predict).start()
+        self.addCleanup(mock.patch.stopall)
+
+
+class FakeTFServing:
+    """
+    stand-in for a tf-serving container on localhost, answers any :predict call
+    with a prediction of length 4 per instance, the mean of that instance
+    b64 instances are read as uint8 pixels, like Base64PixelTransport sends them
+    use as context manager, requests and connections are recorded for checking
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.connections = 0
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # <= keep-alive
+
+            def setup(self):
+                fake.connections += 1
+                super().setup()
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                fake.requests.append((self.path, body))
+                instances = json.loads(body)["instances"]
+                if isinstance(instances[0], dict):
+                    # b64 transport, raw pixels
+                    instances = [np.frombuffer(base64.b64decode(each["b64"]), dtype=np.uint8) for each in instances]
+                instances = np.array(instances, dtype=np.float32)
+                mean = instances.reshape((len(instances), -1)).mean(axis=1)
+                payload = json.dumps({"predictions": [[float(each)] * 4 for each in mean]}).encode()
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.port = self.server.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,91 @@
+from django.test import TestCase
+
+from .__init__ import get_test_embeddings, use_temp_embedding_store
+from ..models import ImageRecord, DataSet, settings
+from ..embedding_store import *
+
+
+class TestEmbeddingStore(TestCase):
+
+    def setUp(self) -> None:
+        use_temp_embedding_store(self)
+
+    def test_put_and_delete(self):
+        embeddings = get_test_embeddings()
+        store = EmbeddingStore("test_set")
+        self.assertFalse(store.exists())
+
+        for i, each_vector in enumerate(embeddings):
+            store.put(f"image_{i}", each_vector)
+
+        # rows are memory-mapped float32 in insertion order
+        ids, vectors = store.arrays()
+        self.assertListEqual(ids, [f"image_{i}" for i in range(len(embeddings))])
+        self.assertTrue(isinstance(vectors, np.memmap))
+        np.testing.assert_allclose(vectors, np.array(embeddings, dtype=np.float32))
+
+        # updates happen in place
+        store.put("image_0", embeddings[1])
+        np.testing.assert_allclose(store.get("image_0"), embeddings[1], rtol=1e-6)
+        self.assertEqual(len(store.arrays()[0]), len(embeddings))
+
+        # deleted rows are gone
+        store.delete("image_0")
+        self.assertIsNone(store.get("image_0"))
+
+        # another process (simulated by a second store object) sees the same data
+        other = EmbeddingStore("test_set")
+        np.testing.assert_allclose(other.get("image_3"), embeddings[3], rtol=1e-6)
+
+    def test_appended_elsewhere(self):
+        embeddings = get_test_embeddings()
+        store, other = EmbeddingStore("test_set"), EmbeddingStore("test_set")
+        store.put("image_0", embeddings[0])
+        self.assertEqual(len(store.arrays()[0]), 1)
+        version = store.version
+
+        # rows appended by another process show up on the next read
+        other.put("image_1", embeddings[1])
+        other.put("image_2", embeddings[2])
+        ids, vectors = store.arrays(start=1)
+        self.assertListEqual(ids, ["image_1", "image_2"])
+        np.testing.assert_allclose(vectors, np.array(embeddings[1:3], dtype=np.float32))
+        self.assertNotEqual(store.version, version)
+        self.assertFalse(store.refresh())
+
+        # a rebuild is a new inode
+        other.rebuild([("image_3", embeddings[3])])
+        self.assertTrue(store.refresh())
+        self.assertNotEqual(store.version[0], version[0])
+        self.assertListEqual(store.arrays()[0], ["image_3"])
+
+    def test_follows_image_records(self):
+        d_set = DataSet.objects.create()
+        embeddings = get_test_embeddings()
+
+        record = ImageRecord.objects.create(data_set=d_set)
+        record.vector = embeddings[2]
+        record.save()
+        np.testing.assert_allclose(get_store(d_set.id).get(record.id), embeddings[2], rtol=1e-6)
+
+        # moving to public set
+        record.data_set = None
+        record.save()
+        self.assertIsNone(get_store(d_set.id).get(record.id))
+        np.testing.assert_allclose(get_store(None).get(record.id), embeddings[2], rtol=1e-6)
+
+        record.delete()
+        self.assertIsNone(get_store(None).get(record.id))
+
+    def test_built_from_db(self):
+        # records saved before the store was switched on get picked up on first open
+        d_set = DataSet.objects.create()
+        with self.settings(EMBEDDING_STORE_ENABLED=False):
+            for each_vector in get_test_embeddings():
+                record = ImageRecord.objects.create(data_set=d_set)
+                record.vector = each_vector
+                record.save()
+
+        ids, vectors = get_store(d_set.id).arrays()
+        self.assertEqual(len(ids), len(get_test_embeddings()))
+        self.assertEqual(vectors.shape, (len(ids), settings.EMBEDDING_DIM))
@@ -1,7 +1,12 @@
 from django.test import TestCase
 
-from .__init__ import get_fake_image_file, get_test_embeddings
+from asgiref.sync import async_to_sync
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from .__init__ import get_fake_image_file, get_test_embeddings, FakeTFServing
 from ..inference import *
+from ..batching import MicroBatcher, AsyncMicroBatcher
 
 
 class TestImageUtil(TestCase):
@@ -30,6 +35,25 @@ class TestImageUtil(TestCase):
         self.assertTrue(isinstance(new_image,ImageFile))
         self.assertEqual(pixels.shape,(1,*settings.IMAGE_SIZE,3))
 
+    def test_standardize_large_jpeg(self):
+        # big flat coloured photo, decoded at reduced scale
+        photo = Image.new("RGB", (3000, 2000), color=(120, 60, 30))
+        to_file = BytesIO()
+        photo.save(to_file, format="JPEG")
+
+        new_image, pixels = standardize_image(BytesIO(to_file.getvalue()))
+        self.assertEqual(pixels.shape,(1,*settings.IMAGE_SIZE,3))
+        self.assertEqual(pixels.dtype, np.uint8)
+        # colour survives within jpeg error
+        np.testing.assert_allclose(pixels.mean(axis=(0, 1, 2)), (120, 60, 30), atol=3)
+        # stored file is readable and at target size
+        self.assertEqual(Image.open(new_image).size, settings.IMAGE_SIZE)
+
+    def test_stored_format(self):
+        with self.settings(STORED_IMAGE_FORMAT="WEBP", STORED_IMAGE_OPTIONS={"quality": 80}):
+            new_image, pixels = standardize_image(get_fake_image_file())
+        self.assertEqual(Image.open(new_image).format, "WEBP")
+
 
 class TestMLModels(TestCase):
 
@@ -51,3 +75,168 @@ class TestMLModels(TestCase):
 
         sameness = call_differenciator(left,right)
         self.assertEqual(len(sameness), 3)
+
+
+class TestMicroBatcher(TestCase):
+
+    def test_concurrent_calls_are_merged(self):
+        batch_sizes = []
+
+        def fake_predict(instances):
+            batch_sizes.append(len(instances))
+            # echo each instance back so we can check routing
+            return [each.tolist() for each in instances]
+
+        batcher = MicroBatcher(fake_predict, max_batch_size=8, max_wait_ms=50)
+
+        # 16 callers with 1 instance each
+        with ThreadPoolExecutor(16) as pool:
+            results = list(pool.map(lambda i: batcher.submit(np.array([[i]])), range(16)))
+
+        # each caller got its own prediction back
+        self.assertListEqual(results, [[[i]] for i in range(16)])
+        # and model was called with full batches, never above the max size
+        self.assertLess(len(batch_sizes), 16)
+        self.assertLessEqual(max(batch_sizes), 8)
+        self.assertEqual(sum(batch_sizes), 16)
+
+    def test_errors_reach_callers(self):
+        def broken_predict(instances):
+            raise ValueError("model server is down")
+
+        batcher = MicroBatcher(broken_predict, max_batch_size=8, max_wait_ms=1)
+        self.assertRaises(ValueError, batcher.submit, np.zeros((1, 4)))
+
+
+    def test_async_calls_are_merged(self):
+        batch_sizes = []
+
+        async def fake_predict(instances):
+            batch_sizes.append(len(instances))
+            return [each.tolist() for each in instances]
+
+        async def submit_a_few():
+            batcher = AsyncMicroBatcher(fake_predict, max_batch_size=4, max_wait_ms=50)
+            return await asyncio.gather(*[batcher.submit(np.array([[i]])) for i in range(10)])
+
+        results = async_to_sync(submit_a_few)()
+        self.assertListEqual(results, [[[i]] for i in range(10)])
+        self.assertListEqual(batch_sizes, [4, 4, 2])
+
+    def test_async_errors_reach_callers(self):
+        async def broken_predict(instances):
+            raise ValueError("model server is down")
+
+        async def submit():
+            return await AsyncMicroBatcher(broken_predict, max_batch_size=8, max_wait_ms=1).submit(np.zeros((1, 4)))
+
+        self.assertRaises(ValueError, async_to_sync(submit))
+
+
+class TestInferenceClient(TestCase):
+
+    def test_keep_alive(self):
+        with FakeTFServing() as server:
+            client = InferenceClient(host="127.0.0.1", port=server.port, timeouts={"encoder": 1.})
+
+            for i in range(5):
+                predictions = client.predict("encoder", np.ones((2, 3)))
+                self.assertEqual(len(predictions), 2)
+
+            # all calls went over one connection, to the cached url
+            self.assertEqual(server.connections, 1)
+            self.assertEqual(len(server.requests), 5)
+            self.assertEqual(server.requests[0][0], "/v1/models/encoder:predict")
+            self.assertIs(client.url_for("encoder"), client.url_for("encoder"))
+
+    def test_errors_raised(self):
+        # nothing is listening here, retries run out
+        with FakeTFServing() as server:
+            port = server.port
+        client = InferenceClient(host="127.0.0.1", port=port, retries=1, backoff=0.)
+        self.assertRaises(requests.exceptions.ConnectionError, client.predict, "encoder", np.ones((1, 3)))
+
+    def test_transports(self):
+        # same image through both transports should give the same prediction
+        new_image, pixels = standardize_image(get_fake_image_file())
+
+        with FakeTFServing() as server:
+            json_client = InferenceClient(host="127.0.0.1", port=server.port)
+            b64_client = InferenceClient(host="127.0.0.1", port=server.port, transports={"encoder": Base64PixelTransport()})
+
+            self.assertListEqual(json_client.predict("encoder", pixels), b64_client.predict("encoder", pixels))
+
+            # and the raw bytes payload is much smaller
+            json_body, b64_body = server.requests[0][1], server.requests[1][1]
+            self.assertLess(len(b64_body) * 2, len(json_body))
+
+    def test_b64_encoding(self):
+        # bytes are little-endian float32 by default
+        vectors = np.array(get_test_embeddings())
+        body = json.loads(Base64Transport().encode(vectors))
+        decoded = [np.frombuffer(base64.b64decode(each["b64"]), dtype="<f4") for each in body["instances"]]
+        np.testing.assert_allclose(np.stack(decoded), vectors, rtol=1e-6)
+
+
+class TestBackends(TestCase):
+
+    def test_local_backend(self):
+        # stand in for onnxruntime session, sums each instance
+        class FakeSession:
+            def get_inputs(self):
+                return [type("Input", (), {"name": "input_1"})]
+
+            def run(self, outputs, feed):
+                instances = feed["input_1"]
+                return [instances.reshape((len(instances), -1)).sum(axis=1, keepdims=True)]
+
+        class FakeLocalBackend(LocalBackend):
+            def load_session(self, path):
+                return FakeSession()
+
+        backend = FakeLocalBackend(model_dir="unused", model_names=["differ"], threads=2)
+        self.assertListEqual(backend.predict("differ", np.ones((3, 8))), [[8.], [8.], [8.]])
+
+        # call_differenciator works the same on top of it
+        with mock.patch("id_service.inference._backend", backend):
+            sameness = call_differenciator(np.ones((2, 4)), np.zeros((2, 4)))
+        self.assertListEqual(sameness, [True, True])
+
+    def test_local_backend_needs_onnxruntime(self):
+        with mock.patch.dict("sys.modules", {"onnxruntime": None}):
+            self.assertRaises(ImproperlyConfigured, LocalBackend, model_dir="unused", model_names=["differ"])
+
+    def test_remote_backend(self):
+        with FakeTFServing() as server, self.settings(INFERENCE_BATCHING_ENABLED=False):
+            client = InferenceClient(host="127.0.0.1", port=server.port)
+            with mock.patch("id_service.inference._client", client):
+                self.assertEqual(len(RemoteBackend().predict("encoder", np.ones((2, 3)))), 2)
+
+    def test_async_predict(self):
+        with FakeTFServing() as server:
+            client = InferenceClient(host="127.0.0.1", port=server.port)
+
+            async def predict_a_few():
+                results = await asyncio.gather(*[client.apredict("encoder", np.ones((2, 3)) * i) for i in range(3)])
+                return results, await client._async_clients.get()
+
+            results, async_client = async_to_sync(predict_a_few)()
+        self.assertListEqual([each[0][0] for each in results], [0., 1., 2.])
+        # closed along with the event loop
+        self.assertTrue(async_client.is_closed)
+        self.assertEqual(len(client._async_clients), 0)
+
+    def test_async_remote_backend_batches(self):
+        with FakeTFServing() as server, self.settings(INFERENCE_BATCHING_ENABLED=True, INFERENCE_MAX_WAIT_MS=50):
+            client = InferenceClient(host="127.0.0.1", port=server.port)
+            backend = RemoteBackend()
+
+            async def predict_a_few():
+                return await asyncio.gather(*[backend.apredict("encoder", np.ones((1, 3)) * i) for i in range(4)])
+
+            with mock.patch("id_service.inference._client", client):
+                results = async_to_sync(predict_a_few)()
+        self.assertListEqual([each[0][0] for each in results], [0., 1., 2., 3.])
+        # one request over httpx for all four, batchers went with the loop
+        self.assertEqual(len(server.requests), 1)
+        self.assertEqual(len(backend._async_batchers), 0)
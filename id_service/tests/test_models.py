@@ -1,9 +1,12 @@
 from django.test import TestCase
+from django.db import connection
 from django.core.exceptions import ObjectDoesNotExist
 
-from .__init__ import get_fake_image_file, get_test_embeddings
+from .__init__ import get_fake_image_file, get_test_embeddings, use_temp_embedding_store, use_temp_media
 from ..models import *
 
+import numpy as np
+
 
 COLLISION_TEST_COUNT = 10000
 
@@ -14,6 +17,10 @@ class TestRecordsBasic(TestCase):
     foreign key relationships,
     basically is here to catch syntax errors / refresh me on django
     """
+    def setUp(self) -> None:
+        use_temp_embedding_store(self)
+        use_temp_media(self)
+
     def test_image_record(self):
 
         # make image record
@@ -47,9 +54,18 @@ class TestRecordsBasic(TestCase):
             inst.save()
 
 
-        # check if property getter works
+        # check if property getter works, before and after a round trip through the db
         for inst, vector in zip(insts,embeddings):
-            self.assertEqual(inst.vector, tuple(vector))
+            np.testing.assert_allclose(inst.vector, vector, rtol=1e-6)
+            np.testing.assert_allclose(ImageRecord.objects.get(id=inst.id).vector, vector, rtol=1e-6)
+
+        # embeddings are stored as packed float32
+        self.assertEqual(len(insts[0].embedding), 4 * settings.EMBEDDING_DIM)
+        self.assertIsNone(ImageRecord().vector)
+
+        # vectors of the wrong size are refused
+        with self.assertRaises(ValueError):
+            insts[0].vector = [1., 2.]
 
     def test_image_vectors(self):
         # get mock image vectors
@@ -59,26 +75,18 @@ class TestRecordsBasic(TestCase):
         # make image records and add embeddings
         for each_vector in embeddings:
             record = ImageRecord.objects.create()
-            record.v0, record.v1, record.v2, record.v3 = each_vector
+            record.vector = each_vector
             ids.append(str(record.id))
             record.save()
 
-        # try query by vector
-        t0, t1, t2, t3 = embeddings[-1]
-        found_set = ImageRecord.objects.filter(
-            v0__range=(t0 - settings.SPACIAL_QUERY_DIST, t0 + settings.SPACIAL_QUERY_DIST),
-            v1__range=(t1 - settings.SPACIAL_QUERY_DIST, t1 + settings.SPACIAL_QUERY_DIST),
-            v2__range=(t2 - settings.SPACIAL_QUERY_DIST, t2 + settings.SPACIAL_QUERY_DIST),
-            v3__range=(t3 - settings.SPACIAL_QUERY_DIST, t3 + settings.SPACIAL_QUERY_DIST),
-        )
-
-        # check of all but image 0 are in found set
-        self.assertListEqual([each_id for each_id in found_set.values_list("id",flat=True)],ids[1:])
+        # all but image 0 are within SPACIAL_QUERY_DIST of the last one on every component
+        box = np.abs(np.array(embeddings) - embeddings[-1]).max(axis=1) <= settings.SPACIAL_QUERY_DIST
+        self.assertListEqual(list(box), [False, True, True, True])
 
         # query this time with class method shortcut
         found_set = ImageRecord.vector_queryset(embeddings[-1])
         # check of all but image 0 are in found set
-        self.assertListEqual([each_id for each_id in found_set.values_list("id", flat=True)], ids[1:])
+        self.assertListEqual(sorted(found_set.values_list("id", flat=True)), sorted(ids[1:]))
 
     def test_animal_record(self):
         # create animal Record
@@ -138,13 +146,13 @@ class TestAPIToken(TestCase):
         t = APIToken.objects.create()
 
         # check if it is valid (it should be)
-        self.assertTrue(t.is_valid(expensive=True))
+        self.assertTrue(t.is_valid())
 
         # set first use time to a little while ago
         t.first_use = datetime.now() - timedelta(hours=1)
 
         # check if it is valid
-        self.assertTrue(t.is_valid(expensive=True))
+        self.assertTrue(t.is_valid())
 
     def test_validation_not_allowed(self):
         # make token, set time to an expired time
@@ -156,17 +164,10 @@ class TestAPIToken(TestCase):
 
         # make another token, set time past but not expired
         t = APIToken.objects.create()
-        past_sec = 1000
-        t.first_use = datetime.now() - timedelta(seconds=past_sec)
-        # set use count to exceeding allowed
-        t.actions = past_sec * settings.MAX_ACTIONS_PER_SEC + 1
-
-        # check if it is invalid
-        self.assertFalse(t.is_valid())
+        t.first_use = datetime.now() - timedelta(days=settings.TOKEN_VALID_DAYS) / 2
 
-        # simulate waiting 60 seconds
-        t.first_use = t.first_use - timedelta(seconds=60)
-        # now it should be valid again
+        # lots of use doesn't expire a token, that's for rate limiting, see test_rate_limit.py
+        t.actions = 10 ** 6
         self.assertTrue(t.is_valid())
 
 
@@ -219,3 +220,23 @@ class TestModelInteractions(TestCase):
     # TODO : finish implementing below tests
     def test_delete_behaviour(self):
         pass
+
+
+class TestDatabaseSetup(TestCase):
+
+    def test_sqlite_pragmas(self):
+        if connection.vendor != "sqlite":
+            self.skipTest("sqlite only")
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA synchronous")
+            # NORMAL
+            self.assertEqual(cursor.fetchone()[0], 1)
+            cursor.execute("PRAGMA temp_store")
+            # MEMORY
+            self.assertEqual(cursor.fetchone()[0], 2)
+
+    def test_indexes(self):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, ImageRecord._meta.db_table)
+        self.assertEqual(constraints["image_set_id_idx"]["columns"], ["data_set_id", "id"])
+        self.assertEqual(constraints["image_identity_id_idx"]["columns"], ["identity_id", "id"])
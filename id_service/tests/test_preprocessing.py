@@ -0,0 +1,31 @@
+from django.test import TestCase
+
+from .__init__ import get_fake_image_file
+from ..preprocessing import *
+
+
+class TestPreprocessing(TestCase):
+
+    def tearDown(self) -> None:
+        shutdown_pool()
+
+    def test_pool_matches_inline(self):
+        files = [get_fake_image_file() for i in range(4)]
+        inline = preprocess(files)
+
+        for each in files:
+            each.seek(0)
+        with self.settings(PREPROCESSING_WORKERS=2):
+            self.assertIsNotNone(get_pool())
+            # not forked from this threaded process
+            self.assertEqual(get_pool()._mp_context.get_start_method(), "forkserver")
+            pooled = preprocess(files)
+
+        self.assertEqual(len(pooled), 4)
+        for (inline_file, inline_pixels), (pooled_file, pooled_pixels) in zip(inline, pooled):
+            np.testing.assert_array_equal(inline_pixels, pooled_pixels)
+            self.assertEqual(inline_file.file.getvalue(), pooled_file.file.getvalue())
+
+    def test_pool_errors(self):
+        with self.settings(PREPROCESSING_WORKERS=2):
+            self.assertRaises(OSError, preprocess, [get_fake_image_file(), BytesIO(b"not an image")])
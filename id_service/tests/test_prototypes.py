@@ -0,0 +1,86 @@
+from django.test import TestCase
+
+import numpy as np
+
+from .__init__ import get_test_embeddings, use_temp_embedding_store
+from ..models import DataSet, ImageRecord, AnimalRecord
+from .. import prototypes
+
+
+class TestCentroids(TestCase):
+
+    def setUp(self) -> None:
+        use_temp_embedding_store(self)
+        self.d_set = DataSet.objects.create()
+        self.animals = [AnimalRecord.objects.create(data_set=self.d_set) for i in range(2)]
+        self.embeddings = np.array(get_test_embeddings(), dtype=np.float32)
+
+    def assertCentroid(self, animal, vectors):
+        animal.refresh_from_db()
+        self.assertEqual(animal.image_count, len(vectors))
+        if len(vectors) == 0:
+            self.assertIsNone(animal.centroid_vector)
+        else:
+            np.testing.assert_allclose(animal.centroid_vector, np.mean(vectors, axis=0), rtol=1e-5)
+
+    def test_incremental(self):
+        images = []
+        for each in self.embeddings:
+            img = ImageRecord(data_set=self.d_set, identity=self.animals[0])
+            img.vector = each
+            img.save()
+            images.append(img)
+        self.assertCentroid(self.animals[0], self.embeddings)
+
+        # reassigned
+        images[0].identity = self.animals[1]
+        images[0].save()
+        self.assertCentroid(self.animals[0], self.embeddings[1:])
+        self.assertCentroid(self.animals[1], self.embeddings[:1])
+
+        # re-encoded, on a freshly loaded record
+        img = ImageRecord.objects.get(id=images[1].id)
+        img.vector = self.embeddings[1] + 1
+        img.save()
+        self.assertCentroid(self.animals[0], [self.embeddings[1] + 1, *self.embeddings[2:]])
+
+        # deleted
+        ImageRecord.objects.get(id=images[0].id).delete()
+        self.assertCentroid(self.animals[1], [])
+
+    def test_deferred_load(self):
+        img = ImageRecord(data_set=self.d_set)
+        img.vector = self.embeddings[0]
+        img.save()
+
+        # identity and vector weren't loaded, they're read back before saving
+        img = ImageRecord.objects.only("id").get(id=img.id)
+        img.identity = self.animals[0]
+        img.save()
+        self.assertCentroid(self.animals[0], self.embeddings[:1])
+
+        # so the old animal loses the image when it's reassigned
+        img = ImageRecord.objects.only("id").get(id=img.id)
+        img.identity = self.animals[1]
+        img.save()
+        self.assertCentroid(self.animals[0], [])
+        self.assertCentroid(self.animals[1], self.embeddings[:1])
+
+        # and when it's deleted
+        ImageRecord.objects.only("id", "data_set").get(id=img.id).delete()
+        self.assertCentroid(self.animals[1], [])
+
+    def test_nearest(self):
+        for animal, vector in zip(self.animals, self.embeddings[:2]):
+            img = ImageRecord(data_set=self.d_set, identity=animal)
+            img.vector = vector
+            img.save()
+
+        self.assertListEqual(prototypes.nearest(self.embeddings[0], data_set_id=self.d_set.id), [str(self.animals[0].id)])
+
+        # index follows centroid changes
+        img = ImageRecord(data_set=self.d_set, identity=self.animals[1])
+        img.vector = self.embeddings[1]
+        img.save()
+        ImageRecord.objects.filter(identity=self.animals[0]).delete()
+        self.assertListEqual(prototypes.nearest(self.embeddings[0], data_set_id=self.d_set.id), [])
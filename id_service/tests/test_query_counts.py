@@ -0,0 +1,63 @@
+from django.core.cache import caches
+from django.test import TestCase, Client, override_settings
+from django.urls import reverse
+
+from .test_views import DBSetUpMixin
+from ..models import DataSet, ImageRecord, AnimalRecord, APIToken, settings
+from ..token_cache import counters
+from .. import rate_limit
+
+
+@override_settings(TOKEN_FLUSH_INTERVAL=3600)
+class TestQueryBudget(DBSetUpMixin, TestCase):
+    """
+    fixed query budgets for each endpoint, with the token already cached
+    a failure here means a view started making more queries than it used to
+    """
+
+    def setUp(self) -> None:
+        caches[settings.TOKEN_CACHE_ALIAS].clear()
+        counters.flush()
+
+        key = APIToken.objects.create()
+        key.read_set.add(self.d_set, DataSet.objects.create())
+        key.write_set = self.d_set
+        key.save()
+        rate_limit.reset(key.id)
+
+        self.client = Client(HTTP_X_API_KEY=key.id)
+        # warm up token cache
+        self.client.get(reverse("data_set_endpoint", kwargs={"pk": str(self.d_set.id)}))
+
+    def assertBudget(self, budget, method, url):
+        with self.assertNumQueries(budget):
+            response = getattr(self.client, method)(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_image_get(self):
+        # read set, image
+        self.assertBudget(2, "get", reverse("image_endpoint", kwargs={"pk": self.known_images[-1]}))
+
+    def test_public_image_get(self):
+        self.assertBudget(2, "get", reverse("image_endpoint", kwargs={"pk": self.known_images[0]}))
+
+    def test_animal_get(self):
+        # read set, animal, images
+        response = self.assertBudget(3, "get", reverse("animal_endpoint", kwargs={"pk": self.known_animals[0]}))
+        self.assertEqual(len(response.json()["images"]), 5)
+
+    def test_set_get(self):
+        # read set, data set
+        self.assertBudget(2, "get", reverse("data_set_endpoint", kwargs={"pk": str(self.d_set.id)}))
+
+    def test_related_list_get(self):
+        # the read set isn't queried again for the related list
+        self.assertBudget(3, "get", reverse("data_set_endpoint", kwargs={"pk": str(self.d_set.id), "rel": "animals"}))
+
+    def test_budget_independent_of_read_set_size(self):
+        token = APIToken.objects.get(id=self.client.defaults["HTTP_X_API_KEY"])
+        token.read_set.add(*[DataSet.objects.create() for i in range(20)])
+        self.client.get(reverse("data_set_endpoint", kwargs={"pk": str(self.d_set.id)}))
+
+        self.assertBudget(3, "get", reverse("animal_endpoint", kwargs={"pk": self.known_animals[0]}))
@@ -0,0 +1,147 @@
+import asyncio
+
+from asgiref.sync import async_to_sync
+from django.core.cache import caches
+from django.test import TestCase, Client, override_settings
+from django.urls import reverse
+
+from unittest import mock
+
+from ..middleware import RateLimitMiddleware
+from ..models import DataSet, ImageRecord, APIToken, settings
+from ..rate_limit import TokenBucket, RateLimited, check, reset
+
+
+class TestTokenBucket(TestCase):
+
+    def test_burst(self):
+        bucket = TokenBucket(rate=1., burst=3)
+        state = None
+        # a fresh bucket is full, burst actions go through at once
+        for i in range(3):
+            state, wait = bucket.take(state, now=100.)
+            self.assertEqual(wait, 0)
+        state, wait = bucket.take(state, now=100.)
+        self.assertAlmostEqual(wait, 1.)
+
+    def test_refill_bounded(self):
+        bucket = TokenBucket(rate=1., burst=3)
+        state, wait = bucket.take(None, now=0.)
+
+        # idling for a long time doesn't save up more than burst
+        state, wait = bucket.take(state, now=10 ** 6)
+        self.assertEqual(state[0], 2)
+
+        # refills at rate
+        state = (0., 0.)
+        state, wait = bucket.take(state, now=0.5)
+        self.assertAlmostEqual(wait, 0.5)
+        state, wait = bucket.take(state, now=1.)
+        self.assertEqual(wait, 0)
+
+
+@override_settings(RATE_LIMITS={
+    "cheap": {"rate": 1., "burst": 2}, "expensive": {"rate": 0.5, "burst": 1}, "batch": {"rate": 1., "burst": 3}})
+class TestRateLimit(TestCase):
+
+    def setUp(self) -> None:
+        self.d_set = DataSet.objects.create()
+        self.token = APIToken.objects.create(write_set=self.d_set)
+        self.token.read_set.add(self.d_set)
+        reset(self.token.id)
+
+    def test_action_classes(self):
+        with mock.patch("id_service.rate_limit.time.time", return_value=1000.):
+            check(self.token.id)
+            check(self.token.id)
+            with self.assertRaises(RateLimited):
+                check(self.token.id)
+
+            # expensive actions have their own bucket
+            check(self.token.id, expensive=True)
+            with self.assertRaises(RateLimited) as raised:
+                check(self.token.id, expensive=True)
+            self.assertAlmostEqual(raised.exception.retry_after, 2.)
+
+        # and it refills
+        with mock.patch("id_service.rate_limit.time.time", return_value=1002.):
+            check(self.token.id, expensive=True)
+
+    def test_429(self):
+        image = ImageRecord.objects.create(data_set=self.d_set)
+        client = Client(HTTP_X_API_KEY=self.token.id)
+        url = reverse("image_endpoint", kwargs={"pk": str(image.id)})
+
+        with mock.patch("id_service.rate_limit.time.time", return_value=1000.):
+            for i in range(2):
+                self.assertEqual(client.get(url).status_code, 200)
+            response = client.get(url)
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "1")
+
+    def _batch(self, count):
+        client = Client(HTTP_X_API_KEY=self.token.id)
+        files = [open(settings.BASE_DIR.joinpath(f"id_service/static/id_service/test_cat_{i}.png"), "rb") for i in range(1, count + 1)]
+        try:
+            return client.post(reverse("image_batch_endpoint"), {"data_set": str(self.d_set.id), "image_file": files})
+        finally:
+            for each in files:
+                each.close()
+
+    def test_batch_charged_up_front(self):
+        with mock.patch("id_service.views.preprocess") as preprocess, \
+                mock.patch("id_service.views.call_encoder_batch") as encoder, \
+                mock.patch("id_service.rate_limit.time.time", return_value=1000.):
+            check(self.token.id, action="batch", cost=3)
+            response = self._batch(1)
+
+        # turned away before anything is decoded, encoded or saved
+        self.assertEqual(response.status_code, 429)
+        preprocess.assert_not_called()
+        encoder.assert_not_called()
+        self.assertEqual(ImageRecord.objects.count(), 0)
+
+    def test_batch_over_burst(self):
+        with mock.patch("id_service.views.preprocess") as preprocess:
+            response = self._batch(4)
+        self.assertEqual(response.status_code, 413)
+        preprocess.assert_not_called()
+
+        # nothing was taken
+        check(self.token.id, action="batch", cost=3)
+
+    def test_batch_has_own_bucket(self):
+        # more images than the expensive burst, with the expensive bucket empty
+        check(self.token.id, expensive=True)
+        with mock.patch("id_service.views.preprocess", side_effect=OSError) as preprocess:
+            response = self._batch(3)
+        # got past the charge, and failed decoding
+        self.assertEqual(response.status_code, 400)
+        preprocess.assert_called_once()
+
+    def test_lock_not_released_by_others(self):
+        cache = caches[settings.RATE_LIMIT_CACHE_ALIAS]
+        lock_key = f"id_service:rate_limit:cheap:{self.token.id}:lock"
+        cache.add(lock_key, 1, 60)
+        self.addCleanup(cache.delete, lock_key)
+
+        # goes ahead once the wait is over, but leaves the holder's lock alone
+        with mock.patch("id_service.rate_limit.LOCK_WAIT", 0.01):
+            check(self.token.id)
+        self.assertEqual(cache.get(lock_key), 1)
+
+
+class TestRateLimitMiddleware(TestCase):
+
+    def test_async_capable(self):
+        async def get_response(request):
+            return "response"
+
+        middleware = RateLimitMiddleware(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        self.assertEqual(async_to_sync(middleware)(None), "response")
+
+        middleware = RateLimitMiddleware(lambda request: "response")
+        self.assertFalse(asyncio.iscoroutinefunction(middleware))
+        self.assertEqual(middleware(None), "response")
@@ -0,0 +1,127 @@
+from django.core.files.base import ContentFile
+from django.core.management import call_command, CommandError
+from django.test import TestCase
+
+from unittest import mock
+from io import StringIO
+import os
+import tempfile
+import numpy as np
+
+from .__init__ import use_temp_embedding_store, use_temp_media
+from ..models import DataSet, ImageRecord, AnimalRecord, settings
+from ..embedding_store import get_store
+from ..vector_index import BruteForceIndex
+from .. import reindex
+
+
+def fake_encoder(pixels):
+    # cats 1 and 3 have different mean colours, so they end up far apart
+    return [[float(each.mean()), 0., 0., 0.] for each in pixels]
+
+
+def fake_differ(left, right):
+    return [bool(np.allclose(each, right, atol=1e-3)) for each in left]
+
+
+class TestReindex(TestCase):
+
+    def setUp(self) -> None:
+        use_temp_embedding_store(self)
+        use_temp_media(self)
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.checkpoints_dir = temp_dir.name
+
+        self.encoder = mock.patch("id_service.reindex.call_encoder_batch", side_effect=fake_encoder).start()
+        self.differ = mock.patch("id_service.reindex.call_differenciator", side_effect=fake_differ).start()
+        self.addCleanup(mock.patch.stopall)
+
+        # old model put the first 4 images together, they're really two cats of 3 images each
+        self.d_set = DataSet.objects.create()
+        old_identities = [AnimalRecord.objects.create(data_set=self.d_set) for i in range(2)]
+        self.images = []
+        for i in range(6):
+            img = ImageRecord(data_set=self.d_set, identity=old_identities[i >= 4])
+            with open(settings.BASE_DIR.joinpath(f"id_service/static/id_service/test_cat_{1 if i < 3 else 3}.png"), "rb") as f:
+                img.image_file.save(str(img.id), ContentFile(f.read()), save=False)
+            img.vector = (0., 0., 0., float(i))
+            img.save()
+            self.images.append(img)
+
+    def test_match_ties_go_to_closest(self):
+        vectors = {"far": np.array([0., 0., 0., 2.], dtype=np.float32), "close": np.array([0., 0., 0., 1.], dtype=np.float32)}
+        index = BruteForceIndex(list(vectors), np.stack(list(vectors.values())))
+        # one vote each, the same way uploads are matched
+        self.differ.side_effect = lambda left, right: [True for each in left]
+        found = reindex._match(index, vectors, {"far": "a", "close": "b"}, np.zeros(4, dtype=np.float32))
+        self.assertEqual(found, "b")
+
+    def checkpoint(self, name):
+        return reindex.Checkpoint(os.path.join(self.checkpoints_dir, name))
+
+    def test_shard_bounds(self):
+        images = ImageRecord.objects.all()
+        for shards in (1, 2, 4, 10):
+            bounds = reindex.shard_bounds(images, shards)
+            covered = []
+            for start, stop in bounds:
+                shard = images
+                if start is not None:
+                    shard = shard.filter(id__gte=start)
+                if stop is not None:
+                    shard = shard.filter(id__lt=stop)
+                covered += list(shard.values_list("id", flat=True))
+            self.assertListEqual(sorted(covered), sorted(str(each.id) for each in self.images))
+
+    def test_reencode_resumes(self):
+        # fail on the second chunk
+        self.encoder.side_effect = [fake_encoder(np.zeros((4, 2, 2, 3))), RuntimeError("encoder went away")]
+        with self.assertRaises(RuntimeError):
+            reindex.reencode(ImageRecord.objects.all(), self.checkpoint("encode.json"), chunk_size=4)
+        state = self.checkpoint("encode.json").load()
+        self.assertEqual(state["encoded"], 4)
+        self.assertFalse(state["finished"])
+
+        # second run only does what's left
+        self.encoder.reset_mock()
+        self.encoder.side_effect = fake_encoder
+        state = reindex.reencode(ImageRecord.objects.all(), self.checkpoint("encode.json"), chunk_size=4)
+        self.assertEqual(state["encoded"], 6)
+        self.assertEqual(sum(len(each.args[0]) for each in self.encoder.call_args_list), 2)
+
+        # and a finished job does nothing
+        self.encoder.reset_mock()
+        reindex.reencode(ImageRecord.objects.all(), self.checkpoint("encode.json"), chunk_size=4)
+        self.encoder.assert_not_called()
+
+    def test_unreadable_images_skipped(self):
+        self.images[0].image_file.storage.delete(self.images[0].image_file.name)
+        state = reindex.reencode(ImageRecord.objects.all(), self.checkpoint("encode.json"))
+        self.assertEqual((state["encoded"], state["skipped"]), (5, 1))
+
+    def test_command(self):
+        out = StringIO()
+        call_command(
+            "reindex", "--data-set", str(self.d_set.id), "--reidentify", "--chunk-size", "4",
+            "--checkpoint-dir", self.checkpoints_dir, stdout=out,
+        )
+
+        # every vector comes from the new encoder
+        for img in self.images:
+            img.refresh_from_db()
+            self.assertEqual(img.vector[3], 0.)
+
+        # two cats of three images each
+        clusters = [img.identity_id for img in self.images]
+        self.assertEqual(len(set(clusters[:3])), 1)
+        self.assertEqual(len(set(clusters[3:])), 1)
+        self.assertNotEqual(clusters[0], clusters[3])
+        self.assertEqual(AnimalRecord.objects.filter(data_set=self.d_set).count(), 2)
+
+        # the embedding store has the new vectors
+        np.testing.assert_allclose(get_store(str(self.d_set.id)).get(self.images[0].id), self.images[0].vector)
+
+        # a checkpointed job for other data sets isn't picked up by mistake
+        with self.assertRaises(CommandError):
+            call_command("reindex", "--data-set", "public", "--checkpoint-dir", self.checkpoints_dir, stdout=out)
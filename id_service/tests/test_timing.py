@@ -0,0 +1,110 @@
+import asyncio
+
+from django.http import HttpResponse
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from asgiref.sync import async_to_sync
+
+from .__init__ import UploadTestMixin
+from ..models import ImageRecord, settings
+from .. import timing
+from ..middleware import TimingMiddleware
+
+
+class TestTiming(TestCase):
+
+    def setUp(self) -> None:
+        timing.reset()
+        self.addCleanup(timing.reset)
+
+    def test_request_recording(self):
+        recorder, token = timing.start_request()
+        try:
+            with timing.stage("decode"):
+                pass
+            with timing.stage("decode"):
+                pass
+            timing.count("candidates", 3)
+        finally:
+            timing.end_request(token)
+
+        # outside a request only histograms get it
+        with timing.stage("decode"):
+            pass
+
+        self.assertListEqual(list(recorder.durations), ["decode"])
+        header = recorder.header()
+        self.assertRegex(header, r'^decode;dur=\d+\.\d, candidates;desc="3"$')
+
+        snapshot = timing.snapshot()
+        self.assertEqual(snapshot["durations"]["decode"]["count"], 3)
+        buckets = dict((str(bound), each) for bound, each in snapshot["counts"]["candidates"]["buckets"])
+        self.assertEqual(buckets["5"], 1)
+
+    def test_timed(self):
+        @timing.timed("sync_stage")
+        def sync_function(value):
+            return value
+
+        @timing.timed("async_stage")
+        async def async_function(value):
+            return value
+
+        self.assertEqual(sync_function(1), 1)
+        self.assertEqual(async_to_sync(async_function)(2), 2)
+        self.assertEqual(timing.snapshot()["durations"]["sync_stage"]["count"], 1)
+        self.assertEqual(timing.snapshot()["durations"]["async_stage"]["count"], 1)
+
+    def test_async_middleware(self):
+        async def get_response(request):
+            # interleaved with the other request while it sleeps
+            with timing.stage(request):
+                await asyncio.sleep(0.01)
+            timing.count(f"{request}_count", 1)
+            return HttpResponse()
+
+        middleware = TimingMiddleware(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+
+        async def both():
+            return await asyncio.gather(middleware("first"), middleware("second"))
+
+        for name, response in zip(["first", "second"], async_to_sync(both)()):
+            self.assertRegex(response["Server-Timing"], rf'^{name};dur=\d+\.\d, total;dur=\d+\.\d, {name}_count;desc="1"$')
+
+    @override_settings(TIMING_ENABLED=False)
+    def test_disabled(self):
+        with timing.stage("decode"):
+            pass
+        timing.count("candidates", 1)
+        self.assertDictEqual(timing.snapshot(), {"durations": {}, "counts": {}})
+
+
+class TestServerTiming(UploadTestMixin, TestCase):
+    # model servers are mocked below the timed inference calls
+
+    def setUp(self) -> None:
+        super().setUp()
+        timing.reset()
+        self.addCleanup(timing.reset)
+
+    def test_upload_stages(self):
+        with open(settings.BASE_DIR.joinpath("id_service/static/id_service/test_cat_1.png"), "rb") as f:
+            response = self.client.post(reverse("image_endpoint", kwargs={"pk": "new"}), {"image_file": f})
+        self.assertEqual(response.status_code, 200)
+
+        stages = [each.split(";")[0] for each in response["Server-Timing"].split(", ")]
+        for each in ["decode", "image_encode", "encoder", "vector_query", "candidate_fetch", "save", "total", "candidates"]:
+            self.assertIn(each, stages)
+
+        # second image is compared against the first
+        with open(settings.BASE_DIR.joinpath("id_service/static/id_service/test_cat_2.png"), "rb") as f:
+            response = self.client.post(reverse("image_endpoint", kwargs={"pk": "new"}), {"image_file": f})
+        self.assertIn('candidates;desc="1"', response["Server-Timing"])
+        self.assertIn("differentiator;dur=", response["Server-Timing"])
+        self.assertEqual(timing.snapshot()["durations"]["encoder"]["count"], 2)
+
+    def test_read(self):
+        record = ImageRecord.objects.create()
+        response = self.client.get(reverse("image_endpoint", kwargs={"pk": str(record.id)}))
+        self.assertRegex(response["Server-Timing"], r"^total;dur=")
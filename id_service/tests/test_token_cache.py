@@ -0,0 +1,107 @@
+from django.core.cache import caches
+from django.db import connection
+from django.test import TestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from ..models import DataSet, ImageRecord, APIToken, settings
+from ..token_cache import get_token, invalidate, counters
+
+
+class TestTokenCache(TestCase):
+
+    def setUp(self) -> None:
+        caches[settings.TOKEN_CACHE_ALIAS].clear()
+        counters.flush()
+
+        self.d_set = DataSet.objects.create()
+        self.token = APIToken.objects.create(write_set=self.d_set)
+        self.token.read_set.add(self.d_set)
+
+    def test_cached_get(self):
+        get_token(self.token.id)
+        # second get comes straight from the cache
+        with self.assertNumQueries(0):
+            token = get_token(self.token.id)
+        self.assertEqual(str(token.id), str(self.token.id))
+
+    def test_missing_token(self):
+        with self.assertRaises(APIToken.DoesNotExist):
+            get_token(None)
+        with self.assertRaises(APIToken.DoesNotExist):
+            get_token("not-a-real-token")
+
+    def test_invalidated_on_change(self):
+        get_token(self.token.id)
+
+        # saving the token drops the cached copy
+        self.token.first_use = None
+        self.token.save()
+        with self.assertNumQueries(1):
+            get_token(self.token.id)
+
+        # so does changing its read set
+        self.token.read_set.add(DataSet.objects.create())
+        with self.assertNumQueries(1):
+            get_token(self.token.id)
+
+        self.token.delete()
+        with self.assertRaises(APIToken.DoesNotExist):
+            get_token(self.token.id)
+
+    def test_batched_counters(self):
+        token = get_token(self.token.id)
+        for i in range(5):
+            counters.record(token)
+        counters.record(token, expensive=True)
+
+        # not written yet, but handed out tokens see the pending counts
+        self.token.refresh_from_db()
+        self.assertEqual((self.token.actions, self.token.expensive_actions), (0, 0))
+        token = get_token(self.token.id)
+        self.assertEqual((token.actions, token.expensive_actions), (5, 1))
+
+        # one update per token on flush
+        with self.assertNumQueries(1):
+            counters.flush()
+        self.token.refresh_from_db()
+        self.assertEqual((self.token.actions, self.token.expensive_actions), (5, 1))
+
+        # counts aren't applied twice after flushing
+        invalidate(self.token.id)
+        token = get_token(self.token.id)
+        self.assertEqual((token.actions, token.expensive_actions), (5, 1))
+
+    def test_request_doesnt_write_token(self):
+        image = ImageRecord.objects.create(data_set=self.d_set)
+        client = Client(HTTP_X_API_KEY=self.token.id)
+        # warm up cache
+        client.get(reverse("image_endpoint", kwargs={"pk": str(image.id)}))
+
+        with override_settings(TOKEN_FLUSH_INTERVAL=3600):
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(reverse("image_endpoint", kwargs={"pk": str(image.id)}))
+        self.assertEqual(response.status_code, 200)
+
+        token_table = APIToken._meta.db_table
+        self.assertFalse([q for q in queries if token_table in q["sql"] and "UPDATE" in q["sql"]])
+
+        counters.flush()
+        self.token.refresh_from_db()
+        self.assertEqual(self.token.actions, 2)
+
+    def test_flushed_after_request(self):
+        image = ImageRecord.objects.create(data_set=self.d_set)
+        client = Client(HTTP_X_API_KEY=self.token.id)
+
+        # nothing pending, nothing written
+        with self.assertNumQueries(0):
+            counters.flush()
+
+        with override_settings(TOKEN_FLUSH_INTERVAL=0):
+            client.get(reverse("image_endpoint", kwargs={"pk": str(image.id)}))
+        # written once the response was done with, nothing left for an exit hook
+        self.assertEqual(counters.pending(self.token.id), (0, 0))
+        self.token.refresh_from_db()
+        self.assertEqual(self.token.actions, 1)
+        self.assertFalse(settings.TOKEN_FLUSH_ON_EXIT)
@@ -0,0 +1,222 @@
+from unittest import mock, skipUnless
+
+from django.db import connection
+from django.test import TestCase, override_settings
+
+from .__init__ import get_test_embeddings, use_temp_embedding_store
+from ..models import ImageRecord, DataSet, settings
+from ..vector_index import *
+from ..embedding_store import EmbeddingStore
+from .. import pg_cube
+
+
+class TestIndexBackends(TestCase):
+
+    def test_kd_tree_matches_brute_force(self):
+        # make a bunch of random vectors, big enough for the tree to have a few levels
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(scale=20., size=(1000, 4))
+        ids = [str(i) for i in range(len(vectors))]
+
+        tree = KDTreeIndex(ids, vectors)
+        brute = BruteForceIndex(ids, vectors)
+
+        for query in vectors[:20]:
+            self.assertListEqual(tree.query(query, 10.), brute.query(query, 10.))
+
+    def test_add_and_remove(self):
+        embeddings = get_test_embeddings()
+        index = KDTreeIndex(["0", "1"], embeddings[:2])
+
+        # pending records can be found
+        index.add("3", embeddings[3])
+        self.assertIn("3", index.query(embeddings[3], settings.SPACIAL_QUERY_DIST))
+
+        # removed records can't be found, closest record comes first
+        index.remove("1")
+        self.assertListEqual(index.query(embeddings[3], settings.SPACIAL_QUERY_DIST), ["3"])
+
+        # lots of changes cause the tree to be rebuilt without losing records
+        for i in range(100):
+            index.add(f"new_{i}", embeddings[2])
+        self.assertLess(len(index.pending), 100)
+        self.assertEqual(len(index), 102)
+
+
+class TestRankByDistance(TestCase):
+
+    def test_l2(self):
+        embeddings = np.array(get_test_embeddings(), dtype=np.float32)
+        # closest to itself first, the odd one out never makes top 3
+        ranked = rank_by_distance(embeddings, embeddings[1], k=3)
+        self.assertEqual(ranked[0], 1)
+        self.assertNotIn(0, ranked)
+
+        # same order as a full sort when k covers everything
+        distances = [np.linalg.norm(each - embeddings[1]) for each in embeddings]
+        self.assertListEqual(list(rank_by_distance(embeddings, embeddings[1])), list(np.argsort(distances)))
+
+    def test_cosine(self):
+        candidates = np.array([[1., 0.], [0., 1.], [10., 1.]], dtype=np.float32)
+        self.assertListEqual(list(rank_by_distance(candidates, [1., 0.], metric="cosine")), [0, 2, 1])
+
+
+class TestBestMatch(TestCase):
+
+    def test_votes(self):
+        identities = np.array(["b", "a", "a", "c"], dtype=object)
+        self.assertEqual(best_match(identities, [True, True, True, False]), "a")
+        self.assertIsNone(best_match(identities, [False] * 4))
+
+    def test_ties_go_to_closest(self):
+        # candidates come closest first
+        identities = np.array(["b", "a", "a", "b"], dtype=object)
+        self.assertEqual(best_match(identities, [True] * 4), "b")
+
+
+class TestIndexRegistry(TestCase):
+
+    def setUp(self) -> None:
+        use_temp_embedding_store(self)
+
+    def test_matches_box_query(self):
+        # index and a box filter over stored vectors should find the same public images
+        embeddings = get_test_embeddings()
+        for each_vector in embeddings:
+            record = ImageRecord.objects.create()
+            record.vector = each_vector
+            record.save()
+
+        found = nearest(embeddings[-1])
+        expected = [
+            each.id for each in ImageRecord.objects.all()
+            if np.abs(each.vector - embeddings[-1]).max() <= settings.SPACIAL_QUERY_DIST
+        ]
+        self.assertSetEqual(set(found), set(expected))
+        self.assertSetEqual(set(ImageRecord.vector_queryset(embeddings[-1]).values_list("id", flat=True)), set(expected))
+
+    def test_kept_up_to_date(self):
+        d_set = DataSet.objects.create()
+        embeddings = get_test_embeddings()
+
+        # load index while data set is still empty
+        self.assertListEqual(nearest(embeddings[1], data_set_id=d_set.id), [])
+
+        # saving a record adds it
+        record = ImageRecord.objects.create(data_set=d_set)
+        record.vector = embeddings[1]
+        record.save()
+        self.assertListEqual(nearest(embeddings[1], data_set_id=d_set.id), [str(record.id)])
+
+        # other data sets don't see it
+        self.assertListEqual(nearest(embeddings[1], data_set_id=DataSet.objects.create().id), [])
+
+        # deleting a record removes it
+        record.delete()
+        self.assertListEqual(nearest(embeddings[1], data_set_id=d_set.id), [])
+
+    def test_sees_other_processes(self):
+        d_set = DataSet.objects.create()
+        embeddings = get_test_embeddings()
+        self.assertListEqual(nearest(embeddings[1], data_set_id=d_set.id), [])
+
+        # saved by another worker: rows without signals here, appended through a store object of its own
+        record = ImageRecord(data_set=d_set, vector=embeddings[1])
+        ImageRecord.objects.bulk_create([record])
+        EmbeddingStore(str(d_set.id)).put(record.id, embeddings[1])
+        self.assertListEqual(nearest(embeddings[1], data_set_id=d_set.id), [str(record.id)])
+
+        # store rebuilt elsewhere, e.g. by manage.py reindex
+        EmbeddingStore(str(d_set.id)).rebuild([(record.id, embeddings[0])])
+        self.assertListEqual(nearest(embeddings[1], data_set_id=d_set.id), [])
+        self.assertListEqual(nearest(embeddings[0], data_set_id=d_set.id), [str(record.id)])
+
+    @override_settings(EMBEDDING_STORE_ENABLED=False, VECTOR_INDEX_RECHECK_INTERVAL=60.)
+    def test_sees_other_processes_without_store(self):
+        d_set = DataSet.objects.create()
+        embeddings = get_test_embeddings()
+        self.assertListEqual(nearest(embeddings[1], data_set_id=d_set.id), [])
+
+        record = ImageRecord(data_set=d_set, vector=embeddings[1])
+        ImageRecord.objects.bulk_create([record])
+        # not counted again until the interval is up
+        with self.assertNumQueries(0):
+            self.assertListEqual(nearest(embeddings[1], data_set_id=d_set.id), [])
+        get_index(d_set.id).checked -= 60.
+        self.assertListEqual(nearest(embeddings[1], data_set_id=d_set.id), [str(record.id)])
+
+        # this process's own saves don't cause a reload
+        ImageRecord(data_set=d_set, vector=embeddings[2]).save()
+        index = get_index(d_set.id)
+        self.assertIs(get_index(d_set.id), index)
+
+
+class TestVectorQueryset(TestCase):
+    # runs on whichever backend vector_queryset picks for the test database
+
+    def setUp(self) -> None:
+        use_temp_embedding_store(self)
+        rng = np.random.default_rng(0)
+        self.vectors = rng.normal(scale=10., size=(200, settings.EMBEDDING_DIM)).astype(np.float32)
+        self.ids = []
+        for each_vector in self.vectors:
+            record = ImageRecord(vector=each_vector)
+            record.save()
+            self.ids.append(str(record.id))
+
+    def test_k_closest_first(self):
+        query = self.vectors[0] + .5
+        distances = np.abs(self.vectors - query).max(axis=1)
+        expected = [self.ids[i] for i in np.argsort(distances, kind="stable")[:5]]
+        found = [str(each) for each in ImageRecord.vector_queryset(query, k=5).values_list("id", flat=True)]
+        self.assertListEqual(found, expected)
+
+
+class TestCubeDimensions(TestCase):
+
+    @override_settings(VECTOR_CUBE_ENABLED=True)
+    def test_falls_back_over_max_dim(self):
+        with mock.patch("id_service.pg_cube.connection", mock.Mock(vendor="postgresql")):
+            self.assertTrue(pg_cube.enabled())
+            self.assertListEqual(pg_cube.check_dimensions(None), [])
+
+            with self.settings(EMBEDDING_DIM=pg_cube.MAX_DIM + 1):
+                self.assertFalse(pg_cube.enabled())
+                self.assertEqual(pg_cube.check_dimensions(None)[0].id, "id_service.W001")
+
+
+@skipUnless(connection.vendor == "postgresql", "cube queries need postgres")
+class TestCubeQueries(TestCase):
+
+    def setUp(self) -> None:
+        use_temp_embedding_store(self)
+        self.d_set = DataSet.objects.create()
+        rng = np.random.default_rng(1)
+        self.vectors = rng.normal(scale=20., size=(500, settings.EMBEDDING_DIM)).astype(np.float32)
+        ids = []
+        for each_vector in self.vectors:
+            record = ImageRecord(data_set=self.d_set, vector=each_vector)
+            record.save()
+            ids.append(str(record.id))
+        self.in_process = KDTreeIndex(ids, self.vectors)
+
+    def test_unpacked_exactly(self):
+        record = ImageRecord.objects.filter(data_set=self.d_set).first()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT {pg_cube.UNPACK_FUNCTION}(embedding)::text FROM id_service_imagerecord WHERE id = %s", [record.id])
+            coords = [float(each) for each in cursor.fetchone()[0].strip("()").split(",")]
+        np.testing.assert_array_equal(np.array(coords, dtype=np.float32), record.vector)
+
+    def test_matches_in_process_index(self):
+        for query in self.vectors[:20]:
+            found = ImageRecord.vector_queryset(query, 10., data_set_id=self.d_set.id, k=8)
+            expected = self.in_process.query(query, 10., 8)
+            # ties may come in either order
+            self.assertSetEqual({str(each) for each in found.values_list("id", flat=True)}, set(expected))
+
+    def test_other_sets_left_out(self):
+        ImageRecord(data_set=DataSet.objects.create(), vector=self.vectors[0]).save()
+        ImageRecord(vector=self.vectors[0]).save()
+        found = ImageRecord.vector_queryset(self.vectors[0], 1., data_set_id=self.d_set.id)
+        self.assertEqual(found.count(), 1)
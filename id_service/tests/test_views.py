@@ -1,9 +1,21 @@
-from django.test import TestCase, Client
+from django.test import TestCase, Client, RequestFactory, override_settings
 from django.urls import reverse
+from asgiref.sync import async_to_sync
 
+import asyncio
+from unittest import mock
+from contextlib import contextmanager
+from io import BytesIO
+import json
+import os
+import zipfile
+import numpy as np
 
-from .__init__ import get_fake_image_file, get_test_embeddings
-from ..models import DataSet, ImageRecord, AnimalRecord, APIToken, settings
+from .__init__ import get_fake_image_file, get_test_embeddings, use_temp_embedding_store, use_temp_media, UploadTestMixin
+from ..models import DataSet, ImageRecord, AnimalRecord, APIToken, UploadJob, settings
+from .. import identity_lock, jobs
+from ..async_views import AsyncImageView
+from ..views import ImageView
 
 class DBSetUpMixin:
     @classmethod
@@ -38,6 +50,9 @@ class TestEndPoints(DBSetUpMixin, TestCase):
 
 
     def setUp(self) -> None:
+        use_temp_embedding_store(self)
+        use_temp_media(self)
+
         # make a key
         key = APIToken.objects.create()
         key.read_set.add(self.d_set)
@@ -88,12 +103,38 @@ class TestEndPoints(DBSetUpMixin, TestCase):
         # test viewing all animals in d_set
         response = self.client.get(reverse("data_set_endpoint",kwargs={"pk":str(self.d_set.id),"rel":"animals"}))
         self.assertEqual(response.status_code, 200)
-        self.assertListEqual(response.json()["animals"],self.known_animals)
+        # related lists come ordered by id, so pages can pick up where the last left off
+        self.assertListEqual(response.json()["animals"],sorted(self.known_animals))
 
         # test viewing all images in d_set
         response = self.client.get(reverse("data_set_endpoint",kwargs={"pk":str(self.d_set.id),"rel":"images"}))
         self.assertEqual(response.status_code, 200)
-        self.assertListEqual(response.json()["images"],self.known_images[100:])
+        self.assertListEqual(response.json()["images"],sorted(self.known_images[100:]))
+
+        # test paging through images in d_set
+        pages, after = [], None
+        while True:
+            response = self.client.get(
+                reverse("data_set_endpoint",kwargs={"pk":str(self.d_set.id),"rel":"images"}),
+                {"limit": 15, **({"after": after} if after else {})}
+            )
+            self.assertEqual(response.status_code, 200)
+            pages.append(response.json()["images"])
+            after = response.json()["next"]["images"]
+            if after is None:
+                break
+        self.assertListEqual([len(each) for each in pages], [15, 15, 15, 5])
+        self.assertListEqual(sum(pages, []), sorted(self.known_images[100:]))
+
+        # test streaming all images in d_set, a few ids at a time
+        with override_settings(RELATED_STREAM_CHUNK_SIZE=7):
+            response = self.client.get(
+                reverse("data_set_endpoint",kwargs={"pk":str(self.d_set.id),"rel":"images"}), {"stream": 1})
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            streamed = json.loads(b"".join(response.streaming_content))
+        self.assertEqual(streamed["id"], str(self.d_set.id))
+        self.assertListEqual(streamed["images"], sorted(self.known_images[100:]))
 
         # test delete private d_set
         response = self.client.delete(reverse("data_set_endpoint",kwargs={"pk":str(self.d_set.id)}))
@@ -102,9 +143,74 @@ class TestEndPoints(DBSetUpMixin, TestCase):
         self.assertEqual(len(ImageRecord.objects.all()),100)
 
 
+class TestExport(TestCase):
+
+    def setUp(self) -> None:
+        use_temp_embedding_store(self)
+        use_temp_media(self)
+
+        self.d_set = DataSet.objects.create()
+        key = APIToken.objects.create(write_set=self.d_set)
+        key.read_set.add(self.d_set)
+        self.client = Client(HTTP_X_API_KEY=key.id)
+
+        animal = AnimalRecord.objects.create(data_set=self.d_set)
+        self.images = {}
+        for i in range(25):
+            img = ImageRecord(data_set=self.d_set, identity=animal if i % 2 else None)
+            img.vector = (i, i + .5, -i, 0.)
+            img.save()
+            self.images[str(img.id)] = img
+        # one without a vector yet
+        img = ImageRecord.objects.create(data_set=self.d_set)
+        self.images[str(img.id)] = img
+        # and some in other sets
+        ImageRecord.objects.create()
+        ImageRecord.objects.create(data_set=DataSet.objects.create())
+
+    @override_settings(EXPORT_CHUNK_SIZE=4)
+    def test_export(self):
+        response = self.client.get(reverse("data_set_export_endpoint", kwargs={"pk": str(self.d_set.id)}))
+        self.assertEqual(response.status_code, 200)
+        content = b"".join(response.streaming_content)
+        self.assertEqual(int(response["Content-Length"]), len(content))
+
+        exported = np.load(BytesIO(content))
+        self.assertEqual(len(exported), len(self.images))
+        self.assertListEqual(exported["id"].astype(str).tolist(), sorted(self.images))
+        for row in exported:
+            img = self.images[row["id"].decode()]
+            self.assertEqual(row["identity"].decode(), str(img.identity_id or ""))
+            if img.vector is None:
+                self.assertTrue(np.isnan(row["vector"]).all())
+            else:
+                np.testing.assert_allclose(row["vector"], img.vector)
+
+    def test_export_rows_deleted_midway(self):
+        response = self.client.get(reverse("data_set_export_endpoint", kwargs={"pk": str(self.d_set.id)}))
+        ImageRecord.objects.filter(id__in=list(self.images)[:3]).delete()
+        exported = np.load(BytesIO(b"".join(response.streaming_content)))
+
+        # still a valid file, with the missing rows padded out
+        self.assertEqual(len(exported), len(self.images))
+        self.assertEqual((exported["id"] == b"").sum(), 3)
+
+    def test_export_access(self):
+        # only readable sets
+        other = DataSet.objects.create()
+        response = self.client.get(reverse("data_set_export_endpoint", kwargs={"pk": str(other.id)}))
+        self.assertEqual(response.status_code, 404)
+
+        response = self.client.post(reverse("data_set_export_endpoint", kwargs={"pk": "new"}))
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(DataSet.objects.count(), 3)
+
+
 class TestImageProcessing(DBSetUpMixin, TestCase):
 
     def setUp(self) -> None:
+        use_temp_embedding_store(self)
+        use_temp_media(self)
 
         # make a new token and d_set
         d_set = DataSet.objects.create()
@@ -130,3 +236,409 @@ class TestImageProcessing(DBSetUpMixin, TestCase):
             # check if an identity has been created and linked
             found = AnimalRecord.objects.get(id=response.json()['identity'])
             self.assertTrue(isinstance(found, AnimalRecord))
+
+
+class TestBatchUpload(UploadTestMixin, TestCase):
+    # tf-serving calls are mocked here, so this runs without the model containers
+
+    def test_batch_upload(self):
+        # upload two plain images and a zip with two more
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, "w") as zipped:
+            for i in (3, 4):
+                zipped.write(settings.BASE_DIR.joinpath(f"id_service/static/id_service/test_cat_{i}.png"), f"cat_{i}.png")
+        archive.seek(0)
+        archive.name = "cats.zip"
+
+        files = [open(settings.BASE_DIR.joinpath(f"id_service/static/id_service/test_cat_{i}.png"), "rb") for i in (1, 2)]
+        with self.settings(ENCODER_BATCH_SIZE=3):
+            response = self.client.post(
+                reverse("image_batch_endpoint"),
+                {"data_set": str(self.d_set.id), "image_file": files + [archive]},
+            )
+        for each in files:
+            each.close()
+
+        self.assertEqual(response.status_code, 200)
+        results = response.json()
+        self.assertEqual(len(results), 4)
+
+        # 4 images in chunks of 3 => 2 encoder calls
+        self.assertEqual(self.encoder.call_count, 2)
+
+        # every image is stored, all were matched to the identity made for the first one
+        for each in results:
+            found = ImageRecord.objects.get(id=each["id"])
+            self.assertEqual(str(found.data_set_id), str(self.d_set.id))
+            self.assertEqual(each["identity"], results[0]["identity"])
+
+    def test_archive_extras_skipped(self):
+        # what zip tools on macOS and elsewhere put next to the images
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, "w") as zipped:
+            zipped.writestr("cats/", b"")
+            for i in (1, 2, 3):
+                path = settings.BASE_DIR.joinpath(f"id_service/static/id_service/test_cat_{i}.png")
+                zipped.write(path, f"cats/cat_{i}.png")
+                zipped.write(path, f"__MACOSX/cats/._cat_{i}.png")
+            zipped.writestr("cats/.DS_Store", b"\0" * 64)
+            zipped.writestr("cats/notes.txt", b"three cats")
+        archive.seek(0)
+        archive.name = "cats.zip"
+
+        chunk_sizes = []
+        from ..preprocessing import preprocess
+
+        def record_preprocess(image_files):
+            chunk_sizes.append(len(image_files))
+            return preprocess(image_files)
+
+        with mock.patch("id_service.views.preprocess", side_effect=record_preprocess), \
+                self.settings(ENCODER_BATCH_SIZE=2):
+            response = self.client.post(reverse("image_batch_endpoint"), {"image_file": archive})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 3)
+        # decoded a chunk at a time, not all at once
+        self.assertListEqual(chunk_sizes, [2, 1])
+        self.assertEqual(self.encoder.call_count, 2)
+
+    def cat_archive(self, count):
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, "w") as zipped:
+            for i in range(count):
+                zipped.write(settings.BASE_DIR.joinpath(f"id_service/static/id_service/test_cat_{i % 4 + 1}.png"), f"cat_{i}.png")
+        archive.seek(0)
+        archive.name = "cats.zip"
+        return archive
+
+    def test_archive_read_once(self):
+        # members are streamed, never read whole into memory to be checked
+        with mock.patch.object(zipfile.ZipFile, "read", side_effect=AssertionError("read whole")):
+            response = self.client.post(reverse("image_batch_endpoint"), {"image_file": self.cat_archive(2)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 2)
+
+    def test_archive_limits(self):
+        with self.settings(BATCH_MAX_ARCHIVE_MEMBERS=2):
+            response = self.client.post(reverse("image_batch_endpoint"), {"image_file": self.cat_archive(3)})
+        self.assertEqual(response.status_code, 413)
+
+        with self.settings(BATCH_MAX_MEMBER_SIZE=1024):
+            response = self.client.post(reverse("image_batch_endpoint"), {"image_file": self.cat_archive(1)})
+        self.assertEqual(response.status_code, 413)
+        self.encoder.assert_not_called()
+        self.assertEqual(ImageRecord.objects.count(), 0)
+
+    def test_differ_gets_closest_only(self):
+        # lots of near identical images from two animals already in the set
+        embeddings = get_test_embeddings()
+        animals = [AnimalRecord.objects.create(data_set=self.d_set) for i in range(2)]
+        for i in range(40):
+            record = ImageRecord.objects.create(data_set=self.d_set, identity=animals[i % 2])
+            record.vector = np.array(embeddings[1]) + i * 0.01
+            record.save()
+
+        with open(settings.BASE_DIR.joinpath("id_service/static/id_service/test_cat_1.png"), "rb") as f, \
+                self.settings(DIFFERENTIATOR_TOP_K=5):
+            response = self.client.post(
+                reverse("image_batch_endpoint"), {"data_set": str(self.d_set.id), "image_file": f},
+            )
+        self.assertEqual(response.status_code, 200)
+
+        # only the top 5 went to differentiator, the closest ones are 0, 1 ,2, 3, 4 => 3 votes for animal 0
+        left, right = self.differ.call_args[0]
+        self.assertEqual(len(left), 5)
+        self.assertEqual(response.json()[0]["identity"], str(animals[0].id))
+
+    def test_prototype_matching(self):
+        # same set up as above, but candidates are one centroid per animal
+        embeddings = get_test_embeddings()
+        animals = [AnimalRecord.objects.create(data_set=self.d_set) for i in range(2)]
+        for i in range(40):
+            record = ImageRecord.objects.create(data_set=self.d_set, identity=animals[i % 2])
+            record.vector = np.array(embeddings[1]) + i * 0.01
+            record.save()
+
+        with open(settings.BASE_DIR.joinpath("id_service/static/id_service/test_cat_1.png"), "rb") as f, \
+                self.settings(IDENTITY_MATCHING="prototype"):
+            response = self.client.post(
+                reverse("image_batch_endpoint"), {"data_set": str(self.d_set.id), "image_file": f},
+            )
+        self.assertEqual(response.status_code, 200)
+
+        # both animals are the same as far as the mock is concerned, the closer centroid wins
+        left, right = self.differ.call_args[0]
+        self.assertEqual(len(left), 2)
+        self.assertEqual(response.json()[0]["identity"], str(animals[0].id))
+
+    def test_bad_batch(self):
+        # nothing uploaded
+        response = self.client.post(reverse("image_batch_endpoint"))
+        self.assertEqual(response.status_code, 400)
+
+        # not an image
+        response = self.client.post(reverse("image_batch_endpoint"), {"image_file": BytesIO(b"not an image")})
+        self.assertEqual(response.status_code, 400)
+
+
+class TestUploadCache(UploadTestMixin, TestCase):
+    # tf-serving calls are mocked, duplicate uploads shouldn't reach them
+
+    def upload(self, i=1, **data):
+        with open(settings.BASE_DIR.joinpath(f"id_service/static/id_service/test_cat_{i}.png"), "rb") as f:
+            response = self.client.post(reverse("image_endpoint", kwargs={"pk": "new"}), {"image_file": f, **data})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_duplicate_upload(self):
+        first = self.upload()
+        self.assertEqual(self.encoder.call_count, 1)
+
+        second = self.upload()
+        # new record, but file, embedding and identity are reused without inference
+        self.assertEqual(self.encoder.call_count, 1)
+        self.assertNotEqual(first["id"], second["id"])
+        self.assertEqual(first["image_file"], second["image_file"])
+        self.assertEqual(first["identity"], second["identity"])
+        np.testing.assert_array_equal(
+            ImageRecord.objects.get(id=first["id"]).vector, ImageRecord.objects.get(id=second["id"]).vector)
+
+        # other images still go through the encoder
+        self.upload(2)
+        self.assertEqual(self.encoder.call_count, 2)
+
+    def test_deleted_identity(self):
+        first = self.upload()
+        AnimalRecord.objects.filter(id=first["identity"]).delete()
+
+        # embedding is reused, identity is matched again
+        second = self.upload()
+        self.assertEqual(self.encoder.call_count, 1)
+        self.assertIsNotNone(second["identity"])
+        self.assertNotEqual(first["identity"], second["identity"])
+
+    def test_scoped_to_data_set(self):
+        first = self.upload()
+        second = self.upload(data_set=str(self.d_set.id))
+        self.assertEqual(self.encoder.call_count, 2)
+        self.assertNotEqual(first["identity"], second["identity"])
+
+
+class TestConcurrentIdentity(TestCase):
+    # two uploads of a new animal matched at the same time, before either is saved
+
+    def setUp(self) -> None:
+        use_temp_embedding_store(self)
+        use_temp_media(self)
+        self.d_set = DataSet.objects.create()
+        self.token = APIToken.objects.create(write_set=self.d_set)
+        self.vector = get_test_embeddings()[1]
+        self.differ = mock.patch(
+            "id_service.views.call_differenciator",
+            side_effect=lambda left, right: [True for each in left],
+        ).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def matched_view(self, vector):
+        view = ImageView()
+        view.token, view.object = self.token, ImageRecord(data_set=self.d_set)
+        view.object.vector = vector
+        # past check_token, rate limits aren't under test
+        view.object.identity = ImageView.get_identity.__wrapped__(view, vector)
+        return view
+
+    def test_same_new_animal(self):
+        first, second = self.matched_view(self.vector), self.matched_view(self.vector)
+        # neither found anything to match
+        self.differ.assert_not_called()
+
+        first.save_object()
+        second.save_object()
+        # second checks the animal first made meanwhile, and joins it
+        self.assertEqual(self.differ.call_count, 1)
+        self.assertEqual(AnimalRecord.objects.count(), 1)
+        self.assertEqual(str(first.object.identity_id), second.object.identity_id)
+        self.assertEqual(ImageRecord.objects.filter(identity_id=first.object.identity_id).count(), 2)
+
+    def test_different_new_animals(self):
+        self.differ.side_effect = lambda left, right: [False for each in left]
+        first, second = self.matched_view(self.vector), self.matched_view(self.vector)
+        first.save_object()
+        second.save_object()
+        self.assertEqual(AnimalRecord.objects.count(), 2)
+        self.assertNotEqual(first.object.identity_id, second.object.identity_id)
+
+    def test_checked_outside_lock(self):
+        held, calls = [], []
+        hold = identity_lock.hold
+
+        @contextmanager
+        def tracked_hold(data_set_id):
+            with hold(data_set_id):
+                held.append(True)
+                try:
+                    yield
+                finally:
+                    held.pop()
+
+        def differ(left, right):
+            calls.append((len(left), bool(held)))
+            if len(calls) == 1:
+                # third makes its animal while second is in the differentiator
+                third.save_object()
+            return [False for each in left]
+
+        first, second, third = [self.matched_view(self.vector) for i in range(3)]
+        first.save_object()
+        self.differ.side_effect = differ
+        with mock.patch("id_service.views.identity_lock.hold", tracked_hold):
+            second.save_object()
+
+        # first's animal is checked unlocked by both, under the lock second only checks third's
+        self.assertListEqual(calls, [(1, False), (1, False), (1, True)])
+        self.assertEqual(AnimalRecord.objects.count(), 3)
+
+    def test_far_new_animals(self):
+        first, second = self.matched_view(self.vector), self.matched_view(np.asarray(self.vector) + 2 * settings.SPACIAL_QUERY_DIST)
+        first.save_object()
+        second.save_object()
+        # too far apart to be checked at all
+        self.differ.assert_not_called()
+        self.assertEqual(AnimalRecord.objects.count(), 2)
+
+
+@override_settings(ASYNC_UPLOADS=True, UPLOAD_JOB_WORKERS=0, UPLOAD_CACHE_ENABLED=False)
+class TestQueuedUploads(UploadTestMixin, TestCase):
+    # jobs are run on the test thread with jobs.run_pending, tf-serving calls are mocked
+
+    def upload(self):
+        with open(settings.BASE_DIR.joinpath("id_service/static/id_service/test_cat_1.png"), "rb") as f:
+            response = self.client.post(reverse("image_endpoint", kwargs={"pk": "new"}), {"image_file": f})
+        self.assertEqual(response.status_code, 202)
+        return response
+
+    def test_upload_is_queued(self):
+        response = self.upload()
+        job = response.json()
+        self.assertEqual(job["status"], "queued")
+        self.assertEqual(response["Location"], reverse("job_endpoint", kwargs={"pk": job["id"]}))
+        # nothing is run before the response
+        self.encoder.assert_not_called()
+        image = ImageRecord.objects.get(id=job["image"])
+        self.assertIsNone(image.vector)
+        self.assertIsNone(image.identity_id)
+
+        self.assertEqual(self.client.get(response["Location"]).json()["status"], "queued")
+
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(self.encoder.call_count, 1)
+        polled = self.client.get(response["Location"]).json()
+        self.assertEqual(polled["status"], "done")
+        self.assertEqual(polled["image"], job["image"])
+
+        image = ImageRecord.objects.get(id=job["image"])
+        self.assertIsNotNone(image.vector)
+        self.assertIsNotNone(image.identity_id)
+        self.assertTrue(image.image_file)
+        self.assertFalse(UploadJob.objects.get(id=job["id"]).raw_file)
+
+        # jobs run once
+        self.assertEqual(jobs.run_pending(), 0)
+
+    def test_failed_job(self):
+        job = self.upload().json()
+        working, self.encoder.side_effect = self.encoder.side_effect, ConnectionError("model server down")
+        jobs.run_pending()
+        polled = self.client.get(reverse("job_endpoint", kwargs={"pk": job["id"]})).json()
+        self.assertEqual(polled["status"], "failed")
+        self.assertIn("model server down", polled["error"])
+
+        # raw upload is kept, so it can be retried
+        self.encoder.side_effect = working
+        self.assertEqual(jobs.requeue(failed=True), 1)
+        jobs.run_pending()
+        self.assertEqual(UploadJob.objects.get(id=job["id"]).status, UploadJob.DONE)
+
+    def test_failed_job_leaves_no_image(self):
+        job = self.upload().json()
+        with mock.patch.object(ImageView, "get_candidates", side_effect=ConnectionError("db gone")):
+            jobs.run_pending()
+        self.assertEqual(UploadJob.objects.get(id=job["id"]).status, UploadJob.FAILED)
+
+        # the image stored before matching failed is gone again
+        stored = os.path.join(settings.MEDIA_ROOT, "images")
+        self.assertListEqual(os.listdir(stored) if os.path.isdir(stored) else [], [])
+
+    def test_token_deleted(self):
+        with open(settings.BASE_DIR.joinpath("id_service/static/id_service/test_cat_1.png"), "rb") as f:
+            job = self.client.post(
+                reverse("image_endpoint", kwargs={"pk": "new"}), {"image_file": f, "data_set": str(self.d_set.id)}).json()
+        APIToken.objects.all().delete()
+        self.assertEqual(jobs.run_pending(), 1)
+
+        self.assertEqual(UploadJob.objects.get(id=job["id"]).status, UploadJob.DONE)
+        image = ImageRecord.objects.get(id=job["image"])
+        # the new animal goes into the job's data set
+        self.assertEqual(str(image.identity.data_set_id), str(self.d_set.id))
+
+    @override_settings(UPLOAD_JOB_POLL_INTERVAL=0.01)
+    def test_long_poll_times_out(self):
+        job = self.upload().json()
+        response = self.client.get(reverse("job_endpoint", kwargs={"pk": job["id"]}), {"wait": "0.05"})
+        self.assertEqual(response.json()["status"], "queued")
+
+    def test_jobs_are_read_only(self):
+        self.assertEqual(self.client.post(reverse("job_endpoint", kwargs={"pk": "new"})).status_code, 405)
+        self.assertEqual(UploadJob.objects.count(), 0)
+
+
+class TestAsyncImageView(UploadTestMixin, TestCase):
+    # runs the async view directly on a request factory request, tf-serving calls are mocked
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.view = async_to_sync(AsyncImageView.as_view())
+
+    def post(self, pk, data):
+        request = RequestFactory().post(f"/image/{pk}", data, HTTP_X_API_KEY=self.token.id)
+        return self.view(request, pk=pk)
+
+    def test_upload(self):
+        identities = []
+        for i in (1, 2):
+            with open(settings.BASE_DIR.joinpath(f"id_service/static/id_service/test_cat_{i}.png"), "rb") as f:
+                response = self.post("new", {"data_set": str(self.d_set.id), "image_file": f})
+            self.assertEqual(response.status_code, 200)
+            found = ImageRecord.objects.get(id=json.loads(response.content)["id"])
+            self.assertIsNotNone(found.image_file)
+            identities.append(found.identity_id)
+
+        # second image matched the animal made for the first
+        self.assertEqual(identities[0], identities[1])
+
+    def test_charged_off_the_loop(self):
+        on_loop = []
+
+        def charge(*args, **kwargs):
+            try:
+                asyncio.get_running_loop()
+                on_loop.append(True)
+            except RuntimeError:
+                on_loop.append(False)
+
+        with mock.patch("id_service.views.charge", side_effect=charge), \
+                open(settings.BASE_DIR.joinpath("id_service/static/id_service/test_cat_1.png"), "rb") as f:
+            self.assertEqual(self.post("new", {"data_set": str(self.d_set.id), "image_file": f}).status_code, 200)
+        # post, process_image and get_identity, all in a thread
+        self.assertListEqual(on_loop, [False, False, False])
+
+    def test_sync_handlers(self):
+        # get and delete come from UnifiedBase and run in a thread
+        record = ImageRecord.objects.create(data_set=self.d_set)
+        request = RequestFactory().get(f"/image/{record.id}", HTTP_X_API_KEY=self.token.id)
+        response = self.view(request, pk=str(record.id))
+        self.assertEqual(json.loads(response.content)["id"], str(record.id))
+
+        request = RequestFactory().delete(f"/image/{record.id}", HTTP_X_API_KEY=self.token.id)
+        self.assertEqual(self.view(request, pk=str(record.id)).status_code, 200)
+        self.assertFalse(ImageRecord.objects.filter(id=record.id).exists())
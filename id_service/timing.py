@@ -0,0 +1,156 @@
+"""
+Per request timings of the upload pipeline
+stages (decoding, the encoder, proximity queries, the differentiator, saves, ...) are timed with stage() or @timed,
+and things like candidate counts are noted with count(). TimingMiddleware gathers what the current request
+recorded into a Server-Timing header, which browser dev tools show next to the request.
+every value also goes into an in-memory histogram per name, kept per process, see snapshot() and z/timings
+
+work outside a request (upload jobs, management commands) only goes into the histograms.
+stages run in the preprocessing pool's worker processes aren't seen, preprocess as a whole is timed instead.
+durations are wall clock, time spent waiting on a busy model server or a db lock counts
+"""
+import asyncio
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+
+
+class RequestTimings:
+    """durations (ms, summed per stage) and counts recorded during one request"""
+
+    def __init__(self):
+        self.durations = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, duration):
+        with self._lock:
+            self.durations[name] = self.durations.get(name, 0.) + duration
+
+    def count(self, name, value):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def header(self):
+        """Server-Timing header value, stages in the order they were first seen"""
+        with self._lock:
+            metrics = [f"{name};dur={duration:.1f}" for name, duration in self.durations.items()]
+            metrics += [f'{name};desc="{value}"' for name, value in self.counts.items()]
+        return ", ".join(metrics)
+
+
+class Histogram:
+    """counts of values falling at or under each bound, the last bucket is everything above"""
+
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.
+
+    def observe(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "buckets": [[bound, each] for bound, each in zip(self.bounds + ["+Inf"], self.buckets)],
+        }
+
+
+_current = ContextVar("id_service_request_timings", default=None)
+_durations = {}
+_counts = {}
+_histogram_lock = threading.Lock()
+
+
+def _observe(histograms, bounds, name, value):
+    with _histogram_lock:
+        try:
+            histogram = histograms[name]
+        except KeyError:
+            histogram = histograms[name] = Histogram(bounds)
+        histogram.observe(value)
+
+
+def start_request():
+    """starts recording for the current request, returns the recorder and a token for end_request"""
+    recorder = RequestTimings()
+    return recorder, _current.set(recorder)
+
+
+def end_request(token):
+    _current.reset(token)
+
+
+def record(name, duration):
+    """adds duration (ms) of stage name"""
+    recorder = _current.get()
+    if recorder is not None:
+        recorder.add(name, duration)
+    _observe(_durations, settings.TIMING_HISTOGRAM_BUCKETS, name, duration)
+
+
+def count(name, value):
+    """notes a count, e.g. candidates found, for the current request"""
+    if not settings.TIMING_ENABLED:
+        return
+    recorder = _current.get()
+    if recorder is not None:
+        recorder.count(name, value)
+    _observe(_counts, settings.TIMING_COUNT_BUCKETS, name, value)
+
+
+@contextmanager
+def stage(name):
+    """times the block as stage name"""
+    if not settings.TIMING_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, (time.perf_counter() - start) * 1000)
+
+
+def timed(name):
+    """decorator, times every call of a function or coroutine function as stage name"""
+    def __decorator(decoratee):
+
+        @wraps(decoratee)
+        def __inner(*args, **kwargs):
+            with stage(name):
+                return decoratee(*args, **kwargs)
+
+        @wraps(decoratee)
+        async def __async_inner(*args, **kwargs):
+            with stage(name):
+                return await decoratee(*args, **kwargs)
+
+        return __async_inner if asyncio.iscoroutinefunction(decoratee) else __inner
+
+    return __decorator
+
+
+def snapshot():
+    """histograms of this process, durations in ms"""
+    with _histogram_lock:
+        return {
+            "durations": {name: each.as_dict() for name, each in _durations.items()},
+            "counts": {name: each.as_dict() for name, each in _counts.items()},
+        }
+
+
+def reset():
+    with _histogram_lock:
+        _durations.clear()
+        _counts.clear()
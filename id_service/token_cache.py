@@ -0,0 +1,110 @@
+"""
+Token state cache and batched action counters
+tokens are read through django's cache (TOKEN_CACHE_ALIAS) for TOKEN_CACHE_TTL seconds,
+APIToken save / delete / read_set changes drop the cached copy, see signals.py
+
+action counters are kept in process memory and written back with one F() update per token
+at most every TOKEN_FLUSH_INTERVAL seconds, checked once each response has been sent (request_finished, see signals.py),
+so the request hot path doesn't write the token row.
+pending counts are added onto tokens handed out by get_token, so usage counts are up to date.
+what's still pending when the process exits is flushed then, unless TOKEN_FLUSH_ON_EXIT is off
+"""
+import atexit
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import F
+
+from .models import APIToken
+
+
+def _cache():
+    return caches[settings.TOKEN_CACHE_ALIAS]
+
+
+def _key(token_id):
+    return f"id_service:api_token:{token_id}"
+
+
+def get_token(token_id) -> APIToken:
+    """returns token with pending action counts applied, raises APIToken.DoesNotExist like objects.get"""
+    if token_id is None:
+        raise APIToken.DoesNotExist
+
+    token = _cache().get(_key(token_id))
+    if token is None:
+        token = APIToken.objects.get(id=token_id)
+        _cache().set(_key(token_id), token, settings.TOKEN_CACHE_TTL)
+
+    actions, expensive_actions = counters.pending(token.id)
+    token.actions += actions
+    token.expensive_actions += expensive_actions
+    return token
+
+
+def invalidate(token_id):
+    _cache().delete(_key(token_id))
+
+
+class CounterStore:
+    """in-memory action counts per token, waiting to be flushed to db"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = defaultdict(lambda: [0, 0])  # <= token id => [actions, expensive actions]
+        self._last_flush = time.monotonic()
+
+    def record(self, token, expensive=False, count=1):
+        """count one action (or count actions) for token, also updates the token instance itself"""
+        with self._lock:
+            self._counts[str(token.id)][1 if expensive else 0] += count
+        if expensive:
+            token.expensive_actions += count
+        else:
+            token.actions += count
+
+    def pending(self, token_id):
+        with self._lock:
+            counts = self._counts.get(str(token_id))
+            return tuple(counts) if counts else (0, 0)
+
+    def maybe_flush(self):
+        """flush if TOKEN_FLUSH_INTERVAL has passed since the last one"""
+        if time.monotonic() - self._last_flush >= settings.TOKEN_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            to_flush, self._counts = self._counts, defaultdict(lambda: [0, 0])
+            self._last_flush = time.monotonic()
+        if len(to_flush) == 0:
+            # don't touch the db for nothing
+            return
+
+        for token_id, (actions, expensive_actions) in to_flush.items():
+            APIToken.objects.filter(id=token_id).update(
+                actions=F("actions") + actions,
+                expensive_actions=F("expensive_actions") + expensive_actions,
+            )
+            # cached copy doesn't have the flushed counts, and they aren't pending anymore
+            invalidate(token_id)
+
+
+counters = CounterStore()
+
+
+def _flush_on_exit():
+    # read at exit, so tests can turn it off after this module was imported
+    if not settings.TOKEN_FLUSH_ON_EXIT:
+        return
+    try:
+        counters.flush()
+    except Exception:
+        # db may be gone already, counts are lost but that's only rate limiting state
+        pass
+
+
+atexit.register(_flush_on_exit)
@@ -0,0 +1,62 @@
+"""
+Content addressed cache of upload results
+retried / re-synced uploads of the same photo are common, the raw bytes are hashed (blake2b) and looked up
+in django's cache (UPLOAD_CACHE_ALIAS) before any decoding. a hit hands back the stored image file,
+embedding and identity of the earlier upload, so preprocessing, the encoder and the differentiator are skipped.
+
+entries are scoped to a data set, so identities never leak between sets, and expire after UPLOAD_CACHE_TTL.
+eviction is whatever the cache backend does, LocMemCache is LRU up to its MAX_ENTRIES,
+point UPLOAD_CACHE_ALIAS at a shared backend (memcached, redis) to dedup across processes
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import AnimalRecord
+
+
+def _cache():
+    return caches[settings.UPLOAD_CACHE_ALIAS]
+
+
+def _key(data_set_id, digest):
+    return f"id_service:upload:{data_set_id or 'public'}:{digest}"
+
+
+def digest(upload) -> str:
+    """hash of the raw upload bytes, the file is left at the start"""
+    hasher = hashlib.blake2b(digest_size=20)
+    upload.seek(0)
+    if hasattr(upload, "chunks"):
+        for chunk in upload.chunks():
+            hasher.update(chunk)
+    else:
+        hasher.update(upload.read())
+    upload.seek(0)
+    return hasher.hexdigest()
+
+
+def lookup(data_set_id, upload_digest):
+    """returns (image file name, embedding, identity id) of an earlier upload, None if there isn't one"""
+    if not settings.UPLOAD_CACHE_ENABLED:
+        return None
+    cached = _cache().get(_key(data_set_id, upload_digest))
+    if cached is None:
+        return None
+
+    image_file, embedding, identity_id = cached
+    # identity may have been deleted or merged since, it'll be matched again
+    if identity_id is not None and not AnimalRecord.objects.filter(id=identity_id, data_set_id=data_set_id).exists():
+        identity_id = None
+    return image_file, embedding, identity_id
+
+
+def store(data_set_id, upload_digest, record):
+    if not settings.UPLOAD_CACHE_ENABLED or record.embedding is None:
+        return
+    _cache().set(
+        _key(data_set_id, upload_digest),
+        (record.image_file.name, bytes(record.embedding), record.identity_id),
+        settings.UPLOAD_CACHE_TTL,
+    )
@@ -1,7 +1,9 @@
+from django.conf import settings
 from django.urls import path
 
-from .views import ImageView, AnimalView, DataSetView
-from .views import get_documentation, get_about_me, get_demo_app, new_token, new_dataset
+from .views import ImageView, ImageBatchView, AnimalView, DataSetView, DataSetExportView, JobView
+from .async_views import AsyncImageView
+from .views import get_documentation, get_about_me, get_demo_app, new_token, new_dataset, get_timings
 
 urlpatterns = [
     path("z/doc", get_documentation, name="documentation"),
@@ -9,9 +11,13 @@ urlpatterns = [
     path("z/new_set", new_dataset, name="new_dataset"),
     path("z/demo_app", get_demo_app, name="demo_app"),
     path("z/about", get_about_me, name="about_me"),
+    path("z/timings", get_timings, name="timings"),
     # API endpoints
-    path("image/<str:pk>", ImageView.as_view(), name="image_endpoint"),
+    path("image/batch", ImageBatchView.as_view(), name="image_batch_endpoint"),
+    path("image/<str:pk>", (AsyncImageView if settings.ASYNC_VIEWS else ImageView).as_view(), name="image_endpoint"),
     path("animal/<str:pk>", AnimalView.as_view(), name="animal_endpoint"),
     path("sets/<str:pk>", DataSetView.as_view(), name="data_set_endpoint"),
-    path("sets/<str:pk>/<str:rel>", DataSetView.as_view(), name="data_set_endpoint")
+    path("sets/<str:pk>/export", DataSetExportView.as_view(), name="data_set_export_endpoint"),
+    path("sets/<str:pk>/<str:rel>", DataSetView.as_view(), name="data_set_endpoint"),
+    path("jobs/<str:pk>", JobView.as_view(), name="job_endpoint"),
 ]
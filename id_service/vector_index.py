@@ -0,0 +1,334 @@
+"""
+In-process nearest neighbour index over image embeddings
+one index is kept per DataSet (public images are keyed under None), built from db the first time it's queried
+ImageRecord save / delete signals keep loaded indexes up to date, see signals.py
+note: every worker process keeps its own copy, so ids coming out of here should always be confirmed against the db
+when EMBEDDING_STORE_ENABLED, indexes are built straight from the memory-mapped embedding store,
+and rows other processes appended to it since are added before each query (a rebuilt store is loaded again).
+without the store, an index is loaded again when the data set's count of encoded images has changed,
+counted at most every VECTOR_INDEX_RECHECK_INTERVAL seconds, so saves in other processes show up that much later
+on postgres with VECTOR_CUBE_ENABLED, nearest asks the database instead, see pg_cube.py
+"""
+import threading
+import time
+import warnings
+
+import numpy as np
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .models import ImageRecord, unpack_vector
+from .embedding_store import get_store
+from . import pg_cube
+
+
+class BaseIndex:
+    """
+    Bookkeeping shared by all index backends
+    vectors are held in a static structure built once, records added after that go to a small pending buffer
+    that is brute force searched, removed records are tombstoned.
+    the static structure is rebuilt once the buffer / tombstones grow too large
+
+    To implement a backend, subclass this and implement:
+    -_build, make search structure over self.vectors
+    -_query_base, return (positions, distances) of base vectors within radius of query
+
+    distance is chebyshev (max abs difference per dimension),
+    so a radius query returns the same box a per component range filter would
+    rows of NaN (deleted in the embedding store) are never within radius of anything
+    """
+    min_rebuild_size = 64  # <= don't bother rebuilding for a handful of changes
+
+    def __init__(self, ids, vectors):
+        self._lock = threading.RLock()
+        self.loaded = None  # <= embedding store version the index has caught up to, see get_index
+        self.checked = time.monotonic()  # <= last time the db was asked whether the index is current, without the store
+        self._reset(ids, vectors)
+
+    def _reset(self, ids, vectors):
+        self.ids = np.array(ids, dtype=object)
+        self.vectors = np.asarray(vectors, dtype=np.float32)
+        if len(self.ids) == 0:
+            self.vectors = self.vectors.reshape((0, 0))
+        self.positions = {record_id: i for i, record_id in enumerate(self.ids)}
+        self.pending = {}
+        self.removed = set()
+        self._build()
+
+    def __len__(self):
+        return len(self.ids) - len(self.removed) + len(self.pending)
+
+    def add(self, record_id, vector):
+        with self._lock:
+            if record_id in self.positions:
+                self.removed.add(record_id)
+            self.pending[record_id] = np.asarray(vector, dtype=np.float32)
+            self._maybe_rebuild()
+
+    def remove(self, record_id):
+        with self._lock:
+            self.pending.pop(record_id, None)
+            if record_id in self.positions:
+                self.removed.add(record_id)
+            self._maybe_rebuild()
+
+    def query(self, vector, radius, k=None):
+        """returns up to k record ids within radius of vector, closest first"""
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            found = []
+            if len(self.ids) != 0:
+                positions, distances = self._query_base(vector, radius)
+                found += [
+                    (dist, self.ids[pos]) for pos, dist in zip(positions, distances)
+                    if self.ids[pos] not in self.removed
+                ]
+            if len(self.pending) != 0:
+                pending_ids = list(self.pending.keys())
+                distances = np.abs(np.stack(list(self.pending.values())) - vector).max(axis=1)
+                found += [(distances[i], pending_ids[i]) for i in np.flatnonzero(distances <= radius)]
+
+        found.sort(key=lambda x: x[0])
+        return [record_id for dist, record_id in found[:k]]
+
+    def _maybe_rebuild(self):
+        changes = len(self.pending) + len(self.removed)
+        if changes < max(self.min_rebuild_size, len(self.ids) // 10):
+            return
+        keep = [i for i, record_id in enumerate(self.ids) if record_id not in self.removed and record_id not in self.pending]
+        ids = list(self.ids[keep]) + list(self.pending.keys())
+        vectors = list(self.vectors[keep]) + list(self.pending.values())
+        self._reset(ids, vectors)
+
+    def _build(self):
+        raise NotImplementedError
+
+    def _query_base(self, vector, radius):
+        raise NotImplementedError
+
+
+class BruteForceIndex(BaseIndex):
+    """linear scan in numpy, fine for small data sets and used as reference in tests"""
+
+    def _build(self):
+        pass
+
+    def _query_base(self, vector, radius):
+        distances = np.abs(self.vectors - vector).max(axis=1)
+        positions = np.flatnonzero(distances <= radius)
+        return positions, distances[positions]
+
+
+class KDTreeIndex(BaseIndex):
+    """
+    static kd-tree over the base vectors, split on median of the widest dimension
+    nodes are kept in flat lists, leaves point to a slice of self.order
+    """
+    leaf_size = 16
+
+    def _build(self):
+        self.order = np.arange(len(self.ids))
+        # per node: split dim, split value, left child, right child, leaf start, leaf end
+        self.nodes = []
+        if len(self.ids) != 0:
+            self._build_node(0, len(self.ids))
+
+    def _build_node(self, start, end):
+        node_id = len(self.nodes)
+        self.nodes.append(None)
+
+        members = self.order[start:end]
+        if end - start <= self.leaf_size:
+            self.nodes[node_id] = (-1, 0., -1, -1, start, end)
+            return node_id
+
+        points = self.vectors[members]
+        with warnings.catch_warnings():
+            # all NaN columns are fine, they just never get picked
+            warnings.simplefilter("ignore", RuntimeWarning)
+            spread = np.nanmax(points, axis=0) - np.nanmin(points, axis=0)
+        dim = int(np.argmax(np.nan_to_num(spread, nan=-1.)))
+        mid = (end - start) // 2
+        # partition members around median on dim
+        partitioned = np.argpartition(points[:, dim], mid)
+        self.order[start:end] = members[partitioned]
+        split = float(self.vectors[self.order[start + mid], dim])
+
+        left = self._build_node(start, start + mid)
+        right = self._build_node(start + mid, end)
+        self.nodes[node_id] = (dim, split, left, right, start, end)
+        return node_id
+
+    def _query_base(self, vector, radius):
+        positions = []
+        to_visit = [0]
+        while to_visit:
+            dim, split, left, right, start, end = self.nodes[to_visit.pop()]
+            if dim == -1:
+                members = self.order[start:end]
+                distances = np.abs(self.vectors[members] - vector).max(axis=1)
+                positions.append(members[distances <= radius])
+                continue
+            # left holds values <= split, right holds values >= split
+            if vector[dim] - radius <= split:
+                to_visit.append(left)
+            if vector[dim] + radius >= split:
+                to_visit.append(right)
+
+        positions = np.concatenate(positions) if positions else np.array([], dtype=int)
+        return positions, np.abs(self.vectors[positions] - vector).max(axis=1)
+
+
+def rank_by_distance(candidates:np.ndarray, vector, k=None, metric="l2") -> np.ndarray:
+    """
+    returns positions of the k candidates closest to vector, closest first
+    metric is either l2 or cosine, computed for all candidates at once
+    """
+    vector = np.asarray(vector, dtype=np.float32)
+    if metric == "l2":
+        distances = np.linalg.norm(candidates - vector, axis=1)
+    elif metric == "cosine":
+        norms = np.linalg.norm(candidates, axis=1) * np.linalg.norm(vector)
+        distances = 1. - candidates @ vector / np.maximum(norms, np.finfo(np.float32).tiny)
+    else:
+        raise ValueError(f"unknown metric {metric}")
+
+    if k is not None and k < len(distances):
+        # partial sort, only the k survivors get ordered
+        top = np.argpartition(distances, k)[:k]
+        return top[np.argsort(distances[top])]
+    return np.argsort(distances)
+
+
+def rank_candidates(identities:np.ndarray, candidates:np.ndarray, vector):
+    """identities and vectors of the DIFFERENTIATOR_TOP_K candidates closest to vector, closest first"""
+    # only the closest few candidates by exact distance go on to the differentiator
+    closest = rank_by_distance(candidates, vector, k=settings.DIFFERENTIATOR_TOP_K, metric=settings.DIFFERENTIATOR_PREFILTER_METRIC)
+    return identities[closest], candidates[closest]
+
+
+def best_match(identities:np.ndarray, sameness):
+    """id of the animal with most same candidates, None if none are the same, ties go to the closest"""
+    # tally each hit in identity/sameness, candidates come closest first
+    possible_ids, first_seen, counts = np.unique(
+        identities[np.array(sameness, dtype=bool)].astype(str), return_index=True, return_counts=True)
+    if len(possible_ids) == 0:
+        return None
+    # take highest count
+    return str(possible_ids[np.lexsort((first_seen, -counts))[0]])
+
+
+###
+## Per DataSet registry
+#
+_indexes = {}
+_registry_lock = threading.Lock()
+
+
+def _key(value):
+    # freshly created models hold uuid objects rather than str
+    return None if value is None else str(value)
+
+
+def _encoded(data_set_id):
+    return ImageRecord.objects.filter(data_set_id=data_set_id, embedding__isnull=False)
+
+
+def _load_index(data_set_id):
+    if settings.EMBEDDING_STORE_ENABLED:
+        store = get_store(data_set_id)
+        ids, vectors = store.arrays()
+        index = import_string(settings.VECTOR_INDEX_BACKEND)(ids, vectors)
+        index.loaded = store.version
+        return index
+
+    rows = _encoded(data_set_id).values_list("id", "embedding")
+    ids = [each[0] for each in rows]
+    vectors = [unpack_vector(each[1]) for each in rows]
+    return import_string(settings.VECTOR_INDEX_BACKEND)(ids, vectors)
+
+
+def _is_current(index, data_set_id):
+    """catches index up with rows other processes have added, False if it has to be loaded again"""
+    if not settings.EMBEDDING_STORE_ENABLED:
+        # a count over the data set, so at most every VECTOR_INDEX_RECHECK_INTERVAL seconds
+        now = time.monotonic()
+        if now - index.checked < settings.VECTOR_INDEX_RECHECK_INTERVAL:
+            return True
+        index.checked = now
+        # this process's own saves are already in, so any difference was made elsewhere
+        return _encoded(data_set_id).count() == len(index)
+
+    if index.loaded is None:
+        # built from db, before the store was switched on
+        return False
+    store = get_store(data_set_id)
+    store.refresh()
+    inode, rows = store.version
+    loaded_inode, loaded_rows = index.loaded
+    if inode != loaded_inode:
+        # rebuilt, e.g. by manage.py reindex
+        return False
+    if rows > loaded_rows:
+        ids, vectors = store.arrays(start=loaded_rows)
+        for record_id, vector in zip(ids, vectors):
+            # rows deleted meanwhile are NaN
+            if np.isnan(vector).any():
+                index.remove(record_id)
+            else:
+                index.add(record_id, vector)
+        index.loaded = inode, rows
+    return True
+
+
+def get_index(data_set_id):
+    """
+    returns the index for a data set, loading it from db if this worker hasn't seen it yet,
+    or catching it up with images saved by other processes if it has
+    """
+    data_set_id = _key(data_set_id)
+    with _registry_lock:
+        index = _indexes.get(data_set_id)
+        if index is None:
+            index = _indexes[data_set_id] = _load_index(data_set_id)
+            return index
+
+    # checked outside the registry lock, lookups in other data sets carry on meanwhile
+    with index._lock:
+        if _is_current(index, data_set_id):
+            return index
+    with _registry_lock:
+        index = _indexes[data_set_id] = _load_index(data_set_id)
+        return index
+
+
+def nearest(vector, data_set_id=None, radius=settings.SPACIAL_QUERY_DIST, k=settings.VECTOR_INDEX_TOP_K):
+    """returns ids of up to k images in data set within radius of vector, closest first"""
+    if pg_cube.enabled():
+        # the database has its own index, see pg_cube.py
+        return [str(each) for each in ImageRecord.vector_queryset(vector, radius, data_set_id, k).values_list("id", flat=True)]
+    return get_index(data_set_id).query(vector, radius, k)
+
+
+def record_saved(record):
+    """update loaded indexes after an ImageRecord is saved, indexes not loaded yet will pick it up from db"""
+    data_set_id = _key(record.data_set_id)
+    has_vector = record.vector is not None
+    for key, index in list(_indexes.items()):
+        if key == data_set_id and has_vector:
+            index.add(str(record.id), record.vector)
+        else:
+            # the record may have moved between data sets or lost its vector
+            index.remove(str(record.id))
+
+
+def record_deleted(record):
+    index = _indexes.get(_key(record.data_set_id))
+    if index is not None:
+        index.remove(str(record.id))
+
+
+def reset():
+    """drop all loaded indexes, they are rebuilt from db on next query"""
+    with _registry_lock:
+        _indexes.clear()
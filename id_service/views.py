@@ -1,21 +1,57 @@
+import asyncio
+import json
+import time
+import zipfile
+from contextlib import ExitStack
+from datetime import timedelta
+from functools import wraps
+from io import BytesIO
+from itertools import islice
+
+import numpy as np
+from PIL import Image
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.shortcuts import render
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import ObjectDoesNotExist, PermissionDenied,RequestAborted
 from django.core.files.images import ImageFile
-from django.http import Http404, JsonResponse, FileResponse, HttpResponseBadRequest, HttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import Http404, JsonResponse, FileResponse, HttpResponseBadRequest, HttpResponse, HttpResponseNotAllowed, StreamingHttpResponse
+from django.http.response import HttpResponseBase
 from django.views.generic.base import View
 from django.views.generic.edit import model_forms
 from django.views.generic.list import MultipleObjectMixin
-from django.db.models import Model
+from django.db.models import Model, Q
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.functional import cached_property
 
 
-from .models import ImageRecord, AnimalRecord, DataSet, APIToken
-from .inference import standardize_image, call_encoder, call_differenciator
+from .models import ImageRecord, AnimalRecord, DataSet, APIToken, UploadJob, VECTOR_DTYPE, unpack_vector
+from .inference import call_encoder, call_encoder_batch, call_differenciator
+from .preprocessing import preprocess
+from . import identity_lock, jobs, prototypes, timing, upload_cache
+from . import rate_limit
+from .token_cache import get_token, counters
+from .vector_index import nearest, rank_candidates, best_match
 
 
 ###
 ## API Views
 #
+def charge(token, expensive_action=False, cost=1, action=None):
+    """
+    takes cost actions off token, raises RateLimited (answered with a 429) if its bucket doesn't hold that many
+    action names a rate limit class other than cheap / expensive, counted as expensive actions
+    """
+    if not token.is_valid():
+        raise PermissionDenied
+    rate_limit.check(token.id, expensive=expensive_action, cost=cost, action=action)
+    # increment action counter, counts are written back to db in batches, see token_cache.py
+    counters.record(token, expensive=expensive_action, count=cost)
+
+
 def check_token(expensive_action=False):
     """
     this function can only decorate class based view methods! 
@@ -23,23 +59,20 @@ def check_token(expensive_action=False):
     """
     def __decorator(decoratee):
 
+        # the undecorated method stays reachable as __wrapped__, see jobs.py
+        @wraps(decoratee)
         def __inner(*args, **kwargs):
-            view_instance = args[0]
-            if view_instance.token.is_valid(expensive=expensive_action):
-                # increment action counter
-                if expensive_action:
-                    view_instance.token.expensive_actions += 1
-                else:
-                    view_instance.token.actions += 1
+            charge(args[0].token, expensive_action)
+            return decoratee(*args, **kwargs)
 
-                # save token after view has returned, so we can increment expensive counters later on
-                return decoratee(*args, **kwargs)
+        @wraps(decoratee)
+        async def __async_inner(*args, **kwargs):
+            # rate limit cache and counters are blocking i/o, kept off the event loop
+            await sync_to_async(charge)(args[0].token, expensive_action)
+            return await decoratee(*args, **kwargs)
 
-            else:
-                # TODO : add more helpful error message, make distinction between 429 and 403
-                raise PermissionDenied
-
-        return __inner
+        # async methods stay coroutine functions, see async_views.py
+        return __async_inner if asyncio.iscoroutinefunction(decoratee) else __inner
 
     return __decorator
 
@@ -56,7 +89,7 @@ class UnifiedBase(View):
     1. get_or_create_object  
     1. django.View.dispatch => get or post or delete  
     1. (optional, using related model list) get_related  
-    1. self.object.save and self.token.save
+    1. save_object unless it's a read (token action counters are flushed in batches by token_cache)
     1. json_response
     ideally methods doesn't return anything but rather modify view instance attributes
     
@@ -67,6 +100,7 @@ class UnifiedBase(View):
     -(optional) in order to return related model lists, either:  
     define default_related_names in class declaration _OR_
     include an kwarg str:rel in url routing
+    related lists are paged by id (?after=&limit=, next page cursors are under "next"), or streamed with ?stream=1
     """
     model = None  # <= django model class
     default_related_names = []  # <= related name of foreign key fields
@@ -78,7 +112,7 @@ class UnifiedBase(View):
 
         # ensure we have a valid token attached to request
         try:
-            self.token = APIToken.objects.get(id=request.headers.get("x-api-key"))
+            self.token = get_token(request.headers.get("x-api-key"))
         except APIToken.DoesNotExist:
             raise PermissionDenied
 
@@ -94,12 +128,24 @@ class UnifiedBase(View):
         except KeyError:
             pass
 
+        # related lists are paged by id, ?after=<last id of previous page>&limit=<page size>
+        # or streamed whole with ?stream=1
+        self.page_after = request.GET.get("after")
+        try:
+            self.page_limit = min(int(request.GET.get("limit", settings.RELATED_PAGE_SIZE)), settings.RELATED_MAX_PAGE_SIZE)
+        except ValueError:
+            self.page_limit = settings.RELATED_PAGE_SIZE
+        self.page_limit = max(self.page_limit, 1)
+        self.stream = request.GET.get("stream") in ("1", "true")
+
+    @cached_property
+    def readable_set_ids(self):
+        # resolved once per request, filter_by_token runs for the object and every related list
+        return list(self.token.read_set.values_list("id",flat=True))
+
     def filter_by_token(self, queryset):
-        if len(self.token.read_set.all()) == 0:
-            return queryset.filter(data_set=None)
-        else:
-            return queryset.filter(data_set=None) | \
-                   queryset.filter(data_set__in=self.token.read_set.all().values_list("id",flat=True))
+        # public data or data in one of the token's read sets
+        return queryset.filter(Q(data_set__isnull=True) | Q(data_set_id__in=self.readable_set_ids))
 
     def get_or_create_object(self):
         # get object or create new
@@ -130,10 +176,54 @@ class UnifiedBase(View):
             data=self.request.POST,files=self.request.FILES,instance=self.object)
 
     def json_response(self):
+        if self.stream and len(self.related) != 0:
+            return StreamingHttpResponse(self.stream_json(), content_type="application/json")
+        return JsonResponse(self.serialize_object())
+
+    def stream_json(self):
+        """
+        yields the same json as serialize_object, but with every related id, not just a page
+        ids are read off a server side cursor RELATED_STREAM_CHUNK_SIZE at a time, so memory stays bounded
+        """
+        head = json.dumps(self.serialize_object(with_related=False), cls=DjangoJSONEncoder)
+        # leave the object open, related lists go after the basic fields
+        yield head[:-1]
+
+        for name, each_set in self.related.items():
+            yield f", {json.dumps(name)}: ["
+            ids = each_set.order_by("id").values_list("id",flat=True).iterator(chunk_size=settings.RELATED_STREAM_CHUNK_SIZE)
+            separator = ""
+            while True:
+                chunk = list(islice(ids, settings.RELATED_STREAM_CHUNK_SIZE))
+                if len(chunk) == 0:
+                    break
+                yield separator + ", ".join(json.dumps(str(each)) for each in chunk)
+                separator = ", "
+            yield "]"
+        yield "}"
+
+    def get_page(self, related_set):
+        """returns one page of ids from related_set, and the cursor for the next page (None on the last page)"""
+        related_set = related_set.order_by("id")
+        if self.page_after is not None:
+            related_set = related_set.filter(id__gt=self.page_after)
+        # one extra to see if there's a next page
+        ids = list(related_set.values_list("id",flat=True)[:self.page_limit + 1])
+        if len(ids) > self.page_limit:
+            return ids[:self.page_limit], ids[self.page_limit - 1]
+        return ids, None
+
+    def serialize_object(self, with_related=True):
         # dump out basic fields, always include id
         to_json = {"model":self.model.__name__}
         for each in ["id"] + self.fields:
-            value = getattr(self.object,each,None)
+            field = self.model._meta.get_field(each)
+            if field.many_to_one:
+                # serialize model by id, read off the foreign key so related object isn't fetched
+                value = getattr(self.object,field.attname,None)
+                value = None if value is None else str(value)
+            else:
+                value = getattr(self.object,each,None)
             # serialize model by id
             if isinstance(value,Model):
                 value = str(value.id)
@@ -146,10 +236,12 @@ class UnifiedBase(View):
 
             to_json[each] = value
 
-        # dump out related fields
-        for name, each_set in self.related.items():
-            to_json[name] = list(each_set.values_list("id",flat=True))
-        return JsonResponse(to_json)
+        # dump out related fields, a page at a time
+        if with_related and len(self.related) != 0:
+            to_json["next"] = {}
+            for name, each_set in self.related.items():
+                to_json[name], to_json["next"][name] = self.get_page(each_set)
+        return to_json
 
     def dispatch(self, request, *args, **kwargs):
         # setting up data first before dispatching to HTTP methods
@@ -159,19 +251,25 @@ class UnifiedBase(View):
         # since most likely we'll want a json response with object data
         ok = super(UnifiedBase, self).dispatch(request,*args,**kwargs)
 
+        return self.finish_response(ok)
+
+    def finish_response(self, ok):
         if ok is True:
-            # save object
-            self.object.save()
-            # save token
-            self.token.save()
+            # save object, nothing to write for reads
+            if self.request.method not in ("GET", "HEAD"):
+                self.save_object()
             # getting related data if any for response
             self.get_related()
             return self.json_response()
-        elif isinstance(ok,HttpResponse):
+        elif isinstance(ok,HttpResponseBase):
             return ok
         else:
             return HttpResponseBadRequest()
 
+    @timing.timed("save")
+    def save_object(self):
+        self.object.save()
+
     # GET and Delete are always available
     @check_token()
     def get(self,request,*args,**kwargs):
@@ -197,6 +295,7 @@ class ImageView(UnifiedBase):
     """
     model = ImageRecord
     fields = ["data_set","image_file","identity"]
+    pending_identity = None  # <= new animal for object, made in save_object
 
     @check_token()
     def post(self,request,*args,**kwargs):
@@ -207,20 +306,33 @@ class ImageView(UnifiedBase):
         if populated_form.is_valid():
             self.object = populated_form.save(commit=False)
 
-            # TODO : validate image and call image encoder here
-            try:
-                cleaned_image, embedding_vector = self.process_image(populated_form.files["image_file"])
-                # update object with computed image related data
-                self.object.image_file.save(str(self.object.id),cleaned_image)
+            image_file = populated_form.files.get("image_file")
+            if image_file is None:
+                # No image is uploaded, no ML inference
+                return True
+
+            # the same bytes may have been uploaded before, see upload_cache.py
+            upload_digest = upload_cache.digest(image_file)
+            cached = upload_cache.lookup(self.object.data_set_id, upload_digest)
+            if cached is not None:
+                # reuse stored file and embedding, nothing to decode or encode
+                self.object.image_file, self.object.embedding, cached_identity = cached
+                embedding_vector = self.object.vector
+                if self.object.identity_id is None:
+                    self.object.identity_id = cached_identity
+            elif settings.ASYNC_UPLOADS:
+                # answer now, decoding and inference run in the background, see jobs.py
+                return self.queue_upload(image_file, upload_digest)
+            else:
+                cleaned_image, embedding_vector = self.process_image(image_file)
+                # update object with computed image related data, written with the record
+                self.object.image_file.save(str(self.object.id),cleaned_image,save=False)
                 self.object.vector = embedding_vector
 
-                # if an identity isn't provided, make new or find matching one
-                if self.object.identity is None:
-                    self.object.identity = self.get_identity(embedding_vector)
-
-            except KeyError:
-                # No image is uploaded, no ML inference
-                pass
+            # if an identity isn't provided, make new or find matching one
+            if self.object.identity_id is None:
+                self.object.identity = self.get_identity(embedding_vector)
+            upload_cache.store(self.object.data_set_id, upload_digest, self.object)
 
         # new records have empty forms, but still it's not a bad request
         elif self.kwargs['pk'] != "new":
@@ -228,13 +340,38 @@ class ImageView(UnifiedBase):
 
         return True
 
+    def queue_upload(self,image_file,upload_digest):
+        """
+        saves the record without image data and queues the raw upload for inference,
+        returns a 202 response pointing at the job to poll
+        """
+        # charged now for what the job will run, the worker doesn't check the token again
+        self.charge_inference()
+        if self.object.identity_id is None:
+            self.charge_inference()
+
+        # image and vector are filled in by the job, only standardized images are kept
+        self.object.image_file = None
+        self.object.embedding = None
+        self.object.save()
+        job = jobs.enqueue(self.object, self.token, image_file, upload_digest)
+
+        response = JsonResponse({"model": UploadJob.__name__, "id": str(job.id), "status": job.status, "image": str(self.object.id)}, status=202)
+        response["Location"] = reverse("job_endpoint", kwargs={"pk": job.id})
+        return response
+
+    @check_token(expensive_action=True)
+    def charge_inference(self):
+        # counts one expensive action against the token, without doing it
+        pass
+
     @check_token(expensive_action=True)
     def process_image(self,image_file):
         """
         returns a cleaned, standard sized django ImageFile, and embedding vector of image
         """
-        # resize image
-        new_file, pixels = standardize_image(image_file)
+        # resize image, in the preprocessing pool if there is one
+        new_file, pixels = preprocess([image_file])[0]
 
         # run pixels through encoder
         vector = call_encoder(pixels)
@@ -243,41 +380,256 @@ class ImageView(UnifiedBase):
 
     @check_token(expensive_action=True)
     def get_identity(self,vector):
-        # query db by vector proximity
-        same_set = ImageRecord.vector_queryset(vector)
-
-        # bail early and create new id if nothing came back from db
-        if len(same_set) == 0:
-            new_animal = AnimalRecord.objects.create(data_set=self.token.write_set)
-            return new_animal
-
-        #  verify each possible candidate
-        compare_left = [each_record.vector for each_record in same_set]
-        compare_right = [vector for each in compare_left]
-        sameness = call_differenciator(compare_left,compare_right)
-
-        # decode and find animal id
-        # write identity to object
-        possible_ids = {}
-
-        for is_same, animal_id in zip(sameness,same_set.values_list("identity_id",flat=True)):
-            # tally each hit in identity/sameness
-            if is_same:
-                try:
-                    possible_ids[str(animal_id)] += 1
-                except KeyError:
-                    possible_ids[str(animal_id)] = 1
-
-        # if none are found, make new id
-        if len(possible_ids) == 0:
-            new_animal = AnimalRecord.objects.create(data_set=self.token.write_set)
-            return new_animal
+        # animals made by other uploads from here on are checked again before a new one is saved
+        self.matching_started = timezone.now()
+        identities, candidates = self.get_candidates(vector)
+
+        #  verify each possible candidate, query vector is broadcast against all of them
+        sameness = call_differenciator(candidates, np.asarray(vector, dtype=np.float32)) if len(candidates) else []
+
+        return self.resolve_identity(identities, sameness)
+
+    def get_candidates(self,vector):
+        """
+        returns identity ids and vectors of the closest images to vector, closest first
+        with IDENTITY_MATCHING = "prototype" candidates are animal centroids instead, one per animal
+        """
+        # query in-process index by vector proximity, then confirm candidates against db
+        if settings.IDENTITY_MATCHING == "prototype":
+            with timing.stage("vector_query"):
+                candidate_ids = prototypes.nearest(vector, data_set_id=self.object.data_set_id)
+            with timing.stage("candidate_fetch"):
+                same_set = AnimalRecord.objects.filter(id__in=candidate_ids, centroid__isnull=False)
+                rows = list(same_set.values_list("id", "centroid"))
         else:
-            # take highest count, assign image to that animal
-            ranked = sorted(possible_ids.items(),key=lambda x:x[1],reverse=True)
+            with timing.stage("vector_query"):
+                candidate_ids = nearest(vector, data_set_id=self.object.data_set_id)
+            with timing.stage("candidate_fetch"):
+                same_set = ImageRecord.objects.filter(id__in=candidate_ids, identity__isnull=False)
+                rows = list(same_set.values_list("identity_id", "embedding"))
+        timing.count("candidates", len(rows))
+        return self.rank_candidates(rows, vector)
+
+    def get_recent_candidates(self,vector,since):
+        """
+        same as get_candidates, but only over images of animals made since, read straight from db
+        the in-process indexes of other workers don't have these yet
+        """
+        recent = ImageRecord.objects.filter(
+            data_set_id=self.object.data_set_id, identity__created__gte=since, embedding__isnull=False
+        ).exclude(id=self.object.id)
+        rows = list(recent.values_list("identity_id", "embedding"))
+        if len(rows) != 0:
+            # same box nearest() searches
+            vectors = np.stack([unpack_vector(each[1]) for each in rows])
+            within = np.abs(vectors - np.asarray(vector, dtype=np.float32)).max(axis=1) <= settings.SPACIAL_QUERY_DIST
+            rows = [each for each, keep in zip(rows, within) if keep]
+        return self.rank_candidates(rows, vector)
+
+    @staticmethod
+    def rank_candidates(rows,vector):
+        """(identity id, packed vector) rows as arrays of identities and vectors, closest first"""
+        if len(rows) == 0:
+            return np.array([], dtype=object), np.zeros((0, settings.EMBEDDING_DIM), dtype=np.float32)
+
+        identities = np.array([each[0] for each in rows], dtype=object)
+        candidates = np.stack([unpack_vector(each[1]) for each in rows])
+        return rank_candidates(identities, candidates, vector)
+
+    def resolve_identity(self,identities,sameness):
+        """returns animal with most same candidates, or a new, not yet saved animal if none are the same"""
+        found_id = best_match(identities, sameness)
+
+        # if none are found, make new id when the record is saved, see save_object
+        if found_id is None:
+            self.pending_identity = AnimalRecord(data_set=self.token.write_set)
+            return self.pending_identity
+        else:
+            # assign image to that animal
+            return AnimalRecord.objects.get(id=found_id)
+
+    @timing.timed("save")
+    def save_object(self):
+        """
+        saves the record, along with its new animal if matching came up empty
+        animals made by other uploads since matching started are checked with the differentiator first, unlocked.
+        only if none match is the data set's identity lock taken, to check the few made while that ran and to
+        make the animal in the same transaction as the record, see identity_lock.py
+        """
+        new_animal, self.pending_identity = self.pending_identity, None
+        if new_animal is None or self.object.identity is not new_animal:
+            self.object.save()
+            return
 
-            found_animal = AnimalRecord.objects.get(id=ranked[0][0])
-            return found_animal
+        vector = np.asarray(self.object.vector, dtype=np.float32)
+        checked_since = timezone.now()
+        found_id, checked = self.recheck(vector, self.matching_started)
+        if found_id is not None:
+            self.object.identity_id = found_id
+            self.object.save()
+            return
+
+        with identity_lock.hold(self.object.data_set_id):
+            found_id, checked = self.recheck(vector, checked_since, skip=checked)
+            if found_id is None:
+                new_animal.save()
+                self.object.identity = new_animal
+            else:
+                self.object.identity_id = found_id
+            self.object.save()
+
+    def recheck(self,vector,since,skip=()):
+        """
+        matches vector against images of animals made since (less IDENTITY_RECHECK_WINDOW), but not in skip
+        returns the best match or None, and the animal ids that were checked
+        """
+        since = since - timedelta(seconds=settings.IDENTITY_RECHECK_WINDOW)
+        identities, candidates = self.get_recent_candidates(vector, since)
+        unchecked = np.array([str(each) not in skip for each in identities], dtype=bool)
+        identities, candidates = identities[unchecked], candidates[unchecked]
+        # charged with the get_identity that made the animal
+        sameness = call_differenciator(candidates, vector) if len(candidates) else []
+        return best_match(identities, sameness), set(skip) | {str(each) for each in identities}
+
+
+class BatchTooLarge(Exception):
+    """an archive in a batch upload is too large to unpack, answered with a 413"""
+
+
+class ImageBatchView(ImageView):
+    """
+    Batch upload endpoint for ImageRecord,
+    accepts any number of files under image_file, each either an image or a zip archive of images
+    zip members that aren't images (directories, __MACOSX/, dot files, ...) are skipped
+    images are decoded and encoded ENCODER_BATCH_SIZE at a time, so memory doesn't grow with the batch,
+    then identities are resolved one by one so images in the same batch can match each other
+    the whole batch is charged up front, one image at a time from the token's "batch" rate limit, so a 429 comes
+    before anything is saved. batches larger than that bucket's burst could never go through and get a 413
+    returns a json array of ImageView style objects, in upload order
+    """
+    form_fields = ["data_set"]  # <= only data set can be set for the whole batch
+
+    def dispatch(self, request, *args, **kwargs):
+        # there is no single object to get or create here, go straight to HTTP method
+        self.object = self.model(data_set=self.token.write_set)
+        self.related = {}
+        return View.dispatch(self, request, *args, **kwargs)
+
+    def get_form(self,request):
+        return model_forms.modelform_factory(self.model,fields=self.form_fields)(
+            data=self.request.POST,instance=self.object)
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponseNotAllowed(["POST"])
+
+    def delete(self, request, *args, **kwargs):
+        return HttpResponseNotAllowed(["POST"])
+
+    @check_token()
+    def post(self,request,*args,**kwargs):
+        # data set is shared by the whole batch
+        populated_form = self.get_form(request=request)
+        if not populated_form.is_valid():
+            return HttpResponseBadRequest()
+        data_set = populated_form.cleaned_data["data_set"]
+
+        with ExitStack() as archives:
+            try:
+                uploads = self.list_uploads(request.FILES.getlist("image_file"), archives)
+            except BatchTooLarge as e:
+                return JsonResponse({"detail": str(e)}, status=413)
+            except (OSError, zipfile.BadZipFile):
+                return HttpResponseBadRequest()
+            if len(uploads) == 0:
+                return HttpResponseBadRequest()
+
+            burst = rate_limit.get_bucket(action="batch").burst
+            if len(uploads) > burst:
+                return JsonResponse({"detail": f"at most {burst:.0f} images per batch"}, status=413)
+            # covers encoding and matching every image, raises RateLimited before anything is done
+            charge(self.token, expensive_action=True, cost=len(uploads), action="batch")
+
+            results = []
+            for start in range(0, len(uploads), settings.ENCODER_BATCH_SIZE):
+                chunk = uploads[start:start + settings.ENCODER_BATCH_SIZE]
+                try:
+                    with ExitStack() as opened:
+                        cleaned = preprocess([opened.enter_context(open_upload()) for open_upload in chunk])
+                except (OSError, zipfile.BadZipFile):
+                    # PIL raises OSError subclasses for anything it can't read, zip members only had their header
+                    # checked in list_uploads. images of earlier chunks are kept
+                    return HttpResponseBadRequest()
+                vectors = self.encode_batch(np.concatenate([pixels for new_file, pixels in cleaned]))
+
+                for (new_file, pixels), embedding_vector in zip(cleaned, vectors):
+                    self.object = self.model(data_set=data_set)
+                    self.object.image_file.save(str(self.object.id), new_file, save=False)
+                    self.object.vector = embedding_vector
+                    # charged with the batch
+                    self.object.identity = ImageView.get_identity.__wrapped__(self, embedding_vector)
+                    self.save_object()
+                    results.append(self.serialize_object())
+
+        return JsonResponse(results, safe=False)
+
+    @classmethod
+    def list_uploads(cls, uploaded_files, archives):
+        """
+        returns a function per image that opens it, nothing is decoded or kept in memory yet
+        zip archives are listed member by member and entered on archives (an ExitStack), members that
+        aren't images are left out. only a member's header is read here, it's decompressed once, when opened.
+        raises OSError if a file uploaded on its own isn't an image, BatchTooLarge for archives with more than
+        BATCH_MAX_ARCHIVE_MEMBERS entries or a member over BATCH_MAX_MEMBER_SIZE bytes uncompressed
+        """
+        uploads = []
+        for each_file in uploaded_files:
+            if zipfile.is_zipfile(each_file):
+                archive = archives.enter_context(zipfile.ZipFile(each_file))
+                members = archive.infolist()
+                if len(members) > settings.BATCH_MAX_ARCHIVE_MEMBERS:
+                    raise BatchTooLarge(f"at most {settings.BATCH_MAX_ARCHIVE_MEMBERS} files per archive")
+                for member in members:
+                    if cls.is_hidden(member):
+                        continue
+                    # sizes come from the archive's directory, a member can't decompress past its file_size
+                    if member.file_size > settings.BATCH_MAX_MEMBER_SIZE:
+                        raise BatchTooLarge(f"{member.filename} is over {settings.BATCH_MAX_MEMBER_SIZE} bytes")
+                    with archive.open(member) as stream:
+                        if not cls.is_image(stream, verify=False):
+                            continue
+                    uploads.append(lambda archive=archive, member=member: archive.open(member))
+            else:
+                each_file.seek(0)
+                if not cls.is_image(each_file):
+                    raise OSError(f"{each_file} is not an image")
+                uploads.append(lambda each_file=each_file: each_file)
+        return uploads
+
+    @staticmethod
+    def is_hidden(member):
+        # directories, and what archivers add alongside, e.g. __MACOSX/ resource forks and .DS_Store
+        parts = member.filename.split("/")
+        return member.is_dir() or any(each.startswith(".") or each == "__MACOSX" for each in parts)
+
+    @staticmethod
+    def is_image(image_file, verify=True):
+        """True if PIL can read image_file's header and, with verify, it passes verify, without decoding pixels"""
+        try:
+            with Image.open(image_file) as image:
+                if verify:
+                    image.verify()
+            return True
+        except (OSError, SyntaxError):
+            return False
+        finally:
+            image_file.seek(0)
+
+    def encode_batch(self, pixels):
+        """returns embeddings for stacked pixels, calling the encoder once per chunk, charged by post"""
+        vectors = []
+        for start in range(0, len(pixels), settings.ENCODER_BATCH_SIZE):
+            vectors += call_encoder_batch(pixels[start:start + settings.ENCODER_BATCH_SIZE])
+        return vectors
 
 
 class AnimalView(UnifiedBase):
@@ -295,7 +647,7 @@ class DataSetView(UnifiedBase):
     def filter_by_token(self, queryset):
         # filtering by d_set too, only token associated to d_set can see this one
         if queryset.model == DataSet:
-            return queryset.filter(id__in=self.token.read_set.all().values_list("id",flat=True))
+            return queryset.filter(id__in=self.readable_set_ids)
         else:
             return super(DataSetView, self).filter_by_token(queryset=queryset)
 
@@ -309,6 +661,107 @@ class DataSetView(UnifiedBase):
         else:
             raise PermissionDenied
 
+
+class DataSetExportView(DataSetView):
+    """
+    Bulk export of a data set's embeddings,  
+    streams image id, identity id and vector of every image in the data set as one .npy structured array,
+    rows ordered by image id, load with numpy.load  
+    images are read EXPORT_CHUNK_SIZE at a time so memory stays bounded for any data set size
+    """
+    http_method_names = ["get"]
+
+    def dispatch(self, request, *args, **kwargs):
+        # don't let a POST to sets/new/export create a data set before being turned away
+        if request.method.lower() not in self.http_method_names:
+            return self.http_method_not_allowed(request, *args, **kwargs)
+        return super(DataSetExportView, self).dispatch(request, *args, **kwargs)
+
+    @property
+    def export_dtype(self):
+        return np.dtype([("id", "S36"), ("identity", "S36"), ("vector", "<f4", (settings.EMBEDDING_DIM,))])
+
+    @check_token(expensive_action=True)
+    def get(self, request, *args, **kwargs):
+        images = self.filter_by_token(self.object.images.all())
+        count = images.count()
+
+        header = BytesIO()
+        np.lib.format.write_array_header_1_0(header, {
+            "descr": np.lib.format.dtype_to_descr(self.export_dtype),
+            "fortran_order": False,
+            "shape": (count,),
+        })
+
+        response = StreamingHttpResponse(self.stream_rows(header.getvalue(), images, count), content_type="application/octet-stream")
+        response["Content-Length"] = str(len(header.getvalue()) + count * self.export_dtype.itemsize)
+        response["Content-Disposition"] = f'attachment; filename="{self.object.id}.npy"'
+        return response
+
+    def stream_rows(self, header, images, count):
+        yield header
+
+        rows = images.order_by("id").values_list("id", "identity_id", "embedding").iterator(chunk_size=settings.EXPORT_CHUNK_SIZE)
+        written = 0
+        while written < count:
+            chunk = list(islice(rows, min(settings.EXPORT_CHUNK_SIZE, count - written)))
+            if len(chunk) == 0:
+                break
+            yield self.pack_rows(chunk).tobytes()
+            written += len(chunk)
+
+        # header promised count rows, images deleted since counting come out as empty rows with nan vectors
+        if written < count:
+            padding = np.zeros(count - written, dtype=self.export_dtype)
+            padding["vector"] = np.nan
+            yield padding.tobytes()
+
+    def pack_rows(self, rows):
+        packed = np.zeros(len(rows), dtype=self.export_dtype)
+        packed["id"] = [each[0] for each in rows]
+        packed["identity"] = [each[1] or "" for each in rows]
+        # embeddings are already packed float32, no vector yet becomes nan
+        encoded = np.array([each[2] is not None for each in rows])
+        packed["vector"] = np.nan
+        packed["vector"][encoded] = np.frombuffer(
+            b"".join(each[2] for each in rows if each[2] is not None), dtype=VECTOR_DTYPE
+        ).reshape((-1, settings.EMBEDDING_DIM))
+        return packed
+
+
+class JobView(UnifiedBase):
+    """
+    Status of an upload queued with ASYNC_UPLOADS, see jobs.py
+    status is queued, running, done or failed, once done the image record holds the upload's results
+    add ?wait=<seconds> to hold the request until the job is finished, up to UPLOAD_JOB_MAX_WAIT
+    """
+    model = UploadJob
+    fields = ["status","image","error"]
+    http_method_names = ["get"]
+
+    def dispatch(self, request, *args, **kwargs):
+        # jobs are only made by uploads
+        if request.method.lower() not in self.http_method_names:
+            return self.http_method_not_allowed(request, *args, **kwargs)
+        return super(JobView, self).dispatch(request, *args, **kwargs)
+
+    @check_token()
+    def get(self, request, *args, **kwargs):
+        try:
+            wait = min(max(float(request.GET.get("wait", 0)), 0.), settings.UPLOAD_JOB_MAX_WAIT)
+        except ValueError:
+            wait = 0.
+
+        # woken early by jobs finishing in this process, jobs run elsewhere are caught by polling
+        deadline = time.monotonic() + wait
+        while self.object.status in (UploadJob.QUEUED, UploadJob.RUNNING):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            jobs.wait(min(remaining, settings.UPLOAD_JOB_POLL_INTERVAL))
+            self.object.refresh_from_db(fields=["status", "error"])
+        return True
+
 # TODO : finish static and management views
 
 ###
@@ -332,6 +785,12 @@ def new_dataset(request):
     pass
 
 
+@login_required()
+def get_timings(request):
+    """stage timing histograms of this worker process, see timing.py"""
+    return JsonResponse(timing.snapshot())
+
+
 ###
 ## Bonus / About Me pages
 #
@@ -0,0 +1 @@
+SECRET_KEY = "local-test-only"
@@ -41,6 +41,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'id_service.middleware.TimingMiddleware',  # <= first, so the whole request is timed
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -48,6 +49,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'id_service.middleware.RateLimitMiddleware',
 ]
 
 ROOT_URLCONF = 'proj.urls'
@@ -74,13 +76,52 @@ WSGI_APPLICATION = 'proj.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
 
+# sqlite for local runs, point DB_ENGINE (e.g. django.db.backends.postgresql) and the rest at a real server in production
+DB_ENGINE = os.environ.get("DB_ENGINE", "django.db.backends.sqlite3")
+DB_IS_SQLITE = DB_ENGINE.endswith("sqlite3")
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'ENGINE': DB_ENGINE,
+        'NAME': os.environ.get("DB_NAME", BASE_DIR / 'db.sqlite3' if DB_IS_SQLITE else "id_service"),
+        'USER': os.environ.get("DB_USER", ""),
+        'PASSWORD': os.environ.get("DB_PASSWORD", ""),
+        'HOST': os.environ.get("DB_HOST", ""),
+        'PORT': os.environ.get("DB_PORT", ""),
+        # seconds a connection is reused across requests, 0 closes it after every request
+        'CONN_MAX_AGE': int(os.environ.get("DB_CONN_MAX_AGE", 60)),
+        # seconds sqlite waits on another writer before giving up with "database is locked"
+        'OPTIONS': {'timeout': 20} if DB_IS_SQLITE else {},
     }
 }
 
+# run on every new sqlite connection, WAL lets readers carry on while one process writes
+# see id_service/signals.py
+SQLITE_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",  # <= safe with WAL, only the last commits can be lost on power failure
+    "temp_store": "memory",
+    "cache_size": -64000,  # <= KiB
+    "mmap_size": 256 * 1024 * 1024,
+}
+
+
+# Caches
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+
+# local memory is per process. rate limits need a cache every worker shares to hold across processes,
+# e.g. RATE_LIMIT_CACHE_BACKEND=django.core.cache.backends.memcached.MemcachedCache RATE_LIMIT_CACHE_LOCATION=memcached:11211
+# (or django.core.cache.backends.db.DatabaseCache and manage.py createcachetable), see id_service/rate_limit.py
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'rate_limit': {
+        'BACKEND': os.environ.get("RATE_LIMIT_CACHE_BACKEND", 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get("RATE_LIMIT_CACHE_LOCATION", 'rate_limit'),
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -126,15 +167,115 @@ MEDIA_URL = "/media/"
 
 # id_service specific settings
 # TODO : find a better place for this
+ASYNC_VIEWS = False  # <= serve uploads with the async views, only worth it under ASGI
 TOKEN_VALID_DAYS = 1
 MAX_ACTIONS_PER_SEC = 1.
 MAX_EXPENSIVE_ACTIONS_PER_SEC = 0.1
 SPACIAL_QUERY_DIST = 10.
 
+# token bucket per token and action class, burst is the most actions an idle token can make at once
+# see id_service/rate_limit.py
+RATE_LIMITS = {
+    "cheap": {"rate": MAX_ACTIONS_PER_SEC, "burst": 30},
+    "expensive": {"rate": MAX_EXPENSIVE_ACTIONS_PER_SEC, "burst": 10},
+    "batch": {"rate": 1., "burst": 1000},  # <= per image in image/batch, burst is also the largest batch taken
+}
+RATE_LIMIT_CACHE_ALIAS = "rate_limit"
+
+# related id lists in responses are paged, see UnifiedBase in id_service/views.py
+RELATED_PAGE_SIZE = 1000
+RELATED_MAX_PAGE_SIZE = 10000
+RELATED_STREAM_CHUNK_SIZE = 2000
+EXPORT_CHUNK_SIZE = 10000  # <= rows per chunk in sets/<pk>/export
+
+# manage.py reindex, see id_service/reindex.py
+REINDEX_CHUNK_SIZE = 256
+REINDEX_CHECKPOINT_DIR = BASE_DIR.joinpath("./reindex/")  # <= git ignored, not under MEDIA_ROOT so it isn't served
+
+# tokens are cached, action counters are written back in batches, see id_service/token_cache.py
+TOKEN_CACHE_ALIAS = "default"
+TOKEN_CACHE_TTL = 60
+TOKEN_FLUSH_INTERVAL = 5.
+# counts still pending are written back when the process exits, for app servers set TOKEN_FLUSH_ON_EXIT=1.
+# off by default, and always off in tests (see id_service/tests/__init__.py): by exit time the test database is gone
+# and the hook would write to the real one
+TOKEN_FLUSH_ON_EXIT = os.environ.get("TOKEN_FLUSH_ON_EXIT", "0") == "1"
+
+# nearest neighbour index used by identity lookup, see id_service/vector_index.py
+VECTOR_INDEX_BACKEND = "id_service.vector_index.KDTreeIndex"
+VECTOR_INDEX_TOP_K = 50
+VECTOR_INDEX_RECHECK_INTERVAL = 5.  # <= seconds between checks for images saved by other processes, without the store
+# on postgres, proximity queries run in the database on a cube GiST index instead, see id_service/pg_cube.py
+# only up to 100 dimensions, larger embeddings fall back to the in-process indexes
+VECTOR_CUBE_ENABLED = DB_ENGINE.endswith("postgresql")
+
+# memory-mapped embedding files shared between workers, see id_service/embedding_store.py
+EMBEDDING_STORE_ENABLED = True
+EMBEDDING_STORE_ROOT = MEDIA_ROOT.joinpath("embeddings")
+EMBEDDING_DIM = 4
+
 ENCODER_NAME = "encoder"
 DIFFERENTIATOR_NAME = "differ"
 TF_SERVER_PORT = 8501
+TF_SERVER_HOST = None  # <= None means each model is reached by its own name, as in docker-compose
+
+# pooled keep-alive client for tf-serving, timeouts are in seconds per model
+INFERENCE_POOL_SIZE = 10
+INFERENCE_TIMEOUTS = {ENCODER_NAME: 10., DIFFERENTIATOR_NAME: 5.}
+INFERENCE_RETRIES = 3
+INFERENCE_RETRY_BACKOFF = 0.2
+# how tensors are sent to each model, the b64 transports need models exported with a raw bytes input
+# see JSONTransport, Base64Transport and Base64PixelTransport in id_service/inference.py
+INFERENCE_TRANSPORTS = {
+    ENCODER_NAME: "id_service.inference.JSONTransport",
+    DIFFERENTIATOR_NAME: "id_service.inference.JSONTransport",
+}
+
+# where models run, RemoteBackend calls tf-serving containers, LocalBackend runs onnx exports in-process
+INFERENCE_BACKEND = "id_service.inference.RemoteBackend"
+INFERENCE_MODEL_DIR = BASE_DIR.joinpath("id_service/trained_models")
+INFERENCE_LOCAL_THREADS = 4
+
+# concurrent predict calls are merged into one request per model, see id_service/batching.py
+INFERENCE_BATCHING_ENABLED = True
+INFERENCE_MAX_BATCH_SIZE = 64
+INFERENCE_MAX_WAIT_MS = 5
+
+ENCODER_BATCH_SIZE = 32  # <= max images per encoder call on batch uploads
+BATCH_MAX_ARCHIVE_MEMBERS = 2000  # <= entries in a zip uploaded to image/batch, images or not
+BATCH_MAX_MEMBER_SIZE = 50 * 1024 * 1024  # <= bytes, uncompressed, of a single zip member
 
 IMAGE_SIZE = 240,240
+# preprocessing, see standardize_image. stored format can be anything PIL writes, e.g. "WEBP" with {"quality": 90}
+IMAGE_REDUCING_GAP = 3.
+PREPROCESSING_WORKERS = 0  # <= size of preprocessing process pool, 0 runs on the request thread
+PREPROCESSING_START_METHOD = "forkserver"  # <= or "spawn", not "fork", web processes run threads
+STORED_IMAGE_FORMAT = "PNG"
+STORED_IMAGE_OPTIONS = {"compress_level": 1}  # <= fast, somewhat larger files
 SAMENESS_THRESHOLD = 0.7
-
+# nearby images are ranked by exact distance (l2 or cosine), only the closest go to the differentiator
+DIFFERENTIATOR_TOP_K = 16
+DIFFERENTIATOR_PREFILTER_METRIC = "l2"
+# "image" votes over the closest images, "prototype" verifies against the closest animal centroids
+# see id_service/prototypes.py
+IDENTITY_MATCHING = "image"
+# new animals are made under a per data set lock, after checking animals other uploads made since matching started
+# the window reaches back this many seconds further, for clock skew between hosts. see id_service/identity_lock.py
+IDENTITY_RECHECK_WINDOW = 5.
+
+# results of earlier uploads by content hash, duplicates skip inference, see id_service/upload_cache.py
+UPLOAD_CACHE_ENABLED = True
+UPLOAD_CACHE_ALIAS = "default"
+UPLOAD_CACHE_TTL = 24 * 3600
+
+# uploads answer 202 with a job to poll at jobs/<pk>, inference runs in the background, see id_service/jobs.py
+ASYNC_UPLOADS = False
+UPLOAD_JOB_WORKERS = 2  # <= threads running jobs in each web process, 0 leaves them to manage.py process_uploads
+UPLOAD_JOB_MAX_WAIT = 30.  # <= longest a jobs/<pk>?wait= long-poll is held, in seconds
+UPLOAD_JOB_POLL_INTERVAL = 0.5
+
+# per request stage timings, sent in a Server-Timing header and kept in per process histograms served at z/timings
+# see id_service/timing.py
+TIMING_ENABLED = True
+TIMING_HISTOGRAM_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)  # <= ms
+TIMING_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)